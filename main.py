@@ -12,7 +12,18 @@ package net.sf.varscan;
 //Import required packages //
 
 import java.io.*;
+import java.net.*;
+import java.nio.ByteBuffer;
+import java.nio.ByteOrder;
+import java.nio.channels.FileChannel;
+import java.nio.charset.Charset;
+import java.nio.file.Files;
+import java.nio.file.attribute.PosixFilePermissions;
+import java.security.MessageDigest;
+import java.security.SecureRandom;
 import java.util.*;
+import java.util.concurrent.*;
+import java.util.zip.*;
 import java.text.*;
 
 
@@ -76,6 +87,31 @@ import java.text.*;
  * 			Input:	VarScan output for SNPs or Indels (varscan.output.snp)
  * 			Output: Variants by somatic status (varscan.output.snp.Somatic)
  *
+ * copynumber-batch [manifest] OPTIONS
+ * 			Run copynumber for many samples, several at a time, sharing the change-point caches
+ * 			Input:	Tab-delimited manifest of input pileups, output base name and options per sample
+ * 			Output: Copynumber output for each sample, and a per-sample timing and statistics summary
+ *
+ * serve OPTIONS
+ * 			Run copynumber jobs sent to a local TCP port on a pool of workers, keeping caches warm between jobs
+ * 			Input:	The access token, then lines of copynumber arguments, on connections to 127.0.0.1
+ * 			Output: Copynumber output for each job; its messages, status and timing to the client
+ *
+ * index [pileup file] OPTIONS
+ * 			Write a sidecar byte-offset index of a sorted pileup for region seeks
+ * 			Input:	Plain or BGZF-compressed pileup or mpileup file
+ * 			Output: Index of chromosome and position offsets (pileup.idx)
+ *
+ * query [copynumber.gz] [regions] OPTIONS
+ * 			Print the copynumber segments overlapping regions, using the tabix index of BGZF output
+ * 			Input:	VarScan copynumber output written with --output-bgzf (varscan.output.copynumber.gz and .tbi)
+ * 			Output: Segments overlapping each region, on standard output
+ *
+ * view [copynumber.bin] OPTIONS
+ * 			Convert a binary columnar copynumber table back to text
+ * 			Input:	VarScan copynumber output written with --output-binary (varscan.output.copynumber.bin)
+ * 			Output: The copynumber table as text, on standard output
+ *
  * copyCaller [copynumber file] OPTIONS
  * 			Process VarScan copynumber output to adjust for GC and make preliminary calls
  * 			Input:	VarScan copynumber output (varscan.output.copynumber)
@@ -125,11 +161,40 @@ public class VarScan {
 			}
 
 		}
+
+		// Where messages and statistics go, and the caches shared by the samples of a batch //
+		private final PrintStream log;
+		private final SharedCaches caches;
+
+		// Outcome of the run, for the copynumber-batch summary //
+		private int exitStatus = 0;
+		private long sharedPositions = 0;
+		private long comparedPositions = 0;
+		private long rawSegments = 0;
+		private long goodSegments = 0;
+
 		////////////////////////////////////////////////////////////////////////////////////////////////////
 		// Constructor with two arguments (string[], boolean) expects mpileup input 					  //
 		////////////////////////////////////////////////////////////////////////////////////////////////////
 		public Copynumber(String[] args, boolean isMpileup)
 		{
+			this(args, isMpileup, System.err, null);
+		}
+
+		/**
+		 * Runs copynumber on an mpileup as one sample of a batch, when caches are given. A batch sample
+		 * reports errors through getExitStatus() rather than exiting the JVM.
+		 *
+		 * @param	args		Command-line arguments
+		 * @param	isMpileup	Expect mpileup input
+		 * @param	log			Stream for messages and statistics
+		 * @param	caches		Change-point caches shared by a batch, or null for a single run
+		 */
+		public Copynumber(String[] args, boolean isMpileup, PrintStream log, SharedCaches caches)
+		{
+			this.log = log;
+			this.caches = caches;
+
 			String usage = "USAGE: java -jar VarScan.jar copynumber [normal-tumor.mpileup] [Opt: output] OPTIONS\n" +
 					"\tnormal-tumor.mpileup - The SAMtools mpileup file for Normal and Tumor\n" +
 					"\toutput - Output base name for files\n" +
@@ -140,11 +205,25 @@ public class VarScan {
 					"\t--min-segment-size - Minimum number of consecutive bases to report a segment [10]\n" +
 					"\t--max-segment-size - Max size before a new segment is made [100]\n" +
 					"\t--p-value - P-value threshold for significant copynumber change-point [0.01]\n" +
-					"\t--data-ratio - The normal/tumor input data ratio for copynumber adjustment [1.0]\n";
+					"\t--data-ratio - The normal/tumor input data ratio for copynumber adjustment [1.0]\n" +
+					"\t--pvalue-cache-size - Max number of change-point p-values to cache, 0 to disable [100000]\n" +
+					"\t--critical-cache-size - Max number of critical tumor-depth bounds to cache, 0 to disable [100000]\n" +
+					"\t--fisher-approx-above - Approximate change-point p-values for tables with more reads than this and at least 10 expected in every cell, 0 for always exact [0]\n" +
+					"\t--read-buffer-size - Size in bytes of the input read buffer [1048576]\n" +
+					"\t--write-buffer-size - Size in bytes of the output write buffer [1048576]\n" +
+					"\t--write-queue-size - Segments to queue for a background writer thread, 0 to write inline [0]\n" +
+					"\t--output-bgzf - If set to 1, write output.copynumber.gz as BGZF with a tabix index, for the query command [0]\n" +
+					"\t--compress-threads - Threads for compressing BGZF output [number of CPUs]\n" +
+					"\t--output-binary - If set to 1, write output.copynumber.bin as a binary columnar table, for the view command [0]\n" +
+					"\t--decompress-threads - Threads for decompressing BGZF input [number of CPUs]\n" +
+					"\t--input-timeout - Seconds to wait for the first input before giving up, 0 to wait forever [500]\n" +
+					"\t--threads - Threads for segmenting the input in chunks, with output in input order [1]\n" +
+					"\t--region - Only use positions in this region, as chrom:start-end [all]\n" +
+					"\t--regions-file - Only use positions in the regions of this file, as tab-delimited chrom, start, stop [all]\n";
 
 			if(args.length < 2)
 			{
-				System.err.println(usage);
+				log.println(usage);
 				return;
 			}
 
@@ -170,7 +249,18 @@ public class VarScan {
 			int maxSegmentSize = 100;
 			double dataRatio = 1.00;
 			double pValueThreshold = 0.01;
-			long numBases = 0;
+			int pValueCacheSize = 100000;
+			int criticalCacheSize = 100000;
+			int fisherApproxAbove = 0;
+			int readBufferSize = ByteLineReader.DEFAULT_BUFFER_SIZE;
+			int writeBufferSize = SegmentWriter.DEFAULT_BUFFER_SIZE;
+			int writeQueueSize = 0;
+			int bgzfThreads = 0;
+			boolean binaryOutput = false;
+			int inputTimeout = 500;
+			int decompressThreads = Runtime.getRuntime().availableProcessors();
+			RegionSet regions = null;
+			int numThreads = 1;
 
 			// Try adjusting any provided parameters based on user inut //
 			try
@@ -195,22 +285,73 @@ public class VarScan {
 				if(params.containsKey("data-ratio"))
 					dataRatio = Double.parseDouble(params.get("data-ratio"));
 
-				System.err.println("Min coverage:\t" + minCoverage);
-				System.err.println("Min avg qual:\t" + minBaseQual);
-				System.err.println("P-value thresh:\t" + pValueThreshold);
+				if(params.containsKey("pvalue-cache-size"))
+					pValueCacheSize = Integer.parseInt(params.get("pvalue-cache-size"));
+
+				if(params.containsKey("critical-cache-size"))
+					criticalCacheSize = Integer.parseInt(params.get("critical-cache-size"));
+
+				if(params.containsKey("fisher-approx-above"))
+					fisherApproxAbove = Integer.parseInt(params.get("fisher-approx-above"));
+
+				if(params.containsKey("read-buffer-size"))
+					readBufferSize = Integer.parseInt(params.get("read-buffer-size"));
+
+				if(params.containsKey("write-buffer-size"))
+					writeBufferSize = Integer.parseInt(params.get("write-buffer-size"));
+
+				if(params.containsKey("write-queue-size"))
+					writeQueueSize = Integer.parseInt(params.get("write-queue-size"));
+
+				if(params.containsKey("output-bgzf") && Integer.parseInt(params.get("output-bgzf")) == 1)
+				{
+					bgzfThreads = Runtime.getRuntime().availableProcessors();
+					if(params.containsKey("compress-threads"))
+						bgzfThreads = Math.max(Integer.parseInt(params.get("compress-threads")), 1);
+				}
+
+				if(params.containsKey("output-binary") && Integer.parseInt(params.get("output-binary")) == 1)
+				{
+					if(bgzfThreads > 0)
+						throw new IllegalArgumentException("--output-bgzf and --output-binary cannot be used together");
+					binaryOutput = true;
+				}
+
+				if(params.containsKey("input-timeout"))
+					inputTimeout = Integer.parseInt(params.get("input-timeout"));
+
+				if(params.containsKey("decompress-threads"))
+					decompressThreads = Integer.parseInt(params.get("decompress-threads"));
+
+				if(params.containsKey("threads"))
+					numThreads = Integer.parseInt(params.get("threads"));
+
+				if(params.containsKey("region") || params.containsKey("regions-file"))
+				{
+					regions = new RegionSet();
+					if(params.containsKey("region"))
+						regions.add(params.get("region"));
+					if(params.containsKey("regions-file"))
+						regions.addFile(params.get("regions-file"));
+				}
+
+				log.println("Min coverage:\t" + minCoverage);
+				log.println("Min avg qual:\t" + minBaseQual);
+				log.println("P-value thresh:\t" + pValueThreshold);
 
 			}
 			catch(Exception e)
 			{
-				System.err.println("Input Parameter Threw Exception: " + e.getLocalizedMessage());
-				e.printStackTrace(System.err);
-				System.exit(1);
+				log.println("Input Parameter Threw Exception: " + e.getLocalizedMessage());
+				e.printStackTrace(log);
+				exit(1);
+				return;
 			}
 
 			// Print usage if -h or --help invoked //
 			if(params.containsKey("help") || params.containsKey("h"))
 			{
-				System.err.println(usage);
+				log.println(usage);
 				return;
 			}
 
@@ -218,9 +359,10 @@ public class VarScan {
 
 			if(args.length < 3)
 			{
-				System.err.println("Please provide an output file basename!");
-				System.err.println(usage);
-				System.exit(1);
+				log.println("Please provide an output file basename!");
+				log.println(usage);
+				exit(1);
+				return;
 			}
 
 
@@ -230,8 +372,18 @@ public class VarScan {
 			{
 				// Declare file-parsing variables //
 
-				BufferedReader in = VarScan.getInfile(args);
-				String line;
+				long inputStartTime = System.nanoTime();
+				ByteLineReader in = null;
+				try
+				{
+					in = VarScan.getByteInfile(args, readBufferSize, decompressThreads, log);
+				}
+				catch(IOException e)
+				{
+					log.println("ERROR: Unable to open input stream\n");
+					exit(10);
+					return;
+				}
 
 				// If no input, print usage //
 
@@ -241,26 +393,19 @@ public class VarScan {
 					return;
 				}
 
-				// If input file not ready, give it a few seconds //
-				int numNaps = 0;
+				// Restrict to the requested regions, seeking with an index if the file has one //
 
-				while(!in.ready())
-				{
-					try {
-						Thread.sleep(5000);
-						numNaps++;
+				if(regions != null)
+					RegionFilter.apply(in, VarScan.getInfileName(args), regions, decompressThreads, log);
 
-						if(numNaps > 100)
-						{
-							System.err.println("Input file was not ready after 100 5-second cycles!");
-							System.exit(10);
-						}
-					}
-					catch(Exception e)
-					{
-						System.err.println("Exception while trying to get input" + e.getMessage());
-						System.exit(1);
-					}
+				// Block until the first input arrives, so processing starts on the first byte //
+
+				if(!in.awaitInput(inputTimeout * 1000L))
+				{
+					log.println("Input file was not ready after " + inputTimeout + " seconds!");
+					in.close();
+					exit(10);
+					return;
 				}
 
 				// Proceed if input stream is ready //
@@ -268,289 +413,104 @@ public class VarScan {
 				if(in != null && in.ready())
 				{
 					// Declare output file //
-					PrintStream outCopySegments = null; // declare a print stream object for copynumber segments
+					String segmentFile = outputName + ((bgzfThreads > 0) ? ".copynumber.gz" : ".copynumber");
+					SegmentWriter outCopySegments = null; // declare a writer for copynumber segments
 
-					outCopySegments = new PrintStream( new FileOutputStream(outputName + ".copynumber") );
-					outCopySegments.println("chrom\tchr_start\tchr_stop\tnum_positions\tnormal_depth\ttumor_depth\tlog2_ratio\tgc_content");
-
-
-					System.err.println("Reading mpileup input...");
-					int numParsingExceptions = 0;
-
-					// Statistics counters //
-					long sharedPositions = 0;
-					long comparedPositions = 0;
-					long rawCopySegments = 0;
-					long goodCopySegments = 0;
+					if(binaryOutput)
+					{
+						segmentFile = outputName + ".copynumber" + SegmentTable.EXTENSION;
+						outCopySegments = SegmentWriter.openTable(segmentFile, writeBufferSize, writeQueueSize);
+					}
+					else
+						outCopySegments = SegmentWriter.open(segmentFile, writeBufferSize, writeQueueSize, bgzfThreads, log);
+					outCopySegments.println(SegmentWriter.HEADER);
 
-					// Set some default parsing variables //
-					String chromNormal = "";
-					String chromTumor = "";
-					String refBase = "";
-					int posNormal = 0;
-					int posTumor = 0;
 
-					// Parameters for copy number calling //
-					String copyChrom = "";
-					int copyStart = 0;
-					int copyStop = 0;
-					int copyDepthNormal = 0;
-					int copyDepthTumor = 0;
-					long copySumNormal = 0;
-					long copySumTumor = 0;
-					long copyPositions = 0;
-					long copyPositionsGC = 0;
+					log.println("Reading mpileup input...");
 
-					DecimalFormat oneDigit = new DecimalFormat("#0.0");
-					DecimalFormat threeDigits = new DecimalFormat("#0.000");
+					// Cache of change-point p-values, since depth tables recur around a segment mean //
+					CriticalDepthCache criticalDepths = getCriticalDepths(pValueThreshold, pValueCacheSize, criticalCacheSize, fisherApproxAbove);
+					PValueCache pValueCache = criticalDepths.getPValueCache();
 
-					// Parse the infile line by line //
+					// Segmentation state and counters; with --threads, each chunk of the input gets its own //
+					MpileupSegmenter segmenter = new MpileupSegmenter(minCoverage, minBaseQual, minSegmentSize, maxSegmentSize, dataRatio, params.containsKey("verbose"), criticalDepths, outCopySegments, log);
+					ChunkedSegmenter chunks = null;
 
-					while ((line = in.readLine()) != null)
+					if(numThreads > 1)
 					{
-						numBases++;
-
-						// Begin try-catch for line parsing //
-
-						try
+						chunks = new ChunkedSegmenter(segmenter, numThreads);
+						if(!chunks.segment(in))
 						{
-							String[] lineContents = line.split("\t");
-
-							// Verify expected pileup format //
+							in.close();
+							outCopySegments.close();
+							exitStatus = 10;
+							return;
+						}
+					}
+					else
+					{
+						// Parse the infile line by line //
 
-//	    				if(lineContents.length > 5 && lineContents[0].length() > 0 && lineContents[1].length() > 0 && lineContents[2].length() > 0 && lineContents[3].length() > 0)
-							if(lineContents.length < 8)
-							{
-								// This is an incomplete mpileup line, so skip it. If verbose, throw a warning //
-								if(params.containsKey("verbose"))
-								{
-									System.err.println("Incomplete mpileup at line " + numBases + "; line being skipped.");
-								}
-							}
-							else
+						while (in.next())
+						{
+							try
 							{
-								sharedPositions++;
-
-								// Parse common fields from line //
-								String refName = lineContents[0];
-								int position = Integer.parseInt(lineContents[1]);
-								refBase = lineContents[2].toUpperCase();
-
-								chromNormal = refName;
-								chromTumor = refName;
-								posNormal = position;
-								posTumor = position;
-
-								// Parse normal, which should be first sample //
-								int normalOffset = 3;
-								int pileupDepthNormal = 0;
-								String normalQualities = "";
-								if(lineContents.length >= (normalOffset + 1))
-								{
-									pileupDepthNormal = Integer.parseInt(lineContents[normalOffset]);
-									//String normalBases = lineContents[normalOffset + 1];
-									normalQualities = lineContents[normalOffset + 2];
-								}
-
-								// Parse tumor, which should be second sample //
-								int tumorOffset = 6;
-								int pileupDepthTumor = 0;
-								String tumorQualities = "";
-								if(lineContents.length >= (tumorOffset + 2 + 1))
-								{
-									pileupDepthTumor = Integer.parseInt(lineContents[tumorOffset]);
-									//String tumorBases = lineContents[tumorOffset + 1];
-									tumorQualities = lineContents[tumorOffset + 2];
-								}
-
-
-								// If either sample met the minimum coverage and both had at least one read //
-
-//		    	        	if((pileupDepthNormal >= minCoverage || pileupDepthTumor >= minCoverage) && normalQualities.length() > 0)// && tumorQualities.length() > 0)
-
-								// We want the normal sample to meet the minimum coverage because that's the comparator //
-								if(pileupDepthNormal >= minCoverage && normalQualities.length() > 0)// && tumorQualities.length() > 0)
-								{
-									comparedPositions++;
-									// Get the depth of bases above minimum quality //
-
-									int normalDepth = VarScan.qualityDepth(normalQualities, minBaseQual);
-									int tumorDepth = 0;
-									if(tumorQualities.length() > 0)
-										tumorDepth = VarScan.qualityDepth(tumorQualities, minBaseQual);
-
-									// Determine if we have a copy changepoint //
-									// If this base is not contiguous with the copyRegion
-									// If the normal or tumor depth changes //
-
-									int diffNormal = Math.abs(copyDepthNormal - normalDepth);
-									int diffTumor = Math.abs(copyDepthTumor - tumorDepth);
-									int posDiff = posTumor - copyStop;
-
-									// DETERMINE IF WE CONTINUE THIS REGION OR PROCESS IT AND START A NEW ONE //
-
-									boolean continueFlag = false;
-
-									// If chromosomes differ or contiguity broken, process the region //
-
-									if(posDiff > 2 || !(copyChrom.equals(chromTumor)))
-									{
-										continueFlag = false;
-									}
-									else
-									{
-										if(copyPositions >= maxSegmentSize)
-										{
-											continueFlag = false;
-										}
-										else if(diffNormal <= 2 && diffTumor <= 2)
-										{
-											continueFlag = true;
-										}
-										else
-										{
-											// Do a Fisher's exact test on the copy number changes. ##
-
-											double changePvalue = VarScan.getSignificance(copyDepthNormal, copyDepthTumor, normalDepth, tumorDepth);
-
-											// If depth change not significant, continue with region //
-											if(changePvalue >= pValueThreshold)
-											{
-												continueFlag = true;
-											}
-											else
-											{
-												continueFlag = false;
-											}
-
-										}
-									}
-
-
-									// If continuing, extend this region and don't process yet //
-
-									if(continueFlag)
-									{
-										copySumNormal += normalDepth;
-										copySumTumor += tumorDepth;
-										copyPositions++;
-										if(refBase.equals("G") || refBase.equals("C") || refBase.equals("g") || refBase.equals("c"))
-											copyPositionsGC++;
-										copyStop = posTumor;
-									}
-
-									// Otherwise, process this region (if it qualifies) and start a new one //
-
-									else
-									{
-										if(copyPositions >= minSegmentSize)
-										{
-											rawCopySegments++;
-											String regionResults = processCopyRegion(copyChrom, copyStart, copyStop, copyPositions, copyPositionsGC, copySumNormal, copySumTumor, minCoverage, dataRatio);
-
-											if(regionResults.length() > 0)
-											{
-												outCopySegments.println(regionResults);
-												goodCopySegments++;
-											}
-										}
-
-										// Start a new copyNumber region //
-										copyChrom = chromTumor;
-										copyStart = posTumor;
-										copyStop = posTumor;
-										copyDepthNormal = normalDepth;
-										copyDepthTumor = tumorDepth;
-										copySumNormal = normalDepth;
-										copySumTumor = tumorDepth;
-										copyPositions = 1;
-										if(refBase.equals("G") || refBase.equals("C") || refBase.equals("g") || refBase.equals("c"))
-											copyPositionsGC = 1;
-										else
-											copyPositionsGC = 0;
-									}
-
-
-								}
-								else
-								{
-									// If minimum coverage was not met, print region //
-									// If we had a copyNumber region that met minimum coverage, report it //
-									if(copyPositions >= minSegmentSize)
-									{
-										rawCopySegments++;
-										String regionResults = processCopyRegion(copyChrom, copyStart, copyStop, copyPositions, copyPositionsGC, copySumNormal, copySumTumor, minCoverage, dataRatio);
-
-										if(regionResults.length() > 0)
-										{
-											outCopySegments.println(regionResults);
-											goodCopySegments++;
-										}
-									}
-
-									// Reset the copyNumber region //
-									copyChrom = "";
-									copyStart = 0;
-									copyStop = 0;
-									copyDepthNormal = 0;
-									copyDepthTumor = 0;
-									copySumNormal = 0;
-									copySumTumor = 0;
-									copyPositions = 0;
-									copyPositionsGC = 0;
-								}
-
+								segmenter.processLine(in.buffer(), in.lineStart(), in.lineEnd());
 							}
-
-						}
-						catch(Exception e)
-						{
-							System.err.println("Parsing Exception on line:\n" + line + "\n" + e.getLocalizedMessage());
-							numParsingExceptions++;
-							if(numParsingExceptions >= 5)
+							catch(Exception e)
 							{
-								System.err.println("Too many parsing exceptions encountered; exiting");
+								segmenter.fail(in.lineString(), e);
+								in.close();
+								outCopySegments.close();
+								exitStatus = 10;
 								return;
 							}
-							return;
 						}
 
-
+						// Last region: If minimum coverage was not met, print region //
+						segmenter.finishSegment(true);
 					}
 
-					// Last region: If minimum coverage was not met, print region //
-					// If we had a copyNumber region that met minimum coverage, report it //
-					if(copyPositions > minSegmentSize)
+					in.close();
+					outCopySegments.close();
+					if(outCopySegments.checkError())
 					{
-						rawCopySegments++;
-						String regionResults = processCopyRegion(copyChrom, copyStart, copyStop, copyPositions, copyPositionsGC, copySumNormal, copySumTumor, minCoverage, dataRatio);
-
-						if(regionResults.length() > 0)
-						{
-							outCopySegments.println(regionResults);
-							goodCopySegments++;
-						}
+						log.println("ERROR: Failed to write " + segmentFile);
+						exit(11);
+						return;
 					}
 
-					in.close();
-
-					System.err.println(sharedPositions + " positions in mpileup"); //stats.get("sharedPositions")
-					System.err.println(comparedPositions + " had sufficient coverage for comparison"); //stats.get("comparedPositions")
-					System.err.println(rawCopySegments + " raw copynumber segments with size > " + minSegmentSize);
-					System.err.println(goodCopySegments + " good copynumber segments with depth > " + minCoverage);
-
+					log.println(segmenter.getSharedPositions() + " positions in mpileup"); //stats.get("sharedPositions")
+					if(in.getLines() > 0)
+						log.println((in.getFirstLineTime() - inputStartTime) / 1000000 + " ms to first record");
+					log.println(segmenter.getComparedPositions() + " had sufficient coverage for comparison"); //stats.get("comparedPositions")
+					log.println(segmenter.getRawCopySegments() + " raw copynumber segments with size > " + minSegmentSize);
+					log.println(segmenter.getGoodCopySegments() + " good copynumber segments with depth > " + minCoverage);
+					if(chunks != null)
+						log.println(chunks.getChunks() + " input chunks segmented on " + numThreads + " threads");
+					if(writeQueueSize > 0)
+						log.println(outCopySegments.getStalls() + " of " + outCopySegments.getQueuedWrites() + " queued writes stalled on a full write queue, for " + outCopySegments.getStallMillis() + " ms");
+					if(caches == null)
+						printCacheStats(pValueCache, criticalDepths, log);
+
+					sharedPositions = segmenter.getSharedPositions();
+					comparedPositions = segmenter.getComparedPositions();
+					rawSegments = segmenter.getRawCopySegments();
+					goodSegments = segmenter.getGoodCopySegments();
 				}
 				else
 				{
-					System.err.println("Input file never ready for parsing (maybe due to file I/O)...");
-					System.exit(10);
+					log.println("Input file never ready for parsing (maybe due to file I/O)...");
+					in.close();
+					exit(10);
+					return;
 				}
 			}
 			catch (IOException e)
 			{
-				System.err.println("File Parsing Exception: " + e.getLocalizedMessage());
-				e.printStackTrace(System.err);
-				System.exit(11);
+				log.println("File Parsing Exception: " + e.getLocalizedMessage());
+				e.printStackTrace(log);
+				exit(11);
 			}
 
 
@@ -565,6 +525,22 @@ public class VarScan {
 
 		public Copynumber(String[] args)
 		{
+			this(args, System.err, null);
+		}
+
+		/**
+		 * Runs copynumber on normal and tumor pileups as one sample of a batch, when caches are given.
+		 * A batch sample reports errors through getExitStatus() rather than exiting the JVM.
+		 *
+		 * @param	args		Command-line arguments
+		 * @param	log			Stream for messages and statistics
+		 * @param	caches		Change-point caches shared by a batch, or null for a single run
+		 */
+		public Copynumber(String[] args, PrintStream log, SharedCaches caches)
+		{
+			this.log = log;
+			this.caches = caches;
+
 			String usage = "USAGE: VarScan copynumber [normal_pileup] [tumor_pileup] [Opt: output] OPTIONS\n" +
 					"\tnormal_pileup - The SAMtools pileup file for Normal\n" +
 					"\ttumor_pileup - The SAMtools pileup file for Tumor\n" +
@@ -577,11 +553,26 @@ public class VarScan {
 					"\t--min-segment-size - Minimum number of consecutive bases to report a segment [10]\n" +
 					"\t--max-segment-size - Max size before a new segment is made [100]\n" +
 					"\t--p-value - P-value threshold for significant copynumber change-point [0.01]\n" +
-					"\t--data-ratio - The normal/tumor input data ratio for copynumber adjustment [1.0]\n";
+					"\t--data-ratio - The normal/tumor input data ratio for copynumber adjustment [1.0]\n" +
+					"\t--pvalue-cache-size - Max number of change-point p-values to cache, 0 to disable [100000]\n" +
+					"\t--critical-cache-size - Max number of critical tumor-depth bounds to cache, 0 to disable [100000]\n" +
+					"\t--fisher-approx-above - Approximate change-point p-values for tables with more reads than this and at least 10 expected in every cell, 0 for always exact [0]\n" +
+					"\t--read-buffer-size - Size in bytes of the input read buffer [1048576]\n" +
+					"\t--write-buffer-size - Size in bytes of the output write buffer [1048576]\n" +
+					"\t--write-queue-size - Segments to queue for a background writer thread, 0 to write inline [0]\n" +
+					"\t--output-bgzf - If set to 1, write output.copynumber.gz as BGZF with a tabix index, for the query command [0]\n" +
+					"\t--compress-threads - Threads for compressing BGZF output [number of CPUs]\n" +
+					"\t--output-binary - If set to 1, write output.copynumber.bin as a binary columnar table, for the view command [0]\n" +
+					"\t--decompress-threads - Threads for decompressing BGZF input [number of CPUs]\n" +
+					"\t--input-timeout - Seconds to wait for the first input before giving up, 0 to wait forever [500]\n" +
+					"\t--region - Only use positions in this region, as chrom:start-end [all]\n" +
+					"\t--regions-file - Only use positions in the regions of this file, as tab-delimited chrom, start, stop [all]\n" +
+					"\t--pipeline - If set to 1, read and parse each pileup ahead on its own thread [0]\n" +
+					"\t--chrom-order - Chromosome order of both pileups: natural, lexical, or a .fai or .dict file [natural]\n";
 
 			if(args.length < 3)
 			{
-				System.err.println(usage);
+				log.println(usage);
 				return;
 			}
 
@@ -596,9 +587,9 @@ public class VarScan {
 				outputName = args[3];
 			}
 
-			System.err.println("Normal Pileup: " + normalPileupFile);
-			System.err.println("Tumor Pileup: " + tumorPileupFile);
-			System.err.println("NOTICE: While dual input files are still supported, using a single mpileup file (normal-tumor) with the --mpileup 1 setting is strongly recommended.");
+			log.println("Normal Pileup: " + normalPileupFile);
+			log.println("Tumor Pileup: " + tumorPileupFile);
+			log.println("NOTICE: While dual input files are still supported, using a single mpileup file (normal-tumor) with the --mpileup 1 setting is strongly recommended.");
 
 			//	Set parameter defaults //
 
@@ -608,6 +599,19 @@ public class VarScan {
 			int maxSegmentSize = 100;
 			double dataRatio = 1.00;
 			double pValueThreshold = 0.01;
+			int pValueCacheSize = 100000;
+			int criticalCacheSize = 100000;
+			int fisherApproxAbove = 0;
+			int readBufferSize = ByteLineReader.DEFAULT_BUFFER_SIZE;
+			int writeBufferSize = SegmentWriter.DEFAULT_BUFFER_SIZE;
+			int writeQueueSize = 0;
+			int bgzfThreads = 0;
+			boolean binaryOutput = false;
+			int inputTimeout = 500;
+			int decompressThreads = Runtime.getRuntime().availableProcessors();
+			RegionSet regions = null;
+			boolean pipeline = false;
+			ChromosomeRegistry chroms = null;
 
 			// Parse command-line parameters //
 			HashMap<String, String> params = VarScan.getParams(args);
@@ -635,22 +639,76 @@ public class VarScan {
 				if(params.containsKey("data-ratio"))
 					dataRatio = Double.parseDouble(params.get("data-ratio"));
 
-				System.err.println("Min coverage:\t" + minCoverage);
-				System.err.println("Min avg qual:\t" + minBaseQual);
-				System.err.println("P-value thresh:\t" + pValueThreshold);
+				if(params.containsKey("pvalue-cache-size"))
+					pValueCacheSize = Integer.parseInt(params.get("pvalue-cache-size"));
+
+				if(params.containsKey("critical-cache-size"))
+					criticalCacheSize = Integer.parseInt(params.get("critical-cache-size"));
+
+				if(params.containsKey("fisher-approx-above"))
+					fisherApproxAbove = Integer.parseInt(params.get("fisher-approx-above"));
+
+				if(params.containsKey("read-buffer-size"))
+					readBufferSize = Integer.parseInt(params.get("read-buffer-size"));
+
+				if(params.containsKey("write-buffer-size"))
+					writeBufferSize = Integer.parseInt(params.get("write-buffer-size"));
+
+				if(params.containsKey("write-queue-size"))
+					writeQueueSize = Integer.parseInt(params.get("write-queue-size"));
+
+				if(params.containsKey("output-bgzf") && Integer.parseInt(params.get("output-bgzf")) == 1)
+				{
+					bgzfThreads = Runtime.getRuntime().availableProcessors();
+					if(params.containsKey("compress-threads"))
+						bgzfThreads = Math.max(Integer.parseInt(params.get("compress-threads")), 1);
+				}
+
+				if(params.containsKey("output-binary") && Integer.parseInt(params.get("output-binary")) == 1)
+				{
+					if(bgzfThreads > 0)
+						throw new IllegalArgumentException("--output-bgzf and --output-binary cannot be used together");
+					binaryOutput = true;
+				}
+
+				if(params.containsKey("input-timeout"))
+					inputTimeout = Integer.parseInt(params.get("input-timeout"));
+
+				if(params.containsKey("decompress-threads"))
+					decompressThreads = Integer.parseInt(params.get("decompress-threads"));
+
+				if(params.containsKey("region") || params.containsKey("regions-file"))
+				{
+					regions = new RegionSet();
+					if(params.containsKey("region"))
+						regions.add(params.get("region"));
+					if(params.containsKey("regions-file"))
+						regions.addFile(params.get("regions-file"));
+				}
+
+				if(params.containsKey("pipeline"))
+					pipeline = Integer.parseInt(params.get("pipeline")) == 1;
+
+				// Chromosome sort order shared by both pileups //
+				chroms = ChromosomeRegistry.forOrder(params.get("chrom-order"));
+
+				log.println("Min coverage:\t" + minCoverage);
+				log.println("Min avg qual:\t" + minBaseQual);
+				log.println("P-value thresh:\t" + pValueThreshold);
 
 			}
 			catch(Exception e)
 			{
-				System.err.println("Input Parameter Threw Exception: " + e.getLocalizedMessage());
-				e.printStackTrace(System.err);
-				System.exit(1);
+				log.println("Input Parameter Threw Exception: " + e.getLocalizedMessage());
+				e.printStackTrace(log);
+				exit(1);
+				return;
 			}
 
 			// Print usage if -h or --help invoked //
 			if(params.containsKey("help") || params.containsKey("h"))
 			{
-				System.err.println(usage);
+				log.println(usage);
 				return;
 			}
 
@@ -658,111 +716,118 @@ public class VarScan {
 
 			if(args.length < 3)
 			{
-				System.err.println("Please provide an output file basename!");
-				System.err.println(usage);
-				System.exit(1);
+				log.println("Please provide an output file basename!");
+				log.println(usage);
+				exit(1);
+				return;
 			}
 
 
 			// Statistics counters //
 			long tumorPositions = 0;
 			long sharedPositions = 0;
-			long comparedPositions = 0;
-			long rawCopySegments = 0;
-			long goodCopySegments = 0;
+
+			// Cache of change-point p-values, since depth tables recur around a segment mean //
+			CriticalDepthCache criticalDepths = getCriticalDepths(pValueThreshold, pValueCacheSize, criticalCacheSize, fisherApproxAbove);
+			PValueCache pValueCache = criticalDepths.getPValueCache();
 
 			try
 			{
 				// Declare output file //
-				PrintStream outCopySegments = null; // declare a print stream object for copynumber segments
+				String segmentFile = outputName + ((bgzfThreads > 0) ? ".copynumber.gz" : ".copynumber");
+				SegmentWriter outCopySegments = null; // declare a writer for copynumber segments
 
-				outCopySegments = new PrintStream( new FileOutputStream(outputName + ".copynumber") );
-				outCopySegments.println("chrom\tchr_start\tchr_stop\tnum_positions\tnormal_depth\ttumor_depth\tlog2_ratio\tgc_content");
+				if(binaryOutput)
+				{
+					segmentFile = outputName + ".copynumber" + SegmentTable.EXTENSION;
+					outCopySegments = SegmentWriter.openTable(segmentFile, writeBufferSize, writeQueueSize);
+				}
+				else
+					outCopySegments = SegmentWriter.open(segmentFile, writeBufferSize, writeQueueSize, bgzfThreads, log);
+				outCopySegments.println(SegmentWriter.HEADER);
 
 				// Prepare file readers for normal and tumor pileups //
 
-				BufferedReader normal = new BufferedReader(new SmartFileReader(normalPileupFile));
-				BufferedReader tumor = new BufferedReader(new SmartFileReader(tumorPileupFile));
-
-				if(!(normal.ready() && tumor.ready()))
-				{
-					// Delay a few seconds to let SAMtools pileup start outputting //
-					try {
-						Thread.sleep(5000);
-
-						if(!(normal.ready() && tumor.ready()))
-							Thread.sleep(5000);
+				long inputStartTime = System.nanoTime();
+				ByteLineReader normal = ByteLineReader.open(normalPileupFile, readBufferSize, decompressThreads);
+				ByteLineReader tumor = ByteLineReader.open(tumorPileupFile, readBufferSize, decompressThreads);
 
-						if(!(normal.ready() && tumor.ready()))
-							Thread.sleep(5000);
+				// Restrict to the requested regions, seeking with an index if a file has one //
 
-						if(!(normal.ready() && tumor.ready()))
-							Thread.sleep(5000);
-					}
-					catch(Exception e)
-					{
+				if(regions != null)
+				{
+					RegionFilter.apply(normal, normalPileupFile, regions, decompressThreads, log);
+					RegionFilter.apply(tumor, tumorPileupFile, regions, decompressThreads, log);
+				}
+				else
+				{
+					// Learn where each normal chromosome starts, so that resetting the normal can seek there //
+					PileupIndex normalIndex = PileupIndex.load(normalPileupFile, log);
+					if(normalIndex != null)
+						normal.setChromosomeOffsets(normalIndex);
+					else
+						normal.recordChromosomeOffsets();
+				}
 
-					}
+				// Block until SAMtools pileup starts outputting to both, sharing one deadline //
 
-				}
+				long waitStart = System.currentTimeMillis();
+				boolean normalReady = normal.awaitInput(inputTimeout * 1000L);
+				long waitLeft = (inputTimeout == 0) ? 0 : Math.max(1, inputTimeout * 1000L - (System.currentTimeMillis() - waitStart));
+				boolean tumorReady = normalReady && tumor.awaitInput(waitLeft);
 
 				// Exit if files not ready after waiting //
 
-				if(!(normal.ready() && tumor.ready()))
+				if(!(normalReady && tumorReady && normal.ready() && tumor.ready()))
 				{
-					System.err.println("ERROR: Invalid input file(s)");
-					System.exit(10);
+					log.println("ERROR: Invalid input file(s)");
+					normal.close();
+					tumor.close();
+					outCopySegments.close();
+					exit(10);
+					return;
 				}
 
-				String lineNormal;
-				String lineTumor;
-				String chromNormal = "";
-				String chromTumor = "";
-				String prevChromNormal = "";
-				String prevChromTumor = "";
-				String refBase = "";
+				PileupRecord recNormal;
+				PileupRecord recTumor;
+				int blankChrom = chroms.id("");
+				int chromNormal = blankChrom;
+				int chromTumor = blankChrom;
+				int prevChromNormal = blankChrom;
+				int prevChromTumor = blankChrom;
+				boolean refGC = false;
 				int posNormal = 0;
 				int posTumor = 0;
 
-				// Parameters for copy number calling //
-				String copyChrom = "";
-				int copyStart = 0;
-				int copyStop = 0;
-				int copyDepthNormal = 0;
-				int copyDepthTumor = 0;
-				long copySumNormal = 0;
-				long copySumTumor = 0;
-				long copyPositions = 0;
-				long copyPositionsGC = 0;
+				// Copy number segmentation of the shared positions //
+				CopySegmenter segmenter = new CopySegmenter(minCoverage, minSegmentSize, maxSegmentSize, dataRatio, criticalDepths, chroms, outCopySegments);
 
-				DecimalFormat oneDigit = new DecimalFormat("#0.0");
-				DecimalFormat threeDigits = new DecimalFormat("#0.000");
+				// Parse each pileup into records, on its own reader thread if pipelined //
+				PileupRecordReader normalRecords = new PileupRecordReader(normal, minBaseQual, chroms, pipeline, "normal-pileup");
+				PileupRecordReader tumorRecords = new PileupRecordReader(tumor, minBaseQual, chroms, pipeline, "tumor-pileup");
 
 				try {
 					// Get first line of Normal //
 
-					if((lineNormal = normal.readLine()) != null)
+					if((recNormal = normalRecords.next()) != null)
 					{
-						String[] normalContents = lineNormal.split("\t");
-
-						if(normalContents.length > 1)
+						if(recNormal.getChromId() >= 0)
 						{
-							chromNormal = normalContents[0];
-							posNormal = Integer.parseInt(normalContents[1]);
+							chromNormal = recNormal.getChromId();
+							posNormal = recNormal.getPosition();
 						}
 					}
 
 					// Loop through lines in tumor //
 
-					while ((lineTumor = tumor.readLine()) != null)
+					while ((recTumor = tumorRecords.next()) != null)
 					{
 						tumorPositions++;
-						String[] tumorContents = lineTumor.split("\t");
 
-						if(tumorContents.length > 1)
+						if(recTumor.getChromId() >= 0)
 						{
-							chromTumor = tumorContents[0];
-							posTumor = Integer.parseInt(tumorContents[1]);
+							chromTumor = recTumor.getChromId();
+							posTumor = recTumor.getPosition();
 						}
 
 						// Parse normal lines until we get the same chromosome //
@@ -770,18 +835,16 @@ public class VarScan {
 						boolean normalWasReset = false;
 
 						//	Advance in normal file if tumor is changed but normal is not, or if tumor is higher //
-						while(!chromNormal.equals(chromTumor) && !chromTumor.equals(prevChromTumor) && !flagEOF && (chromNormal.equals(prevChromTumor) || inSortOrder(chromNormal, chromTumor)))
+						while(chromNormal != chromTumor && chromTumor != prevChromTumor && !flagEOF && (chromNormal == prevChromTumor || chroms.inOrder(chromNormal, chromTumor)))
 						{
 							//System.err.println("Normal (" + chromNormal + ") catching up to " + chromTumor);
 							// Get next line from normal pileup //
-							if((lineNormal = normal.readLine()) != null)
+							if((recNormal = normalRecords.next()) != null)
 							{
-								String[] normalContents = lineNormal.split("\t");
-
-								if(normalContents.length > 1)
+								if(recNormal.getChromId() >= 0)
 								{
-									chromNormal = normalContents[0];
-									posNormal = Integer.parseInt(normalContents[1]);
+									chromNormal = recNormal.getChromId();
+									posNormal = recNormal.getPosition();
 								}
 							}
 							else
@@ -793,238 +856,57 @@ public class VarScan {
 						}
 
 						// If chromosomes match and are non-blank, attempt to get matching positions //
-						if(chromNormal.equals(chromTumor) && !chromNormal.equals(""))
+						if(chromNormal == chromTumor && chromNormal != blankChrom)
 						{
 							normalWasReset = false;
 							// Seek to matching Normal Position //
 
-							while(chromNormal.equals(chromTumor) && posNormal < posTumor && ((lineNormal = normal.readLine()) != null))
+							while(chromNormal == chromTumor && posNormal < posTumor && ((recNormal = normalRecords.next()) != null))
 							{
-								String[] normalContents = lineNormal.split("\t");
-								if(normalContents.length > 1)
+								if(recNormal.getChromId() >= 0)
 								{
-									chromNormal = normalContents[0];
-									posNormal = Integer.parseInt(normalContents[1]);
-
-									// If still less than tumor position, look for homozygous del //
-									if(posNormal < posTumor)
-									{
-										int pileupDepthNormal = 0;
-										String normalQualities = "";
-
-										try
-										{
-											// Pileup Files have 6-7 columns //
-											if(normalContents.length <= 7)
-											{
-												pileupDepthNormal = Integer.parseInt(normalContents[3]);
-												normalQualities = normalContents[5];
-											}
-											// Pileup lines in CNS files have 10-11 columns
-											else if (normalContents.length >= 10 && normalContents.length <= 11)
-											{
-												pileupDepthNormal = Integer.parseInt(normalContents[7]);
-												normalQualities = normalContents[9];
-											}
-										}
-										catch(Exception e)
-										{
-
-										}
-
-									}
-									else
-									{
-
-									}
+									chromNormal = recNormal.getChromId();
+									posNormal = recNormal.getPosition();
 								}
 							}
 
 							// Seek to matching Tumor Position //
 
-							while(chromNormal.equals(chromTumor) && posTumor < posNormal && ((lineTumor = tumor.readLine()) != null))
+							while(chromNormal == chromTumor && posTumor < posNormal && ((recTumor = tumorRecords.next()) != null))
 							{
-								tumorContents = lineTumor.split("\t");
-								if(tumorContents.length > 1)
+								if(recTumor.getChromId() >= 0)
 								{
-									chromTumor = tumorContents[0];
-									posTumor = Integer.parseInt(tumorContents[1]);
+									chromTumor = recTumor.getChromId();
+									posTumor = recTumor.getPosition();
 								}
 							}
 
 							// Proceed if normal and tumor positions match //
 
-							if(chromNormal.equals(chromTumor) && chromNormal.equals(chromTumor) && posNormal == posTumor)
+							if(chromNormal == chromTumor && posNormal == posTumor)
 							{
 								//stats.put("sharedPositions", (stats.get("sharedPositions") + 1));
 								sharedPositions++;
-								refBase = tumorContents[2];
-
-//			    			 Parse out base qualities //
-								String[] normalContents = lineNormal.split("\t");
-								int pileupDepthNormal = 0;
-								int pileupDepthTumor = 0;
-								String normalQualities = "";
-								String tumorQualities = "";
-
-								// Pileup Files have 6-7 columns //
-								if(normalContents.length >= 6 && normalContents.length <= 7)
-								{
-									pileupDepthNormal = Integer.parseInt(normalContents[3]);
-									normalQualities = normalContents[5];
-								}
-								// Pileup lines in CNS files have 10-11 columns
-								else if (normalContents.length >= 10 && normalContents.length <= 11)
-								{
-									pileupDepthNormal = Integer.parseInt(normalContents[7]);
-									normalQualities = normalContents[9];
-								}
+								refGC = recTumor.isGC();
 
-								// Pileup Files have 6-7 columns //
-								if(tumorContents.length >= 6 && tumorContents.length <= 7)
-								{
-									tumorQualities = tumorContents[5];
-									pileupDepthTumor = Integer.parseInt(tumorContents[3]);
-								}
-								// Pileup lines in CNS files have 10-11 columns
-								else if (tumorContents.length >= 10 && tumorContents.length <= 11)
-								{
-									tumorQualities = tumorContents[9];
-									pileupDepthTumor = Integer.parseInt(tumorContents[7]);
-								}
+								// Depths and base qualities were parsed with the record //
+								int pileupDepthNormal = recNormal.getDepth();
+								int pileupDepthTumor = recTumor.getDepth();
 
 								// If either sample met the minimum coverage and both had at least one read //
 
 //	    					if((pileupDepthNormal >= minCoverage || pileupDepthTumor >= minCoverage) && normalQualities.length() > 0 && tumorQualities.length() > 0)
 
 								// We want the normal sample to meet the minimum coverage because that's the comparator //
-								if(pileupDepthNormal >= minCoverage && normalQualities.length() > 0) // && tumorQualities.length() > 0)
+								if(pileupDepthNormal >= minCoverage && recNormal.getQualityCount() > 0) // && recTumor.getQualityCount() > 0)
 								{
-									comparedPositions++;
-//	    						 Get the depth of bases above minimum quality //
-
-									int normalDepth = VarScan.qualityDepth(normalQualities, minBaseQual);
-									int tumorDepth = VarScan.qualityDepth(tumorQualities, minBaseQual);
-
-									// Determine if we have a copy changepoint //
-									// If this base is not contiguous with the copyRegion
-									// If the normal or tumor depth changes //
-
-									int diffNormal = Math.abs(copyDepthNormal - normalDepth);
-									int diffTumor = Math.abs(copyDepthTumor - tumorDepth);
-									int posDiff = posTumor - copyStop;
-
-									// DETERMINE IF WE CONTINUE THIS REGION OR PROCESS IT AND START A NEW ONE //
-
-									boolean continueFlag = false;
-
-									// If chromosomes differ or contiguity broken, process the region //
-
-									if(posDiff > 2 || !(copyChrom.equals(chromTumor)))
-									{
-										continueFlag = false;
-									}
-									else
-									{
-										if(copyPositions >= maxSegmentSize)
-										{
-											continueFlag = false;
-										}
-										else if(diffNormal <= 2 && diffTumor <= 2)
-										{
-											continueFlag = true;
-										}
-										else
-										{
-											// Do a Fisher's exact test on the copy number changes. ##
-
-											double changePvalue = VarScan.getSignificance(copyDepthNormal, copyDepthTumor, normalDepth, tumorDepth);
-
-											// If depth change not significant, continue with region //
-											if(changePvalue >= pValueThreshold)
-											{
-												continueFlag = true;
-											}
-											else
-											{
-												continueFlag = false;
-											}
-
-										}
-									}
-
-
-									// If continuing, extend this region and don't process yet //
-
-									if(continueFlag)
-									{
-										copySumNormal += normalDepth;
-										copySumTumor += tumorDepth;
-										copyPositions++;
-										if(refBase.equals("G") || refBase.equals("C") || refBase.equals("g") || refBase.equals("c"))
-											copyPositionsGC++;
-										copyStop = posTumor;
-									}
-
-									// Otherwise, process this region (if it qualifies) and start a new one //
-
-									else
-									{
-										if(copyPositions >= minSegmentSize)
-										{
-											rawCopySegments++;
-											String regionResults = processCopyRegion(copyChrom, copyStart, copyStop, copyPositions, copyPositionsGC, copySumNormal, copySumTumor, minCoverage, dataRatio);
-
-											if(regionResults.length() > 0)
-											{
-												outCopySegments.println(regionResults);
-												goodCopySegments++;
-											}
-										}
-
-										// Start a new copyNumber region //
-										copyChrom = chromTumor;
-										copyStart = posTumor;
-										copyStop = posTumor;
-										copyDepthNormal = normalDepth;
-										copyDepthTumor = tumorDepth;
-										copySumNormal = normalDepth;
-										copySumTumor = tumorDepth;
-										copyPositions = 1;
-										if(refBase.equals("G") || refBase.equals("C") || refBase.equals("g") || refBase.equals("c"))
-											copyPositionsGC = 1;
-										else
-											copyPositionsGC = 0;
-									}
-
-
+									// Extend the current segment with the depths of bases above minimum quality, or start a new one //
+									segmenter.add(chromTumor, posTumor, recNormal.getQualityDepth(), recTumor.getQualityDepth(), refGC);
 								}
 								else
 								{
-									// If minimum coverage was not met, print region //
-									// If we had a copyNumber region that met minimum coverage, report it //
-									if(copyPositions >= minSegmentSize)
-									{
-										rawCopySegments++;
-										String regionResults = processCopyRegion(copyChrom, copyStart, copyStop, copyPositions, copyPositionsGC, copySumNormal, copySumTumor, minCoverage, dataRatio);
-
-										if(regionResults.length() > 0)
-										{
-											outCopySegments.println(regionResults);
-											goodCopySegments++;
-										}
-									}
-
-									// Reset the copyNumber region //
-									copyChrom = "";
-									copyStart = 0;
-									copyStop = 0;
-									copyDepthNormal = 0;
-									copyDepthTumor = 0;
-									copySumNormal = 0;
-									copySumTumor = 0;
-									copyPositions = 0;
-									copyPositionsGC = 0;
+									// If minimum coverage was not met, report any segment that met it and reset //
+									segmenter.endSegment();
 								}
 
 								// Record this chromosome //
@@ -1038,9 +920,9 @@ public class VarScan {
 							}
 						}
 						// If they're in sort order, do nothing so that tumor can catch up //
-						else if(inSortOrder(chromNormal, chromTumor))
+						else if(chroms.inOrder(chromNormal, chromTumor))
 						{
-							System.err.println("Not resetting normal file because " + chromNormal + " < " + chromTumor);
+							log.println("Not resetting normal file because " + chroms.name(chromNormal) + " < " + chroms.name(chromTumor));
 						}
 						// If we reached the end of the normal file but never saw this chromosome, //
 						// fast-forward until tumor chromosome changes and reset normal file //
@@ -1048,16 +930,14 @@ public class VarScan {
 						{
 							flagEOF = false;
 
-							while(prevChromTumor.equals(chromTumor) && !flagEOF)
+							while(prevChromTumor == chromTumor && !flagEOF)
 							{
-								if((lineTumor = tumor.readLine()) != null)
+								if((recTumor = tumorRecords.next()) != null)
 								{
-									tumorContents = lineTumor.split("\t");
-
-									if(tumorContents.length > 1)
+									if(recTumor.getChromId() >= 0)
 									{
-										chromTumor = tumorContents[0];
-										posTumor = Integer.parseInt(tumorContents[1]);
+										chromTumor = recTumor.getChromId();
+										posTumor = recTumor.getPosition();
 									}
 								}
 								else
@@ -1070,16 +950,25 @@ public class VarScan {
 
 							if(!flagEOF && !normalWasReset)
 							{
-								if(inSortOrder(chromNormal, chromTumor))
+								if(chroms.inOrder(chromNormal, chromTumor))
 								{
-									System.err.println("Not resetting normal file because " + chromNormal + " < " + chromTumor);
+									log.println("Not resetting normal file because " + chroms.name(chromNormal) + " < " + chroms.name(chromTumor));
 								}
 								else
 								{
-									System.err.println("Resetting normal file because " + chromNormal + " > " + chromTumor);
+									log.println("Resetting normal file because " + chroms.name(chromNormal) + " > " + chroms.name(chromTumor));
 									normalWasReset = true;
-									normal.close();
-									normal = new BufferedReader(new SmartFileReader(normalPileupFile));
+									normalRecords.stop();
+
+									// Seek straight to the tumor chromosome rather than rescanning, when its offset is known //
+									if(regions != null || !normal.seekChromosome(normalPileupFile, chroms.name(chromTumor), decompressThreads))
+									{
+										normal.close();
+										normal = ByteLineReader.open(normalPileupFile, readBufferSize, decompressThreads);
+										if(regions != null)
+											normal.setFilter(new RegionFilter(regions, PileupIndex.load(normalPileupFile, log), normalPileupFile, decompressThreads));
+									}
+									normalRecords = new PileupRecordReader(normal, minBaseQual, chroms, pipeline, "normal-pileup");
 								}
 
 							}
@@ -1090,8 +979,14 @@ public class VarScan {
 				}
 				catch (Exception e)
 				{
-					System.err.println("Exception encountered while parsing normal/tumor files: " + e.getMessage());
-					System.err.println("Note: It is HIGHLY recommended that you use a two-sample mpileup input rather than separate pileup files for normal/tumor.");
+					normalRecords.stop();
+					tumorRecords.stop();
+					outCopySegments.close();
+					log.println("Exception encountered while parsing normal/tumor files: " + e.getMessage());
+					log.println("Note: It is HIGHLY recommended that you use a two-sample mpileup input rather than separate pileup files for normal/tumor.");
+					normal.close();
+					tumor.close();
+					exitStatus = 10;
 					return;
 				}
 
@@ -1099,422 +994,6252 @@ public class VarScan {
 
 
 
+				normalRecords.stop();
+				tumorRecords.stop();
 				normal.close();
 				tumor.close();
 
 				// If we had a copyNumber region that met minimum coverage, report it //
-				if(copyPositions > minSegmentSize)
-				{
-					rawCopySegments++;
-					String regionResults = processCopyRegion(copyChrom, copyStart, copyStop, copyPositions, copyPositionsGC, copySumNormal, copySumTumor, minCoverage, dataRatio);
-
-					if(regionResults.length() > 0)
-					{
-						outCopySegments.println(regionResults);
-						goodCopySegments++;
-					}
-				}
+				segmenter.finish();
 
 
 				outCopySegments.close();
+				if(outCopySegments.checkError())
+				{
+					log.println("ERROR: Failed to write " + segmentFile);
+					exit(11);
+					return;
+				}
 
-				System.err.println(tumorPositions + " positions in tumor");
-				System.err.println(sharedPositions + " positions shared in normal"); //stats.get("sharedPositions")
-				System.err.println(comparedPositions + " had sufficient coverage for comparison"); //stats.get("comparedPositions")
-
-				System.err.println(rawCopySegments + " raw copynumber segments with size > " + minSegmentSize);
-				System.err.println(goodCopySegments + " good copynumber segments with depth > " + minCoverage);
+				log.println(tumorPositions + " positions in tumor");
+				if(tumor.getLines() > 0)
+					log.println((tumor.getFirstLineTime() - inputStartTime) / 1000000 + " ms to first record");
+				log.println(sharedPositions + " positions shared in normal"); //stats.get("sharedPositions")
+				log.println(segmenter.getComparedPositions() + " had sufficient coverage for comparison"); //stats.get("comparedPositions")
+
+				log.println(segmenter.getRawSegments() + " raw copynumber segments with size > " + minSegmentSize);
+				log.println(segmenter.getGoodSegments() + " good copynumber segments with depth > " + minCoverage);
+				if(writeQueueSize > 0)
+					log.println(outCopySegments.getStalls() + " of " + outCopySegments.getQueuedWrites() + " queued writes stalled on a full write queue, for " + outCopySegments.getStallMillis() + " ms");
+				if(caches == null)
+					printCacheStats(pValueCache, criticalDepths, log);
+
+				this.sharedPositions = sharedPositions;
+				comparedPositions = segmenter.getComparedPositions();
+				rawSegments = segmenter.getRawSegments();
+				goodSegments = segmenter.getGoodSegments();
 			}
 			catch (IOException e)
 			{
-				System.err.println("File Parsing Exception: " + e.getLocalizedMessage());
-				e.printStackTrace(System.err);
-				System.exit(11);
+				log.println("File Parsing Exception: " + e.getLocalizedMessage());
+				e.printStackTrace(log);
+				exit(11);
 			}
 		}
 
+		/**
+		 * Gets the change-point caches for a run: new ones, or those a batch shares for these settings
+		 */
+		private CriticalDepthCache getCriticalDepths(double pValueThreshold, int pValueCacheSize, int criticalCacheSize, int fisherApproxAbove)
+		{
+			if(caches != null)
+				return caches.get(pValueThreshold, pValueCacheSize, criticalCacheSize, fisherApproxAbove);
+
+			return new CriticalDepthCache(pValueThreshold, criticalCacheSize, new PValueCache(pValueCacheSize, fisherApproxAbove));
+		}
 
 		/**
-		 * Calculates relative tumor copynumber for a contiguous segment
+		 * Prints the hit and miss counts of the change-point caches
 		 *
-//		 * @param	args	Command-line arguments
-		 * @return			HashMap of parameter names and their values
+		 * @param	pValueCache		Cache of change-point p-values
+		 * @param	criticalDepths	Cache of critical tumor-depth bounds
+		 * @param	log				Stream for the statistics
 		 */
-		static String processCopyRegion(String copyChrom, int copyStart, int copyStop, long copyPositions, long copyPositionsGC, long copySumNormal, long copySumTumor, int minCoverage, double dataRatio)
+		static void printCacheStats(PValueCache pValueCache, CriticalDepthCache criticalDepths, PrintStream log)
 		{
-			DecimalFormat oneDigit = new DecimalFormat("#0.0");
-			DecimalFormat threeDigits = new DecimalFormat("#0.000");
+			log.println(pValueCache.getHits() + " p-value cache hits, " + pValueCache.getMisses() + " misses");
+			log.println(criticalDepths.getComputed() + " critical tumor-depth bounds computed for " + criticalDepths.getLookups() + " change-point tests");
+			if(pValueCache.getApproxAbove() > 0)
+				log.println(pValueCache.getApproximated() + " p-values approximated above " + pValueCache.getApproxAbove() + " reads; max error vs exact in " + pValueCache.getValidated() + " checks: " + pValueCache.getMaxApproxError() + " (" + pValueCache.getMaxApproxLog10Error() + " log10 units)");
+		}
 
-			try
-			{
-//			 Calculate average depth //
-				float avgNormal = (float) copySumNormal / (float) copyPositions;
-				float avgTumor = (float) copySumTumor / (float) copyPositions;
-				// Adjust tumor depth for ratio
-				float adjustedTumorDepth = (float) dataRatio * (float) avgTumor;
+		/**
+		 * Ends a run on an error. A single run exits the JVM with the status, as copynumber always has;
+		 * a batch sample records it for the batch summary.
+		 *
+		 * @param	status	Exit status
+		 */
+		private void exit(int status)
+		{
+			exitStatus = status;
+			if(caches == null)
+				System.exit(status);
+		}
 
-				float gcContent = (float) copyPositionsGC / (float) copyPositions * 100;
+		/**
+		 * Gets the exit status of the run, 0 unless it failed
+		 */
+		public int getExitStatus()
+		{
+			return exitStatus;
+		}
 
-				if(avgNormal >= minCoverage || avgTumor >= minCoverage)
-				{
-					// Determine ratio and diff //
-					if(avgNormal >= 0.01 && avgTumor >= 0.01)
-					{
-						float tumorNormalRatio = adjustedTumorDepth / avgNormal;
-						double log2ratio = Math.log(tumorNormalRatio) / Math.log(2);
+		public long getSharedPositions()
+		{
+			return sharedPositions;
+		}
 
-						return(copyChrom + "\t" + copyStart + "\t" + copyStop + "\t" + copyPositions + "\t" + oneDigit.format(avgNormal) + "\t" + oneDigit.format(avgTumor) + "\t" + threeDigits.format(log2ratio) + "\t" + oneDigit.format(gcContent));
-					}
-					else if (avgTumor >= 0.01)
-					{
-						// If only tumor has coverage, handle it //
-						double log2ratio = 2.00;
-						return(copyChrom + "\t" + copyStart + "\t" + copyStop + "\t" + copyPositions + "\t" + oneDigit.format(avgNormal) + "\t" + oneDigit.format(avgTumor) + "\t" + threeDigits.format(log2ratio) + "\t" + oneDigit.format(gcContent));
-					}
-					else
+		public long getComparedPositions()
+		{
+			return comparedPositions;
+		}
+
+		public long getRawSegments()
+		{
+			return rawSegments;
+		}
+
+		public long getGoodSegments()
+		{
+			return goodSegments;
+		}
+
+		/**
+		 * Copy-number segmentation state for a run of mpileup lines. The mpileup constructor feeds one
+		 * segmenter the whole input, or with --threads gives each chunk of the input its own.
+		 */
+		static class MpileupSegmenter
+		{
+			private final int minCoverage;
+			private final int minBaseQual;
+			private final int minSegmentSize;
+			private final int maxSegmentSize;
+			private final double dataRatio;
+			private final boolean verbose;
+			private final CriticalDepthCache criticalDepths;
+			private final SegmentWriter out;
+			private final PrintStream log;
+			private final ChromosomeRegistry chroms = new ChromosomeRegistry(true);
+			private final CopySegmenter segmenter;
+
+			// Statistics counters //
+			private long lines = 0;
+			private long sharedPositions = 0;
+			private long failedLine = 0;
+
+			// Column boundaries are recorded once per line; only the columns used are copied //
+			private final TabTokenizer lineContents = new TabTokenizer();
+			private final int[] qualityDepths = new int[2];
+			private String chromTumor = "";
+			private int chromIdTumor = chroms.id("");
+
+			/**
+			 * constructor for MpileupSegmenter
+			 *
+			 * @param	out		Stream for copynumber segment rows
+			 * @param	log		Stream for warnings and parsing exceptions
+			 */
+			MpileupSegmenter(int minCoverage, int minBaseQual, int minSegmentSize, int maxSegmentSize, double dataRatio, boolean verbose, CriticalDepthCache criticalDepths, SegmentWriter out, PrintStream log)
+			{
+				this.minCoverage = minCoverage;
+				this.minBaseQual = minBaseQual;
+				this.minSegmentSize = minSegmentSize;
+				this.maxSegmentSize = maxSegmentSize;
+				this.dataRatio = dataRatio;
+				this.verbose = verbose;
+				this.criticalDepths = criticalDepths;
+				this.out = out;
+				this.log = log;
+				this.segmenter = new CopySegmenter(minCoverage, minSegmentSize, maxSegmentSize, dataRatio, criticalDepths, chroms, out);
+			}
+
+			/**
+			 * Creates a segmenter with the same settings for a chunk of the input
+			 *
+			 * @param	settings	Segmenter to copy the settings from
+			 * @param	firstLine	Number of input lines before the chunk
+			 */
+			MpileupSegmenter(MpileupSegmenter settings, SegmentWriter out, PrintStream log, long firstLine)
+			{
+				this(settings.minCoverage, settings.minBaseQual, settings.minSegmentSize, settings.maxSegmentSize, settings.dataRatio, settings.verbose, settings.criticalDepths, out, log);
+				this.lines = firstLine;
+			}
+
+			/**
+			 * Processes one mpileup line, extending the current segment or reporting it and starting another
+			 *
+			 * @param	buffer	Buffer holding the line
+			 * @param	start	Offset of the line
+			 * @param	end		Offset just past the line, without the line terminator
+			 */
+			void processLine(byte[] buffer, int start, int end)
+			{
+				lines++;
+				lineContents.reset(buffer, start, end);
+
+				// Verify expected pileup format //
+
+				if(lineContents.count() < 8)
+				{
+					// This is an incomplete mpileup line, so skip it. If verbose, throw a warning //
+					if(verbose)
 					{
-						// If only normal has coverage, mark as homozygyous deletion //
-						double log2ratio = -2.00;
-						return(copyChrom + "\t" + copyStart + "\t" + copyStop + "\t" + copyPositions + "\t" + oneDigit.format(avgNormal) + "\t" + oneDigit.format(avgTumor) + "\t" + threeDigits.format(log2ratio) + "\t" + oneDigit.format(gcContent));
+						log.println("Incomplete mpileup at line " + lines + "; line being skipped.");
 					}
+					return;
+				}
+
+				sharedPositions++;
+
+				// Parse common fields from line, reusing the chromosome while it is unchanged //
+				if(!lineContents.fieldEquals(0, chromTumor))
+				{
+					chromTumor = lineContents.field(0);
+					chromIdTumor = chroms.id(chromTumor);
+				}
+				int posTumor = lineContents.intField(1);
+				String refBase = lineContents.field(2).toUpperCase();
+
+				// Parse normal, which should be first sample //
+				int normalOffset = 3;
+				int pileupDepthNormal = lineContents.intField(normalOffset);
+				int normalQualitiesLength = lineContents.fieldLength(normalOffset + 2);
+
+				// Parse tumor, which should be second sample //
+				int tumorOffset = 6;
+				int tumorQualitiesLength = 0;
+				if(lineContents.count() >= (tumorOffset + 2 + 1))
+				{
+					lineContents.intField(tumorOffset);
+					tumorQualitiesLength = lineContents.fieldLength(tumorOffset + 2);
+				}
 
+				// We want the normal sample to meet the minimum coverage because that's the comparator //
+				if(pileupDepthNormal < minCoverage || normalQualitiesLength == 0)
+				{
+					// If we had a copyNumber region that met minimum coverage, report it and reset //
+					segmenter.endSegment();
+					return;
 				}
+
+				// Get the depth of bases above minimum quality, counted in place for both samples //
+				lineContents.qualityDepths(normalOffset + 2, (tumorQualitiesLength > 0) ? tumorOffset + 2 : -1, minBaseQual, qualityDepths);
+				boolean isGC = refBase.equals("G") || refBase.equals("C") || refBase.equals("g") || refBase.equals("c");
+
+				// Extend the current segment or report it and start a new one //
+				segmenter.add(chromIdTumor, posTumor, qualityDepths[0], qualityDepths[1], isGC);
+			}
+
+			/**
+			 * Reports the current segment if it is large enough, and resets the segmentation state
+			 *
+			 * @param	endOfInput	True for the last segment of the input, which must exceed the minimum size
+			 */
+			void finishSegment(boolean endOfInput)
+			{
+				if(endOfInput)
+					segmenter.finish();
 				else
+					segmenter.endSegment();
+			}
+
+			/**
+			 * Determines whether a complete mpileup line resets the segmentation state, because the normal
+			 * lacks coverage. Such a line is followed by a fresh state, so the input can be split after it.
+			 *
+			 * @param	line	Tokenized line with at least 8 columns
+			 * @return			True if processing the line ends with the state reset
+			 */
+			boolean resetsSegment(TabTokenizer line)
+			{
+				try
+				{
+					line.intField(1);
+					if(line.count() >= 9)
+						line.intField(6);
+					return line.intField(3) < minCoverage || line.fieldLength(5) == 0;
+				}
+				catch(NumberFormatException e)
 				{
-//				System.err.println("Warning: Not reporting region " + copyChrom + " " + copyStart + " " + copyStop + " " + copyPositions + " " + avgNormal + " " + avgTumor);
+					return false;
 				}
 			}
-			catch(Exception e)
+
+			/**
+			 * Records a parsing exception, which stops the run
+			 *
+			 * @param	line	The line that could not be parsed
+			 */
+			void fail(String line, Exception e)
+			{
+				failedLine = lines;
+				log.println("Parsing Exception on line:\n" + line + "\n" + e.getLocalizedMessage());
+			}
+
+			/**
+			 * Adds the counters of a chunk's segmenter to this one
+			 */
+			void addCounts(MpileupSegmenter chunk)
+			{
+				lines = chunk.lines;
+				sharedPositions += chunk.sharedPositions;
+				segmenter.addCounts(chunk.segmenter);
+			}
+
+			long getLines()
+			{
+				return lines;
+			}
+
+			long getFailedLine()
+			{
+				return failedLine;
+			}
+
+			long getSharedPositions()
+			{
+				return sharedPositions;
+			}
+
+			long getComparedPositions()
 			{
-				System.err.println("Warning: Error while processing copynumber segment:" + e.getMessage());
+				return segmenter.getComparedPositions();
 			}
 
+			long getRawCopySegments()
+			{
+				return segmenter.getRawSegments();
+			}
 
-			return("");
+			long getGoodCopySegments()
+			{
+				return segmenter.getGoodSegments();
+			}
 		}
 
 
 		/**
-		 * Determine if tumor chromosome is before normal chromosome in sort order
-		 *
-//		 * @param	args	Command-line arguments
-		 * @return			HashMap of parameter names and their values
+		 * Segments an mpileup in chunks on a pool of worker threads, writing each chunk's segments in input
+		 * order. A chunk only ends where a single-threaded run would restart its segmentation state: at a
+		 * chromosome change, or after a position where the normal lacks coverage. The last segment of each
+		 * chunk is reported once the next chunk is known, so output and counters match a single thread.
 		 */
-		static boolean inSortOrder(String chrom1, String chrom2)
+		static class ChunkedSegmenter
 		{
-			String[] testArray = {chrom1, chrom2};
-			Arrays.sort(testArray);
+			static final int CHUNK_SIZE = 1 << 22;
+
+			private final MpileupSegmenter totals;
+			private final int maxPending;
+			private final ExecutorService pool;
+			private final ArrayDeque<Future<SegmentChunk>> pending = new ArrayDeque<Future<SegmentChunk>>();
+			private SegmentChunk held = null;
+			private long chunks = 0;
+
+			/**
+			 * constructor for ChunkedSegmenter
+			 *
+			 * @param	totals	Segmenter with the settings and output stream, which receives the counters
+			 * @param	threads	Number of worker threads
+			 */
+			ChunkedSegmenter(MpileupSegmenter totals, int threads)
+			{
+				this.totals = totals;
+				this.maxPending = 2 * threads;
+				this.pool = Executors.newFixedThreadPool(threads, VarScan.daemonThreadFactory("copynumber"));
+			}
 
-			if(testArray[0].equals(chrom1))
-				return true;
+			/**
+			 * Reads and segments the whole input
+			 *
+			 * @param	in	Reader for the mpileup
+			 * @return		False if a parsing exception stopped the run
+			 */
+			boolean segment(ByteLineReader in) throws IOException
+			{
+				TabTokenizer boundaryTokens = new TabTokenizer();
+				byte[] chunk = new byte[CHUNK_SIZE + (CHUNK_SIZE >> 2)];
+				int chunkLength = 0;
+				long chunkFirstLine = 0;
+				String prevChrom = null;
+				boolean prevResets = false;
+
+				try
+				{
+					while (in.next())
+					{
+						int lineLength = in.lineEnd() - in.lineStart();
 
-			return false;
-		}
+						// Near the target size, check each line for a place where the state restarts, //
+						// including the line that brings the chunk to the target size exactly //
+						if(chunkLength + lineLength + 1 >= CHUNK_SIZE)
+						{
+							boundaryTokens.reset(in.buffer(), in.lineStart(), in.lineEnd());
+							String chrom = (boundaryTokens.count() >= 8) ? boundaryTokens.field(0) : null;
 
+							if(chunkLength >= CHUNK_SIZE && (prevResets || (chrom != null && prevChrom != null && !chrom.equals(prevChrom))))
+							{
+								if(!submit(chunk, chunkLength, chunkFirstLine))
+									return false;
 
+								chunk = new byte[chunk.length];
+								chunkLength = 0;
+								chunkFirstLine = in.getLines() - 1;
+							}
 
-		/**
-		 * Determines the sort order for chromosomes
-		 *
-//		 * @param	args	Command-line arguments
-		 * @return			HashMap of parameter names and their values
-		 */
-		static Boolean chromSorted(String chrom1, String chrom2)
-		{
-			Boolean answer = false;
+							prevChrom = chrom;
+							prevResets = (chrom != null) && totals.resetsSegment(boundaryTokens);
+						}
+
+						if(chunkLength + lineLength + 1 > chunk.length)
+							chunk = Arrays.copyOf(chunk, Math.max(2 * chunk.length, chunkLength + lineLength + 1));
+
+						System.arraycopy(in.buffer(), in.lineStart(), chunk, chunkLength, lineLength);
+						chunkLength += lineLength;
+						chunk[chunkLength++] = '\n';
+					}
 
-			chrom1.replace("X", "23");
-			chrom1.replace("Y", "24");
-			chrom1.replace("M", "25");
+					if(chunkLength > 0 && !submit(chunk, chunkLength, chunkFirstLine))
+						return false;
 
-			chrom2.replace("X", "23");
-			chrom2.replace("Y", "24");
-			chrom2.replace("M", "25");
+					if(!writeChunks(true))
+						return false;
 
-			String[] unsorted = {chrom1, chrom2};
-			String[] sorted = {chrom1, chrom2};
-			Arrays.sort(sorted);
-			System.err.println("Sorted order is " + sorted[0] + " " + sorted[1]);
-			try{
-				if(sorted[0].equals(unsorted[0]))
+					// Last region: If minimum coverage was not met, print region //
+					if(held != null)
+					{
+						held.segmenter.finishSegment(true);
+						write(held);
+						held = null;
+					}
+					return true;
+				}
+				finally
 				{
-					answer = true;
+					pool.shutdownNow();
 				}
 			}
-			catch(Exception e)
-			{
 
+			private boolean submit(byte[] chunk, int length, long firstLine) throws IOException
+			{
+				pending.add(pool.submit(new SegmentChunk(totals, chunk, length, firstLine)));
+				chunks++;
+				return writeChunks(false);
 			}
 
-			return(answer);
-		}
-	}
+			/**
+			 * Writes finished chunks in input order, waiting for them if too many are pending or all are wanted
+			 */
+			private boolean writeChunks(boolean all) throws IOException
+			{
+				while(!pending.isEmpty() && (all || pending.size() > maxPending || pending.peek().isDone()))
+				{
+					SegmentChunk next = await(pending.poll());
 
-	public static class FishersExact {
-		private static final boolean DEBUG = false;
-		private double[] f;
-		int maxSize;
+					if(held != null)
+					{
+						// A single thread reports the previous segment on the next line, unless that line fails //
+						if(next.segmenter.getFailedLine() != next.firstLine + 1)
+							held.segmenter.finishSegment(false);
+						write(held);
+					}
+					held = next;
 
+					if(next.segmenter.getFailedLine() > 0)
+					{
+						write(next);
+						held = null;
+						return false;
+					}
+				}
+				return true;
+			}
 
-		/**
-		 * constructor for FisherExact table
-		 *
-		 * @param maxSize is the maximum sum that will be encountered by the table (a+b+c+d)
-		 */
-		public FishersExact(int maxSize) {
-			this.maxSize = maxSize;
-			double cf = 1.0;
-			f = new double[maxSize + 1];
-			f[0] = 0.0;
-			for (int i = 1; i <= this.maxSize; i++) {
-				f[i] = f[i - 1] + Math.log(i);
+			private void write(SegmentChunk chunk) throws IOException
+			{
+				chunk.writer.flush();
+				totals.out.write(chunk.writer);
+				chunk.messages.writeTo(totals.log);
+				totals.addCounts(chunk.segmenter);
 			}
-		}
 
-		/**
-		 * calculates the P-value for this specific state
-		 *
-		 * @param a     a, b, c, d are the four cells in a 2x2 matrix
-		 * @param b
-		 * @param c
-		 * @param d
-		 * @return the P-value
-		 */
-		public final double getP(int a, int b, int c, int d) {
-			try
+			private static SegmentChunk await(Future<SegmentChunk> result) throws IOException
 			{
-				int n = a + b + c + d;
-				if (n > maxSize) {
-					return Double.NaN;
+				try
+				{
+					return result.get();
+				}
+				catch(InterruptedException e)
+				{
+					Thread.currentThread().interrupt();
+					throw new InterruptedIOException("Interrupted while segmenting input chunks");
+				}
+				catch(ExecutionException e)
+				{
+					throw new IOException(e.getCause());
 				}
-				double p;
-				p = (f[a + b] + f[c + d] + f[a + c] + f[b + d]) - (f[a] + f[b] + f[c] + f[d] + f[n]);
-				return Math.exp(p);
 			}
-			catch(Exception e)
+
+			long getChunks()
 			{
-				return Double.NaN;
+				return chunks;
 			}
-
 		}
 
+
 		/**
-		 * Calculates the one-tail P-value for the Fisher Exact test.  Determines whether to calculate the right- or left-
-		 * tail, thereby always returning the smallest p-value.
-		 *
-		 * @param a     a, b, c, d are the four cells in a 2x2 matrix
-		 * @param b
-		 * @param c
-		 * @param d
-		 * @return one-tailed P-value (right or left, whichever is smallest)
+		 * One chunk of mpileup lines, segmented on a worker thread into buffered output
 		 */
-		public final double getCumlativeP(int a, int b, int c, int d) {
-			int min, i;
-			int n = a + b + c + d;
-			if (n > maxSize) {
-				return Double.NaN;
+		static class SegmentChunk implements Callable<SegmentChunk>
+		{
+			private static final Charset LATIN1 = Charset.forName("ISO-8859-1");
+			private static final int CHUNK_OUTPUT_BUFFER_SIZE = 1 << 16;
+
+			private final byte[] chunk;
+			private final int length;
+			final long firstLine;
+			final ByteArrayOutputStream output = new ByteArrayOutputStream();
+			final ByteArrayOutputStream messages = new ByteArrayOutputStream();
+			final SegmentWriter writer;
+			final MpileupSegmenter segmenter;
+
+			SegmentChunk(MpileupSegmenter settings, byte[] chunk, int length, long firstLine)
+			{
+				this.chunk = chunk;
+				this.length = length;
+				this.firstLine = firstLine;
+				this.writer = settings.out.forChunk(output, CHUNK_OUTPUT_BUFFER_SIZE);
+				this.segmenter = new MpileupSegmenter(settings, writer, new PrintStream(messages), firstLine);
 			}
-			double p = 0;
 
-			p += getP(a, b, c, d);
-			if (DEBUG) {System.out.println("p = " + p);}
-			if ((a * d) >= (b * c)) {
-				if (DEBUG) {System.out.println("doing R-tail: a=" + a + " b=" + b + " c=" + c + " d=" + d);}
-				min = (c < b) ? c : b;
-				for (i = 0; i < min; i++) {
-					if (DEBUG) {System.out.print("doing round " + i);}
-					p += getP(++a, --b, --c, ++d);
-					if (DEBUG) {System.out.println("\ta=" + a + " b=" + b + " c=" + c + " d=" + d);}
-				}
-				System.out.println("");
-			}
-			if ((a * d) < (b * c)) {
-				if (DEBUG) {System.out.println("doing L-tail: a=" + a + " b=" + b + " c=" + c + " d=" + d);}
-				min = (a < d) ? a : d;
-				for (i = 0; i < min; i++) {
-					if (DEBUG) {System.out.print("doing round " + i);}
-					double pTemp = getP(--a, ++b, ++c, --d);
-					if (DEBUG) {System.out.print("\tpTemp = " + pTemp);}
-					p += pTemp;
-					if (DEBUG) {System.out.println("\ta=" + a + " b=" + b + " c=" + c + " d=" + d);}
+			public SegmentChunk call()
+			{
+				int lineStart = 0;
+				for(int i = 0; i < length; i++)
+				{
+					if(chunk[i] == '\n')
+					{
+						try
+						{
+							segmenter.processLine(chunk, lineStart, i);
+						}
+						catch(Exception e)
+						{
+							segmenter.fail(new String(chunk, lineStart, i - lineStart, LATIN1), e);
+							break;
+						}
+						lineStart = i + 1;
+					}
 				}
+				return this;
 			}
-			return p;
 		}
 
 		/**
-		 * Calculates the right-tail P-value for the Fisher Exact test.
-		 *
-		 * @param a     a, b, c, d are the four cells in a 2x2 matrix
-		 * @param b
-		 * @param c
-		 * @param d
-		 * @return one-tailed P-value (right-tail)
+		 * One sample of a copynumber batch, or one job of the serve command, run on a worker thread
+		 * with its messages buffered
 		 */
-		public final double getRightTailedP(int a, int b, int c, int d) {
-			int min, i;
-			int n = a + b + c + d;
-			if (n > maxSize) {
-				return Double.NaN;
+		static class BatchSample implements Callable<BatchSample>
+		{
+			final int number;
+			final String input;
+			final String outputName;
+			private final String[] args;
+			private final SharedCaches caches;
+			private final long submitTime = System.nanoTime();
+			final ByteArrayOutputStream messages = new ByteArrayOutputStream();
+			Copynumber result = null;
+			int exitStatus = 0;
+			long queueMillis = 0;
+			long millis = 0;
+
+			/**
+			 * constructor for BatchSample
+			 *
+			 * @param	number		Line of the manifest, or job number
+			 * @param	input		Mpileup, or normal and tumor pileups separated by a comma
+			 * @param	outputName	Output base name
+			 * @param	args		Command-line arguments for copynumber
+			 * @param	caches		Change-point caches shared by the batch
+			 */
+			BatchSample(int number, String input, String outputName, String[] args, SharedCaches caches)
+			{
+				this.number = number;
+				this.input = input;
+				this.outputName = outputName;
+				this.args = args;
+				this.caches = caches;
 			}
-			double p = 0;
 
-			p += getP(a, b, c, d);
-			if (DEBUG) {System.out.println("p = " + p);}
-			if (DEBUG) {System.out.println("doing R-tail: a=" + a + " b=" + b + " c=" + c + " d=" + d);}
-			min = (c < b) ? c : b;
-			for (i = 0; i < min; i++) {
-				p += getP(++a, --b, --c, ++d);
+			public BatchSample call()
+			{
+				PrintStream log = new PrintStream(messages);
+				long startTime = System.nanoTime();
+				queueMillis = (startTime - submitTime) / 1000000;
+
+				try
+				{
+					// Without its input file, copynumber would read STDIN //
+					String[] inputs = input.split(",");
+					for(int i = 0; i < inputs.length; i++)
+					{
+						if(!new File(inputs[i]).exists())
+						{
+							log.println("ERROR: Input file not found: " + inputs[i]);
+							exitStatus = 10;
+						}
+					}
+
+					if(exitStatus == 0)
+					{
+						if(inputs.length == 1)
+							result = new Copynumber(args, true, log, caches);
+						else
+							result = new Copynumber(args, log, caches);
+						exitStatus = result.getExitStatus();
+					}
+				}
+				catch(RuntimeException e)
+				{
+					log.println("Sample Threw Exception: " + e.getLocalizedMessage());
+					e.printStackTrace(log);
+					exitStatus = 11;
+				}
 
+				millis = (System.nanoTime() - startTime) / 1000000;
+				log.flush();
+				return this;
 			}
-			return p;
 		}
 
 		/**
-		 * Calculates the left-tail P-value for the Fisher Exact test.
-		 *
-		 * @param a     a, b, c, d are the four cells in a 2x2 matrix
-		 * @param b
-		 * @param c
-		 * @param d
-		 * @return one-tailed P-value (left-tail)
+		 * Local daemon for the serve command. Each connection to the loopback port first presents the access
+		 * token, then sends requests as lines; copynumber jobs run on a fixed pool of workers that share
+		 * change-point caches for the life of the server, so that repeated small jobs pay neither JVM startup
+		 * nor cold caches.
 		 */
-		public final double getLeftTailedP(int a, int b, int c, int d) {
-			int min, i;
-			int n = a + b + c + d;
-			if (n > maxSize) {
-				return Double.NaN;
+		static class Server
+		{
+			static final int RECENT_JOBS = 100;
+
+			private final ServerSocket socket;
+			private final byte[] token;
+			private final ThreadPoolExecutor workers;
+			private final ExecutorService connections = Executors.newCachedThreadPool(VarScan.daemonThreadFactory("serve-connection"));
+			private final HashSet<Socket> clients = new HashSet<Socket>();
+			private final SharedCaches caches = new SharedCaches();
+			private final ArrayDeque<BatchSample> recent = new ArrayDeque<BatchSample>();
+			private volatile boolean stopping = false;
+			private int jobs = 0;
+			private int active = 0;
+			private long completed = 0;
+			private long failed = 0;
+			private long totalQueueMillis = 0;
+			private long totalMillis = 0;
+			private long maxMillis = 0;
+
+			/**
+			 * constructor for Server
+			 *
+			 * @param	port	Local TCP port, or 0 for any free port
+			 * @param	threads	Number of worker threads for jobs
+			 * @param	token	Access token that each connection must send as its first line
+			 */
+			Server(int port, int threads, String token) throws IOException
+			{
+				socket = new ServerSocket(port, 50, InetAddress.getLoopbackAddress());
+				this.token = token.getBytes("US-ASCII");
+				workers = new ThreadPoolExecutor(threads, threads, 0L, TimeUnit.MILLISECONDS, new LinkedBlockingQueue<Runnable>(), VarScan.daemonThreadFactory("serve-job"));
 			}
-			double p = 0;
 
-			p += getP(a, b, c, d);
-			if (DEBUG) {System.out.println("p = " + p);}
-			if (DEBUG) {System.out.println("doing L-tail: a=" + a + " b=" + b + " c=" + c + " d=" + d);}
-			min = (a < d) ? a : d;
-			for (i = 0; i < min; i++) {
-				if (DEBUG) {System.out.print("doing round " + i);}
-				double pTemp = getP(--a, ++b, ++c, --d);
-				if (DEBUG) {System.out.print("\tpTemp = " + pTemp);}
-				p += pTemp;
-				if (DEBUG) {System.out.println("\ta=" + a + " b=" + b + " c=" + c + " d=" + d);}
+			/**
+			 * Writes a new random access token to a file that only the current user may read, replacing any old one
+			 *
+			 * @param	tokenFile	File to hold the token
+			 * @return	The token
+			 */
+			static String writeToken(File tokenFile) throws IOException
+			{
+				byte[] bytes = new byte[32];
+				new SecureRandom().nextBytes(bytes);
+				StringBuilder token = new StringBuilder();
+				for(int i = 0; i < bytes.length; i++)
+					token.append(String.format("%02x", bytes[i] & 0xFF));
+
+				// Create the file afresh, so that it is never readable by others and a planted link is not followed //
+				Files.deleteIfExists(tokenFile.toPath());
+				try
+				{
+					Files.createFile(tokenFile.toPath(), PosixFilePermissions.asFileAttribute(PosixFilePermissions.fromString("rw-------")));
+				}
+				catch(UnsupportedOperationException e)
+				{
+					Files.createFile(tokenFile.toPath());
+					tokenFile.setReadable(false, false);
+					tokenFile.setWritable(false, false);
+					tokenFile.setReadable(true, true);
+					tokenFile.setWritable(true, true);
+				}
+
+				PrintStream out = new PrintStream(new FileOutputStream(tokenFile));
+				out.println(token);
+				out.close();
+				if(out.checkError())
+					throw new IOException("write failed");
+				return token.toString();
 			}
 
+			int getPort()
+			{
+				return socket.getLocalPort();
+			}
 
-			return p;
-		}
+			int getWorkers()
+			{
+				return workers.getMaximumPoolSize();
+			}
 
+			synchronized long getCompleted()
+			{
+				return completed;
+			}
 
-		/**
-		 *   Calculates the two-tailed P-value for the Fisher Exact test.
+			synchronized long getFailed()
+			{
+				return failed;
+			}
+
+			/**
+			 * Accepts connections until a shutdown request, then waits for the jobs already taken
+			 */
+			void run() throws IOException
+			{
+				while(!stopping)
+				{
+					final Socket client;
+					try
+					{
+						client = socket.accept();
+					}
+					catch(SocketException e)
+					{
+						if(stopping)
+							break;
+						throw e;
+					}
+
+					synchronized(this)
+					{
+						clients.add(client);
+					}
+					connections.execute(new Runnable() {
+						public void run() {
+							serve(client);
+						}
+					});
+				}
+
+				// Let every job answer its client, then drop the idle connections //
+				synchronized(this)
+				{
+					while(active > 0)
+					{
+						try
+						{
+							wait();
+						}
+						catch(InterruptedException e)
+						{
+							Thread.currentThread().interrupt();
+							break;
+						}
+					}
+
+					for(Socket client : clients)
+						close(client);
+				}
+				workers.shutdown();
+				connections.shutdown();
+			}
+
+			/**
+			 * Answers the requests of one connection until the client closes it
+			 */
+			private void serve(Socket client)
+			{
+				try
+				{
+					BufferedReader in = new BufferedReader(new InputStreamReader(client.getInputStream()));
+					PrintStream out = new PrintStream(new BufferedOutputStream(client.getOutputStream()));
+
+					// Refuse connections whose first line is not the token //
+					String line = in.readLine();
+					if(line == null || !MessageDigest.isEqual(line.trim().getBytes("US-ASCII"), token))
+					{
+						System.err.println("Refused a connection from port " + client.getPort() + " without the access token");
+						out.println("ERROR: Access token not recognized");
+						out.println("DONE");
+						out.flush();
+						return;
+					}
+
+					while((line = in.readLine()) != null)
+					{
+						line = line.trim();
+						if(line.length() == 0)
+							continue;
+
+						// Arguments are tab-separated, so that paths may hold spaces, or else space-separated //
+						String[] args = line.split((line.indexOf('\t') >= 0) ? "\t" : "\\s+");
+
+						if(args[0].equals("copynumber"))
+						{
+							runJob(args, out);
+						}
+						else if(args[0].equals("status"))
+						{
+							printStatus(out);
+						}
+						else if(args[0].equals("shutdown"))
+						{
+							out.println("DONE");
+							out.flush();
+							shutdown();
+							break;
+						}
+						else
+						{
+							out.println("ERROR: Command not recognized: " + args[0]);
+							out.println("DONE");
+						}
+						out.flush();
+					}
+				}
+				catch(IOException e)
+				{
+					// The client went away; a job it started still runs to the end //
+				}
+				finally
+				{
+					synchronized(this)
+					{
+						clients.remove(client);
+					}
+					close(client);
+				}
+			}
+
+			/**
+			 * Runs one copynumber job on the workers, and answers with its messages and timing
+			 *
+			 * @param	args	Arguments as for the copynumber command
+			 * @param	out		Stream to the client
+			 */
+			private void runJob(String[] args, PrintStream out) throws IOException
+			{
+				// Inputs and output base name as the copynumber command takes them //
+				boolean mpileup = VarScan.getParams(args).containsKey("mpileup");
+				int outputArg = mpileup ? 2 : 3;
+				for(int i = 1; i <= outputArg; i++)
+				{
+					if(i >= args.length || args[i].startsWith("-"))
+					{
+						out.println("ERROR: A copynumber job needs " + (mpileup ? "an mpileup" : "normal and tumor pileups") + " and an output base name");
+						out.println("DONE\t0\t1\t0\t0");
+						return;
+					}
+				}
+				String input = mpileup ? args[1] : args[1] + "," + args[2];
+
+				BatchSample job;
+				synchronized(this)
+				{
+					if(stopping)
+					{
+						out.println("ERROR: Server is shutting down");
+						out.println("DONE\t0\t1\t0\t0");
+						return;
+					}
+					job = new BatchSample(++jobs, input, args[outputArg], args, caches);
+					active++;
+				}
+
+				try
+				{
+					workers.submit(job).get();
+					job.messages.writeTo(out);
+					out.println("DONE\t" + job.number + "\t" + job.exitStatus + "\t" + job.queueMillis + "\t" + job.millis);
+					out.flush();
+				}
+				catch(InterruptedException e)
+				{
+					Thread.currentThread().interrupt();
+					throw new InterruptedIOException("Interrupted while waiting for job " + job.number);
+				}
+				catch(ExecutionException e)
+				{
+					throw new IOException(e.getCause());
+				}
+				finally
+				{
+					finished(job);
+				}
+			}
+
+			/**
+			 * Records the timing of a job that has answered its client
+			 */
+			private synchronized void finished(BatchSample job)
+			{
+				completed++;
+				if(job.exitStatus != 0)
+					failed++;
+				totalQueueMillis += job.queueMillis;
+				totalMillis += job.millis;
+				maxMillis = Math.max(maxMillis, job.millis);
+
+				recent.addLast(job);
+				if(recent.size() > RECENT_JOBS)
+					recent.removeFirst();
+
+				System.err.println("Job " + job.number + " (" + job.outputName + ") " + ((job.exitStatus == 0) ? "finished" : "FAILED with status " + job.exitStatus) + ", " + job.queueMillis + " ms queued, " + job.millis + " ms running");
+
+				active--;
+				notifyAll();
+			}
+
+			/**
+			 * Answers a status request: queue depth, job counts and latencies, cache statistics and the recent jobs
+			 */
+			private synchronized void printStatus(PrintStream out)
+			{
+				out.println("workers\t" + workers.getMaximumPoolSize());
+				out.println("queued\t" + workers.getQueue().size());
+				out.println("running\t" + workers.getActiveCount());
+				out.println("completed\t" + completed);
+				out.println("failed\t" + failed);
+				out.println("mean_queue_ms\t" + ((completed > 0) ? totalQueueMillis / completed : 0));
+				out.println("mean_run_ms\t" + ((completed > 0) ? totalMillis / completed : 0));
+				out.println("max_run_ms\t" + maxMillis);
+
+				// Per p-value threshold: p-value cache hits and misses, bounds computed and change-point tests //
+				for(CriticalDepthCache criticalDepths : caches.getCaches())
+				{
+					PValueCache pValueCache = criticalDepths.getPValueCache();
+					out.println("cache\t" + criticalDepths.getThreshold() + "\t" + pValueCache.getHits() + "\t" + pValueCache.getMisses() + "\t" + criticalDepths.getComputed() + "\t" + criticalDepths.getLookups());
+				}
+
+				// Recent jobs: number, output, exit status, ms queued and ms running //
+				for(BatchSample job : recent)
+					out.println("job\t" + job.number + "\t" + job.outputName + "\t" + job.exitStatus + "\t" + job.queueMillis + "\t" + job.millis);
+
+				out.println("DONE");
+			}
+
+			/**
+			 * Stops accepting connections and jobs
+			 */
+			synchronized void shutdown()
+			{
+				stopping = true;
+				close(socket);
+			}
+
+			private static void close(Closeable closeable)
+			{
+				try
+				{
+					closeable.close();
+				}
+				catch(IOException e)
+				{
+					// Nothing more to do with it //
+				}
+			}
+		}
+
+		/**
+		 * Writes copynumber segment rows through a reusable byte buffer. The #0.0 and #0.000 columns are
+		 * formatted straight into the buffer, with the same text DecimalFormat would give. Like PrintStream,
+		 * write errors are not thrown but reported by checkError().
+		 *
+		 * With a write queue, rows are handed to a background thread through a bounded ring, so that a slow
+		 * output file stalls the caller only once the ring is full. Each stall is counted for the run stats.
+		 */
+		static class SegmentWriter implements CopySegmenter.Listener
+		{
+			static final int DEFAULT_BUFFER_SIZE = 1 << 20;
+			static final String HEADER = "chrom\tchr_start\tchr_stop\tnum_positions\tnormal_depth\ttumor_depth\tlog2_ratio\tgc_content";
+			private static final byte[] LINE_SEPARATOR = System.getProperty("line.separator").getBytes();
+
+			// Below this magnitude a scaled value is within 1e-7 of exact, so only near-ties are left to DecimalFormat //
+			private static final double FAST_LIMIT = 1e6;
+			private static final double TIE_WINDOW = 1e-6;
+
+			private final OutputStream out;
+			private byte[] buffer;
+			private int count = 0;
+			private boolean error = false;
+
+			// Binary output: rows go to a segment table instead of being formatted //
+			private final SegmentTableWriter table;
+
+			// Fast formatting needs the default locale to print plain ASCII digits //
+			private final boolean plainDigits;
+			private DecimalFormat oneDigit = null;
+			private DecimalFormat threeDigits = null;
+
+			private String lastChrom = null;
+			private byte[] lastChromBytes = null;
+
+			// Write queue: a ring of pending writes. A slot's data is a segment row's chromosome, a byte[] //
+			// line, a SegmentWriter of chunk rows, or null for a flush. Only the writer thread formats. //
+			private final Thread writerThread;
+			private final Object ringLock = new Object();
+			private Object[] ringData = null;
+			private int[] ringStarts;
+			private int[] ringStops;
+			private long[] ringPositions;
+			private float[] ringNormal;
+			private float[] ringTumor;
+			private double[] ringLog2;
+			private float[] ringGC;
+			private int ringTail = 0;
+			private int ringCount = 0;
+			private boolean closing = false;
+			private long queuedWrites = 0;
+			private long stalls = 0;
+			private long stallNanos = 0;
+
+			/**
+			 * constructor for SegmentWriter
+			 *
+			 * @param	out			Stream for copynumber segment rows
+			 * @param	bufferSize	Size in bytes of the output buffer
+			 */
+			SegmentWriter(OutputStream out, int bufferSize)
+			{
+				this(out, bufferSize, 0);
+			}
+
+			/**
+			 * constructor for SegmentWriter
+			 *
+			 * @param	out			Stream for copynumber segment rows
+			 * @param	bufferSize	Size in bytes of the output buffer
+			 * @param	queueSize	Writes to queue for a background writer thread, or 0 to write on the caller's thread
+			 */
+			SegmentWriter(OutputStream out, int bufferSize, int queueSize)
+			{
+				this(out, bufferSize, queueSize, null);
+			}
+
+			/**
+			 * constructor for SegmentWriter
+			 *
+			 * @param	out			Stream for copynumber segment rows
+			 * @param	bufferSize	Size in bytes of the output buffer
+			 * @param	queueSize	Writes to queue for a background writer thread, or 0 to write on the caller's thread
+			 * @param	table		Segment table to add rows to instead of formatting them, writing to out; or null
+			 */
+			SegmentWriter(OutputStream out, int bufferSize, int queueSize, SegmentTableWriter table)
+			{
+				this.out = out;
+				this.buffer = new byte[Math.max(bufferSize, 1024)];
+				this.table = table;
+
+				DecimalFormatSymbols symbols = new DecimalFormatSymbols();
+				this.plainDigits = symbols.getDecimalSeparator() == '.' && symbols.getMinusSign() == '-' && symbols.getZeroDigit() == '0';
+
+				if(queueSize <= 0)
+				{
+					writerThread = null;
+					return;
+				}
+
+				ringData = new Object[queueSize];
+				ringStarts = new int[queueSize];
+				ringStops = new int[queueSize];
+				ringPositions = new long[queueSize];
+				ringNormal = new float[queueSize];
+				ringTumor = new float[queueSize];
+				ringLog2 = new double[queueSize];
+				ringGC = new float[queueSize];
+
+				writerThread = VarScan.daemonThreadFactory("segment-writer").newThread(new Runnable() {
+					public void run() {
+						drainQueue();
+					}
+				});
+				writerThread.start();
+			}
+
+			/**
+			 * Opens a file for copynumber segment rows
+			 *
+			 * @param	fileName	The file to write
+			 * @param	bufferSize	Size in bytes of the output buffer
+			 * @param	queueSize	Writes to queue for a background writer thread, or 0 to write on the caller's thread
+			 * @param	bgzfThreads	Threads for compressing the file as BGZF with a tabix index, or 0 to write it plain
+			 * @param	log			Stream for the warning when BGZF rows cannot be indexed
+			 * @return	a writer for the file
+			 */
+			static SegmentWriter open(String fileName, int bufferSize, int queueSize, int bgzfThreads, PrintStream log) throws IOException
+			{
+				if(bgzfThreads > 0)
+					return new SegmentWriter(new IndexedBgzfOutputStream(fileName, TabixIndex.forCopynumber(), bgzfThreads, log), bufferSize, queueSize);
+				return new SegmentWriter(new FileOutputStream(fileName), bufferSize, queueSize);
+			}
+
+			/**
+			 * Opens a file for copynumber segments in the binary SegmentTable format
+			 *
+			 * @param	fileName	The file to write
+			 * @param	bufferSize	Size in bytes of the output buffer
+			 * @param	queueSize	Writes to queue for a background writer thread, or 0 to write on the caller's thread
+			 * @return	a writer for the file
+			 */
+			static SegmentWriter openTable(String fileName, int bufferSize, int queueSize) throws IOException
+			{
+				OutputStream out = new BufferedOutputStream(new FileOutputStream(fileName), Math.max(bufferSize, 1024));
+				return new SegmentWriter(out, 0, queueSize, new SegmentTableWriter(out, SegmentTableWriter.DEFAULT_ROW_GROUP_SIZE));
+			}
+
+			/**
+			 * Creates a writer for rows to be appended to this one later with write(SegmentWriter)
+			 *
+			 * @param	out			Stream for the rows as text, unless this writer writes a segment table
+			 * @param	bufferSize	Size in bytes of the output buffer
+			 * @return	a writer that formats rows into out, or keeps them in memory if this writer writes a segment table
+			 */
+			SegmentWriter forChunk(ByteArrayOutputStream out, int bufferSize)
+			{
+				return new SegmentWriter(out, bufferSize, 0, (table != null) ? new SegmentTableWriter() : null);
+			}
+
+			/**
+			 * Writes a line of text, such as the header
+			 *
+			 * @param	line	The line, without a line separator
+			 */
+			void println(String line)
+			{
+				if(table != null)
+					return;
+
+				byte[] text = line.getBytes();
+				byte[] bytes = Arrays.copyOf(text, text.length + LINE_SEPARATOR.length);
+				System.arraycopy(LINE_SEPARATOR, 0, bytes, text.length, LINE_SEPARATOR.length);
+
+				if(writerThread != null)
+					enqueue(bytes, 0, 0, 0, 0, 0, 0, 0);
+				else
+					write(bytes);
+			}
+
+			/**
+			 * Writes a segment from a CopySegmenter
+			 *
+			 * @param	segment	The segment
+			 */
+			public void segment(CopySegment segment)
+			{
+				writeRow(segment.getChrom(), segment.getStart(), segment.getStop(), segment.getPositions(), segment.getNormalDepth(), segment.getTumorDepth(), segment.getLog2Ratio(), segment.getGCContent());
+			}
+
+			/**
+			 * Writes a segment row with the values of a CopySegment, as when converting a segment table back to text
+			 */
+			void writeRow(String copyChrom, int copyStart, int copyStop, long copyPositions, float avgNormal, float avgTumor, double log2ratio, float gcContent)
+			{
+				if(writerThread != null)
+					enqueue(copyChrom, copyStart, copyStop, copyPositions, avgNormal, avgTumor, log2ratio, gcContent);
+				else
+					formatRow(copyChrom, copyStart, copyStop, copyPositions, avgNormal, avgTumor, log2ratio, gcContent);
+			}
+
+			private void formatRow(String copyChrom, int copyStart, int copyStop, long copyPositions, float avgNormal, float avgTumor, double log2ratio, float gcContent)
+			{
+				if(table != null)
+				{
+					try
+					{
+						table.add(copyChrom, copyStart, copyStop, (int) copyPositions, avgNormal, avgTumor, log2ratio, gcContent);
+					}
+					catch(IOException e)
+					{
+						error = true;
+					}
+					return;
+				}
+
+				if(copyChrom != lastChrom)
+				{
+					lastChrom = copyChrom;
+					lastChromBytes = copyChrom.getBytes();
+				}
+
+				write(lastChromBytes);
+				appendByte('\t');
+				appendLong(copyStart);
+				appendByte('\t');
+				appendLong(copyStop);
+				appendByte('\t');
+				appendLong(copyPositions);
+				appendByte('\t');
+				appendFixed(avgNormal, 1);
+				appendByte('\t');
+				appendFixed(avgTumor, 1);
+				appendByte('\t');
+				appendFixed(log2ratio, 3);
+				appendByte('\t');
+				appendFixed(gcContent, 1);
+				write(LINE_SEPARATOR);
+			}
+
+			/**
+			 * Adds a write to the ring, waiting for a free slot if it is full
+			 */
+			private void enqueue(Object data, int start, int stop, long positions, float normal, float tumor, double log2, float gc)
+			{
+				synchronized(ringLock)
+				{
+					if(ringCount == ringData.length)
+					{
+						stalls++;
+						long stallStart = System.nanoTime();
+						try
+						{
+							while(ringCount == ringData.length)
+								ringLock.wait();
+						}
+						catch(InterruptedException e)
+						{
+							Thread.currentThread().interrupt();
+							error = true;
+							return;
+						}
+						finally
+						{
+							stallNanos += System.nanoTime() - stallStart;
+						}
+					}
+
+					int slot = (ringTail + ringCount) % ringData.length;
+					ringData[slot] = data;
+					ringStarts[slot] = start;
+					ringStops[slot] = stop;
+					ringPositions[slot] = positions;
+					ringNormal[slot] = normal;
+					ringTumor[slot] = tumor;
+					ringLog2[slot] = log2;
+					ringGC[slot] = gc;
+					ringCount++;
+					queuedWrites++;
+					ringLock.notifyAll();
+				}
+			}
+
+			/**
+			 * Writer thread: formats queued writes in batches, releasing their slots after each batch, until closed
+			 */
+			private void drainQueue()
+			{
+				while(true)
+				{
+					int first;
+					int available;
+					synchronized(ringLock)
+					{
+						while(ringCount == 0 && !closing)
+						{
+							try
+							{
+								ringLock.wait();
+							}
+							catch(InterruptedException e)
+							{
+								// Only close() ends the writer, once the ring is drained //
+							}
+						}
+						if(ringCount == 0)
+							break;
+						first = ringTail;
+						available = ringCount;
+					}
+
+					// The slots of this batch are not refilled until they are released below //
+					for(int i = 0; i < available; i++)
+					{
+						int slot = (first + i) % ringData.length;
+						Object data = ringData[slot];
+						if(data instanceof String)
+							formatRow((String) data, ringStarts[slot], ringStops[slot], ringPositions[slot], ringNormal[slot], ringTumor[slot], ringLog2[slot], ringGC[slot]);
+						else if(data instanceof byte[])
+							write((byte[]) data);
+						else if(data instanceof SegmentWriter)
+							writeRows((SegmentWriter) data);
+						else
+							flushStream();
+						ringData[slot] = null;
+					}
+
+					synchronized(ringLock)
+					{
+						ringTail = (first + available) % ringData.length;
+						ringCount -= available;
+						ringLock.notifyAll();
+					}
+				}
+
+				flushStream();
+			}
+
+			/**
+			 * Appends a value as DecimalFormat("#0.0") or ("#0.000") formats it, with a minus sign for any
+			 * negative value, even one that rounds to zero. Values close to halfway between two outputs, and
+			 * large or non-finite ones, are passed to DecimalFormat itself, whose tie-breaking follows the
+			 * shortest decimal form of the double rather than its exact value.
+			 *
+			 * @param	value	The value to format
+			 * @param	digits	1 or 3 fraction digits
+			 */
+			void appendFixed(double value, int digits)
+			{
+				double magnitude = Math.abs(value);
+				long scale = (digits == 1) ? 10 : 1000;
+				double scaled = magnitude * scale;
+				long whole = (long) scaled;
+				double fraction = scaled - whole;
+
+				if(!plainDigits || !(magnitude < FAST_LIMIT) || Math.abs(fraction - 0.5) <= TIE_WINDOW)
+				{
+					write(format(value, digits).getBytes());
+					return;
+				}
+
+				boolean negative = value < 0 || (value == 0 && Double.doubleToRawLongBits(value) != 0);
+				long units = (fraction > 0.5) ? whole + 1 : whole;
+
+				if(negative)
+					appendByte('-');
+				appendLong(units / scale);
+				appendByte('.');
+				long fractionUnits = units % scale;
+				for(long place = scale / 10; place > 0; place /= 10)
+				{
+					appendByte('0' + (int) (fractionUnits / place % 10));
+				}
+			}
+
+			private String format(double value, int digits)
+			{
+				if(digits == 1)
+				{
+					if(oneDigit == null)
+						oneDigit = new DecimalFormat("#0.0");
+					return oneDigit.format(value);
+				}
+
+				if(threeDigits == null)
+					threeDigits = new DecimalFormat("#0.000");
+				return threeDigits.format(value);
+			}
+
+			private void appendLong(long value)
+			{
+				if(value < 0)
+				{
+					write(Long.toString(value).getBytes());
+					return;
+				}
+
+				ensure(20);
+				int digits = 1;
+				for(long rest = value / 10; rest > 0; rest /= 10)
+					digits++;
+				for(int i = count + digits - 1; i >= count; i--)
+				{
+					buffer[i] = (byte) ('0' + value % 10);
+					value /= 10;
+				}
+				count += digits;
+			}
+
+			private void appendByte(int b)
+			{
+				ensure(1);
+				buffer[count++] = (byte) b;
+			}
+
+			private void write(byte[] bytes)
+			{
+				ensure(bytes.length);
+				System.arraycopy(bytes, 0, buffer, count, bytes.length);
+				count += bytes.length;
+			}
+
+			private void ensure(int length)
+			{
+				if(count + length > buffer.length)
+				{
+					flushBuffer();
+					if(length > buffer.length)
+						buffer = new byte[length];
+				}
+			}
+
+			/**
+			 * Writes the rows of a writer from forChunk(), after this writer's own. Flush it first.
+			 *
+			 * @param	rows	A writer from forChunk()
+			 */
+			void write(SegmentWriter rows)
+			{
+				if(writerThread != null)
+					enqueue(rows, 0, 0, 0, 0, 0, 0, 0);
+				else
+					writeRows(rows);
+			}
+
+			private void writeRows(SegmentWriter rows)
+			{
+				if(table == null)
+				{
+					writeRows((ByteArrayOutputStream) rows.out);
+					return;
+				}
+
+				try
+				{
+					table.addRows(rows.table);
+				}
+				catch(IOException e)
+				{
+					error = true;
+				}
+			}
+
+			private void writeRows(ByteArrayOutputStream rows)
+			{
+				flushBuffer();
+				try
+				{
+					rows.writeTo(out);
+				}
+				catch(IOException e)
+				{
+					error = true;
+				}
+			}
+
+			private void flushBuffer()
+			{
+				if(count == 0)
+					return;
+				try
+				{
+					out.write(buffer, 0, count);
+				}
+				catch(IOException e)
+				{
+					error = true;
+				}
+				count = 0;
+			}
+
+			/**
+			 * Flushes the rows written so far to the underlying stream; with a write queue, once the writer thread reaches it
+			 */
+			void flush()
+			{
+				if(writerThread != null)
+					enqueue(null, 0, 0, 0, 0, 0, 0, 0);
+				else
+					flushStream();
+			}
+
+			private void flushStream()
+			{
+				flushBuffer();
+				try
+				{
+					out.flush();
+				}
+				catch(IOException e)
+				{
+					error = true;
+				}
+			}
+
+			/**
+			 * Writes out all rows, waiting for the writer thread to finish if there is one, and closes the stream
+			 */
+			void close()
+			{
+				if(writerThread != null)
+				{
+					synchronized(ringLock)
+					{
+						closing = true;
+						ringLock.notifyAll();
+					}
+
+					boolean interrupted = false;
+					while(writerThread.isAlive())
+					{
+						try
+						{
+							writerThread.join();
+						}
+						catch(InterruptedException e)
+						{
+							interrupted = true;
+						}
+					}
+					if(interrupted)
+						Thread.currentThread().interrupt();
+				}
+				else
+				{
+					flushStream();
+				}
+
+				try
+				{
+					if(table != null)
+						table.finish();
+				}
+				catch(IOException e)
+				{
+					error = true;
+				}
+
+				try
+				{
+					out.close();
+				}
+				catch(IOException e)
+				{
+					error = true;
+				}
+			}
+
+			/**
+			 * @return	true if a write to the underlying stream has failed; call after close()
+			 */
+			boolean checkError()
+			{
+				return error;
+			}
+
+			/**
+			 * @return	the number of writes that went through the write queue
+			 */
+			long getQueuedWrites()
+			{
+				return queuedWrites;
+			}
+
+			/**
+			 * @return	the number of writes that waited for the writer thread because the write queue was full
+			 */
+			long getStalls()
+			{
+				return stalls;
+			}
+
+			/**
+			 * @return	total time in milliseconds spent waiting for the writer thread
+			 */
+			long getStallMillis()
+			{
+				return stallNanos / 1000000;
+			}
+		}
+	}
+
+	public static class FishersExact {
+		private static final boolean DEBUG = false;
+		int maxSize;
+
+		// Process-wide log-factorial table: f[i] = log(i!). Readers take an immutable snapshot, //
+		// writers replace it with a larger copy under the class lock (copy-on-grow) //
+		private static volatile double[] sharedFactorials = new double[] {0.0};
+
+		// Beyond this size log(n!) comes from Stirling's series instead of the table //
+		private static final int MAX_TABLE_SIZE = 1 << 20;
+
+		// Scaled tail terms are renormalised above this value to stay within double range //
+		private static final double RESCALE_ABOVE = 1e200;
+
+		// Tail summation stops once the remaining terms cannot change the sum by more than this //
+		private static final double TAIL_EPSILON = 1e-17;
+
+		// The normal approximation is only used when every cell expected under independence reaches this count //
+		static final double MIN_EXPECTED_CELL = 10;
+
+
+		/**
+		 * constructor for FisherExact table
+		 *
+		 * @param maxSize is the maximum sum that will be encountered by the table (a+b+c+d)
+		 */
+		public FishersExact(int maxSize) {
+			this.maxSize = maxSize;
+			logFactorials(maxSize);
+		}
+
+		/**
+		 * Returns a snapshot of the shared log-factorial table covering at least n, growing it if needed.
+		 * The table stops growing at MAX_TABLE_SIZE; use logFactorial() for lookups that may lie beyond it.
+		 *
+		 * @param n     the largest table sum (a+b+c+d) that will be looked up
+		 * @return array f where f[i] = log(i!) for all i <= n, up to MAX_TABLE_SIZE
+		 */
+		static double[] logFactorials(int n) {
+			double[] f = sharedFactorials;
+			n = Math.min(n, MAX_TABLE_SIZE - 1);
+			if (n < f.length) {
+				return f;
+			}
+
+			synchronized (FishersExact.class) {
+				f = sharedFactorials;
+				if (n >= f.length) {
+					// Grow geometrically so that slowly increasing depths don't trigger repeated copies //
+					int newSize = Math.min(Math.max(n + 1, 2 * f.length), MAX_TABLE_SIZE);
+					double[] grown = Arrays.copyOf(f, newSize);
+					for (int i = f.length; i < newSize; i++) {
+						grown[i] = grown[i - 1] + Math.log(i);
+					}
+					sharedFactorials = grown;
+					f = grown;
+				}
+			}
+			return f;
+		}
+
+		/**
+		 * Returns log(n!) from a log-factorial snapshot, or from Stirling's series when n is beyond it
+		 *
+		 * @param f     log-factorial table snapshot
+		 * @param n     a non-negative integer
+		 * @return log(n!)
+		 */
+		static double logFactorial(double[] f, int n) {
+			if (n < f.length) {
+				return f[n];
+			}
+
+			// log(n!) = n log n - n + log(2 pi n) / 2 + 1/(12n) - 1/(360n^3) + 1/(1260n^5) //
+			double x = n;
+			double x2 = x * x;
+			return x * Math.log(x) - x + 0.5 * Math.log(2 * Math.PI * x) + (1.0 / 12.0 - (1.0 / 360.0 - 1.0 / (1260.0 * x2)) / x2) / x;
+		}
+
+		/**
+		 * calculates the P-value for this specific state
+		 *
+		 * @param a     a, b, c, d are the four cells in a 2x2 matrix
+		 * @param b
+		 * @param c
+		 * @param d
+		 * @return the P-value
+		 */
+		public final double getP(int a, int b, int c, int d) {
+			return getP(logFactorials(a + b + c + d), a, b, c, d);
+		}
+
+		/**
+		 * calculates the P-value for this specific state using a log-factorial snapshot
+		 *
+		 * @param f     log-factorial table covering a+b+c+d
+		 * @param a     a, b, c, d are the four cells in a 2x2 matrix
+		 * @param b
+		 * @param c
+		 * @param d
+		 * @return the P-value
+		 */
+		private static double getP(double[] f, int a, int b, int c, int d) {
+			try
+			{
+				int n = a + b + c + d;
+				double p;
+				p = logP(f, a, b, c, d);
+				return Math.exp(p);
+			}
+			catch(Exception e)
+			{
+				return Double.NaN;
+			}
+
+		}
+
+		/**
+		 * calculates the log P-value for this specific state
+		 *
+		 * @param f     log-factorial table snapshot
+		 * @param a     a, b, c, d are the four cells in a 2x2 matrix
+		 * @param b
+		 * @param c
+		 * @param d
+		 * @return the natural log of the P-value
+		 */
+		private static double logP(double[] f, int a, int b, int c, int d) {
+			int n = a + b + c + d;
+			return (logFactorial(f, a + b) + logFactorial(f, c + d) + logFactorial(f, a + c) + logFactorial(f, b + d))
+				- (logFactorial(f, a) + logFactorial(f, b) + logFactorial(f, c) + logFactorial(f, d) + logFactorial(f, n));
+		}
+
+		/**
+		 * Sums one tail of the Fisher Exact test in log space.
+		 *
+		 * Each term is derived from the previous one by the hypergeometric ratio, and terms are kept scaled
+		 * relative to a running reference so that neither they nor the sum under- or overflow. The terms are
+		 * log-concave, so once they start falling the rest of the tail is bounded by a geometric series and
+		 * summation stops when that bound is negligible.
+		 *
+		 * @param f     log-factorial table snapshot
+		 * @param a     a, b, c, d are the four cells in a 2x2 matrix
+		 * @param b
+		 * @param c
+		 * @param d
+		 * @param rightTail		true to sum tables with increasing a, false for decreasing a
+		 * @param logThreshold	stop once the partial sum reaches exp(logThreshold)
+		 * @return the natural log of the tail P-value, or of a partial sum >= exp(logThreshold)
+		 */
+		private static double logTailedP(double[] f, int a, int b, int c, int d, boolean rightTail, double logThreshold) {
+			if (a < 0 || b < 0 || c < 0 || d < 0) {
+				return Double.NaN;
+			}
+
+			double logRef = logP(f, a, b, c, d);
+			double term = 1.0;
+			double sum = 1.0;
+			double limit = Math.exp(logThreshold - logRef);
+			int steps = rightTail ? Math.min(b, c) : Math.min(a, d);
+
+			for (int i = 0; i < steps && sum < limit; i++) {
+				double ratio;
+				if (rightTail) {
+					ratio = ((double) b * c) / ((double) (a + 1) * (d + 1));
+					a++; b--; c--; d++;
+				}
+				else {
+					ratio = ((double) a * d) / ((double) (b + 1) * (c + 1));
+					a--; b++; c++; d--;
+				}
+
+				term *= ratio;
+				sum += term;
+
+				if (term > RESCALE_ABOVE) {
+					logRef += Math.log(term);
+					sum /= term;
+					term = 1.0;
+					limit = Math.exp(logThreshold - logRef);
+				}
+
+				if (ratio < 1.0 && term * ratio < (1.0 - ratio) * sum * TAIL_EPSILON) {
+					break;
+				}
+			}
+
+			return logRef + Math.log(sum);
+		}
+
+		/**
+		 * Calculates the one-tail P-value for the Fisher Exact test.  Determines whether to calculate the right- or left-
+		 * tail, thereby always returning the smallest p-value.
+		 *
+		 * @param a     a, b, c, d are the four cells in a 2x2 matrix
+		 * @param b
+		 * @param c
+		 * @param d
+		 * @return one-tailed P-value (right or left, whichever is smallest)
+		 */
+		public final double getCumlativeP(int a, int b, int c, int d) {
+			int min, i;
+			double[] f = logFactorials(a + b + c + d);
+			double p = 0;
+
+			p += getP(f, a, b, c, d);
+			if (DEBUG) {System.out.println("p = " + p);}
+			if ((a * d) >= (b * c)) {
+				if (DEBUG) {System.out.println("doing R-tail: a=" + a + " b=" + b + " c=" + c + " d=" + d);}
+				min = (c < b) ? c : b;
+				for (i = 0; i < min; i++) {
+					if (DEBUG) {System.out.print("doing round " + i);}
+					p += getP(f, ++a, --b, --c, ++d);
+					if (DEBUG) {System.out.println("\ta=" + a + " b=" + b + " c=" + c + " d=" + d);}
+				}
+				System.out.println("");
+			}
+			if ((a * d) < (b * c)) {
+				if (DEBUG) {System.out.println("doing L-tail: a=" + a + " b=" + b + " c=" + c + " d=" + d);}
+				min = (a < d) ? a : d;
+				for (i = 0; i < min; i++) {
+					if (DEBUG) {System.out.print("doing round " + i);}
+					double pTemp = getP(f, --a, ++b, ++c, --d);
+					if (DEBUG) {System.out.print("\tpTemp = " + pTemp);}
+					p += pTemp;
+					if (DEBUG) {System.out.println("\ta=" + a + " b=" + b + " c=" + c + " d=" + d);}
+				}
+			}
+			return p;
+		}
+
+		/**
+		 * Calculates the right-tail P-value for the Fisher Exact test.
+		 *
+		 * @param a     a, b, c, d are the four cells in a 2x2 matrix
+		 * @param b
+		 * @param c
+		 * @param d
+		 * @return one-tailed P-value (right-tail)
+		 */
+		public final double getRightTailedP(int a, int b, int c, int d) {
+			return Math.exp(logTailedP(logFactorials(a + b + c + d), a, b, c, d, true, Double.POSITIVE_INFINITY));
+		}
+
+		/**
+		 * Calculates the left-tail P-value for the Fisher Exact test.
+		 *
+		 * @param a     a, b, c, d are the four cells in a 2x2 matrix
+		 * @param b
+		 * @param c
+		 * @param d
+		 * @return one-tailed P-value (left-tail)
+		 */
+		public final double getLeftTailedP(int a, int b, int c, int d) {
+			return Math.exp(logTailedP(logFactorials(a + b + c + d), a, b, c, d, false, Double.POSITIVE_INFINITY));
+		}
+
+		/**
+		 * Calculates the right-tail P-value only as far as needed to compare it against a threshold.
+		 * Summing stops as soon as the partial tail reaches the threshold.
+		 *
+		 * @param a     a, b, c, d are the four cells in a 2x2 matrix
+		 * @param b
+		 * @param c
+		 * @param d
+		 * @param threshold	the value the tail is compared against
+		 * @return the exact right-tail P-value if it is below threshold, otherwise a partial sum that is >= threshold
+		 */
+		public final double getRightTailedP(int a, int b, int c, int d, double threshold) {
+			return Math.exp(logTailedP(logFactorials(a + b + c + d), a, b, c, d, true, Math.log(threshold)));
+		}
+
+		/**
+		 * Calculates the left-tail P-value only as far as needed to compare it against a threshold.
+		 * Summing stops as soon as the partial tail reaches the threshold.
+		 *
+		 * @param a     a, b, c, d are the four cells in a 2x2 matrix
+		 * @param b
+		 * @param c
+		 * @param d
+		 * @param threshold	the value the tail is compared against
+		 * @return the exact left-tail P-value if it is below threshold, otherwise a partial sum that is >= threshold
+		 */
+		public final double getLeftTailedP(int a, int b, int c, int d, double threshold) {
+			return Math.exp(logTailedP(logFactorials(a + b + c + d), a, b, c, d, false, Math.log(threshold)));
+		}
+
+		/**
+		 * Calculates the natural log of the right-tail P-value, which stays finite where the P-value underflows.
+		 *
+		 * @param a     a, b, c, d are the four cells in a 2x2 matrix
+		 * @param b
+		 * @param c
+		 * @param d
+		 * @return log of the one-tailed P-value (right-tail)
+		 */
+		public final double getLogRightTailedP(int a, int b, int c, int d) {
+			return logTailedP(logFactorials(a + b + c + d), a, b, c, d, true, Double.POSITIVE_INFINITY);
+		}
+
+		/**
+		 * Calculates the natural log of the left-tail P-value, which stays finite where the P-value underflows.
+		 *
+		 * @param a     a, b, c, d are the four cells in a 2x2 matrix
+		 * @param b
+		 * @param c
+		 * @param d
+		 * @return log of the one-tailed P-value (left-tail)
+		 */
+		public final double getLogLeftTailedP(int a, int b, int c, int d) {
+			return logTailedP(logFactorials(a + b + c + d), a, b, c, d, false, Double.POSITIVE_INFINITY);
+		}
+
+		/**
+		 * Calculates right-tail P-values for a batch of 2x2 tables given as parallel arrays.
+		 *
+		 * @param a     a, b, c, d hold the four cells of each table
+		 * @param b
+		 * @param c
+		 * @param d
+		 * @param p     receives the one-tailed P-value (right-tail) of each table
+		 */
+		public final void getRightTailedP(int[] a, int[] b, int[] c, int[] d, double[] p) {
+			getTailedP(a, b, c, d, p, true);
+		}
+
+		/**
+		 * Calculates left-tail P-values for a batch of 2x2 tables given as parallel arrays.
+		 *
+		 * @param a     a, b, c, d hold the four cells of each table
+		 * @param b
+		 * @param c
+		 * @param d
+		 * @param p     receives the one-tailed P-value (left-tail) of each table
+		 */
+		public final void getLeftTailedP(int[] a, int[] b, int[] c, int[] d, double[] p) {
+			getTailedP(a, b, c, d, p, false);
+		}
+
+		/**
+		 * Evaluates one tail for a batch of tables. The log-factorial table is grown once for the
+		 * largest table, and tables are visited in order of size so lookups stay in nearby entries.
+		 */
+		private static void getTailedP(int[] a, int[] b, int[] c, int[] d, double[] p, boolean rightTail) {
+			int count = p.length;
+			if (a.length != count || b.length != count || c.length != count || d.length != count) {
+				throw new IllegalArgumentException("Fisher batch arrays differ in length");
+			}
+
+			// Sort keys carry the table size in the high bits and the batch index in the low bits //
+			long[] order = new long[count];
+			int maxSize = 0;
+			for (int i = 0; i < count; i++) {
+				int n = Math.max(0, a[i] + b[i] + c[i] + d[i]);
+				maxSize = Math.max(maxSize, n);
+				order[i] = ((long) n << 32) | i;
+			}
+			Arrays.sort(order);
+
+			double[] f = logFactorials(maxSize);
+			for (int k = 0; k < count; k++) {
+				int i = (int) order[k];
+				p[i] = Math.exp(logTailedP(f, a[i], b[i], c[i], d[i], rightTail, Double.POSITIVE_INFINITY));
+			}
+		}
+
+		/**
+		 * Determines whether the normal approximation may stand in for the exact test: every cell expected
+		 * from the margins must be at least MIN_EXPECTED_CELL, so a large total alone is not enough.
+		 *
+		 * @param a     a, b, c, d are the four cells in a 2x2 matrix
+		 * @param b
+		 * @param c
+		 * @param d
+		 * @return true if getNormalRightTailedP and getNormalLeftTailedP are accurate for this table
+		 */
+		public static boolean isNormalApproximable(int a, int b, int c, int d) {
+			double n = (double) a + b + c + d;
+			double minRow = Math.min((double) a + b, (double) c + d);
+			double minColumn = Math.min((double) a + c, (double) b + d);
+			return n > 0 && minRow * minColumn / n >= MIN_EXPECTED_CELL;
+		}
+
+		/**
+		 * Approximates the right-tail P-value with the continuity-corrected normal approximation to the
+		 * hypergeometric distribution of a. Only accurate for tables that pass isNormalApproximable.
+		 *
+		 * @param a     a, b, c, d are the four cells in a 2x2 matrix
+		 * @param b
+		 * @param c
+		 * @param d
+		 * @return approximate one-tailed P-value (right-tail), or NaN if the margins leave a fixed
+		 */
+		public final double getNormalRightTailedP(int a, int b, int c, int d) {
+			double n = (double) a + b + c + d;
+			double mean = ((double) a + b) * ((double) a + c) / n;
+			double variance = ((double) a + b) * ((double) c + d) * ((double) a + c) * ((double) b + d) / (n * n * (n - 1));
+			if (!(variance > 0)) {
+				return Double.NaN;
+			}
+			return upperNormalTail((a - 0.5 - mean) / Math.sqrt(variance));
+		}
+
+		/**
+		 * Approximates the left-tail P-value with the continuity-corrected normal approximation to the
+		 * hypergeometric distribution of a. Only accurate for tables that pass isNormalApproximable.
+		 *
+		 * @param a     a, b, c, d are the four cells in a 2x2 matrix
+		 * @param b
+		 * @param c
+		 * @param d
+		 * @return approximate one-tailed P-value (left-tail), or NaN if the margins leave a fixed
+		 */
+		public final double getNormalLeftTailedP(int a, int b, int c, int d) {
+			double n = (double) a + b + c + d;
+			double mean = ((double) a + b) * ((double) a + c) / n;
+			double variance = ((double) a + b) * ((double) c + d) * ((double) a + c) * ((double) b + d) / (n * n * (n - 1));
+			if (!(variance > 0)) {
+				return Double.NaN;
+			}
+			return upperNormalTail((mean - a - 0.5) / Math.sqrt(variance));
+		}
+
+		/**
+		 * Standard normal upper tail Q(z) = erfc(z / sqrt(2)) / 2, using the Chebyshev fit to erfc
+		 * from Numerical Recipes (fractional error below 1.2e-7 everywhere)
+		 *
+		 * @param z     standard normal deviate
+		 * @return P(Z >= z)
+		 */
+		private static double upperNormalTail(double z) {
+			double x = Math.abs(z) / Math.sqrt(2.0);
+			double t = 1.0 / (1.0 + 0.5 * x);
+			double erfc = t * Math.exp(-x * x - 1.26551223 + t * (1.00002368 + t * (0.37409196 + t * (0.09678418 +
+				t * (-0.18628806 + t * (0.27886807 + t * (-1.13520398 + t * (1.48851587 + t * (-0.82215223 + t * 0.17087277)))))))));
+			return (z >= 0) ? 0.5 * erfc : 1.0 - 0.5 * erfc;
+		}
+
+
+		/**
+		 *   Calculates the two-tailed P-value for the Fisher Exact test.
+		 *
+		 *   In order for a table under consideration to have its p-value included
+		 *   in the final result, it must have a p-value less than the original table's P-value, i.e.
+		 *   Fisher's exact test computes the probability, given the observed marginal
+		 *   frequencies, of obtaining exactly the frequencies observed and any configuration more extreme.
+		 *   By "more extreme," we mean any configuration (given observed marginals) with a smaller probability of
+		 *   occurrence in the same direction (one-tailed) or in both directions (two-tailed).
+		 *
+		 * @param a     a, b, c, d are the four cells in a 2x2 matrix
+		 * @param b
+		 * @param c
+		 * @param d
+		 * @return two-tailed P-value
+		 */
+		public final double getTwoTailedP(int a, int b, int c, int d) {
+			int min, i;
+			double[] f = logFactorials(a + b + c + d);
+			double p = 0;
+
+			double baseP = getP(f, a, b, c, d);
+//         in order for a table under consideration to have its p-value included
+//         in the final result, it must have a p-value less than the baseP, i.e.
+//         Fisher's exact test computes the probability, given the observed marginal
+//         frequencies, of obtaining exactly the frequencies observed and any configuration more extreme.
+//         By "more extreme," we mean any configuration (given observed marginals) with a smaller probability of
+//         occurrence in the same direction (one-tailed) or in both directions (two-tailed).
+
+			if (DEBUG) {System.out.println("baseP = " + baseP);}
+			int initialA = a, initialB = b, initialC = c, initialD = d;
+			p += baseP;
+			if (DEBUG) {System.out.println("p = " + p);}
+			if (DEBUG) {System.out.println("Starting with R-tail: a=" + a + " b=" + b + " c=" + c + " d=" + d);}
+			min = (c < b) ? c : b;
+			for (i = 0; i < min; i++) {
+				if (DEBUG) {System.out.print("doing round " + i);}
+				double tempP = getP(f, ++a, --b, --c, ++d);
+				if (tempP <= baseP) {
+					if (DEBUG) {System.out.print("\ttempP (" + tempP + ") is less than baseP (" + baseP + ")");}
+					p += tempP;
+				}
+				if (DEBUG) {System.out.println(" a=" + a + " b=" + b + " c=" + c + " d=" + d);}
+			}
+
+			// reset the values to their original so we can repeat this process for the other side
+			a = initialA;
+			b = initialB;
+			c = initialC;
+			d = initialD;
+
+			if (DEBUG) {System.out.println("Now doing L-tail: a=" + a + " b=" + b + " c=" + c + " d=" + d);}
+			min = (a < d) ? a : d;
+			if (DEBUG) {System.out.println("min = " + min);}
+			for (i = 0; i < min; i++) {
+				if (DEBUG) {System.out.print("doing round " + i);}
+				double pTemp = getP(f, --a, ++b, ++c, --d);
+				if (DEBUG) {System.out.println("  pTemp = " + pTemp);}
+				if (pTemp <= baseP) {
+					if (DEBUG) {System.out.print("\ttempP (" + pTemp + ") is less than baseP (" + baseP + ")");}
+					p += pTemp;
+				}
+				if (DEBUG) {System.out.println(" a=" + a + " b=" + b + " c=" + c + " d=" + d);}
+			}
+			return p;
+		}
+
+//		public static void main(String[] args) {
+//
+//			int[][] argInts = new int[15][4];
+//			argInts[0] = new int[]{2, 3, 6, 4};
+//			argInts[1] = new int[]{2, 1, 3, 0};
+//			argInts[2] = new int[]{3, 0, 2, 1};
+//			argInts[3] = new int[]{1, 2, 0, 3};
+//			argInts[4] = new int[]{3, 1, 1, 3};
+//			argInts[5] = new int[]{1, 3, 3, 1};
+//			argInts[6] = new int[]{0, 1, 1, 0};
+//			argInts[7] = new int[]{1, 0, 0, 1};
+//			argInts[8] = new int[]{11, 0, 0, 6};
+//			argInts[9] = new int[]{10, 1, 1, 5};
+//			argInts[10] = new int[]{5, 6, 6, 0};
+//			argInts[11] = new int[]{9, 2, 2, 4};
+//			argInts[12] = new int[]{6, 5, 5, 1};
+//			argInts[13] = new int[]{8, 3, 3, 3};
+//			argInts[14] = new int[]{7, 4, 4, 2};
+//
+//			net.sf.varscan.FishersExact fe = new net.sf.varscan.FishersExact(100);
+//
+//			for (int i = 0; i < argInts.length; i++) {
+//				System.out.println("\na=" + argInts[i][0] + " b=" + argInts[i][1] + " c=" + argInts[i][2] + " d=" + argInts[i][3]);
+//				System.out.print("*****Original algorithm: ");
+//				double cumulativeP = fe.getCumlativeP(argInts[i][0], argInts[i][1], argInts[i][2], argInts[i][3]);
+//				System.out.println("\tcumulativeP = " + cumulativeP);
+//
+//				System.out.print("*****Left Tailed: ");
+//				double leftTailedP = fe.getLeftTailedP(argInts[i][0], argInts[i][1], argInts[i][2], argInts[i][3]);
+//				System.out.println("\tleftTailedP = " + leftTailedP);
+//
+//				System.out.print("*****Right Tailed: ");
+//				double rightTailedP = fe.getRightTailedP(argInts[i][0], argInts[i][1], argInts[i][2], argInts[i][3]);
+//				System.out.println("\trightTailedP = " + rightTailedP);
+//
+//				System.out.print("*****Two Tailed: ");
+//				double twoTailedP = fe.getTwoTailedP(argInts[i][0], argInts[i][1], argInts[i][2], argInts[i][3]);
+//				System.out.println("\ttwoTailedP = " + twoTailedP);
+//			}
+//		}
+
+	}
+
+
+	/**
+	 * Bounded least-recently-used cache of getSignificance results keyed on the 2x2 table.
+	 *
+	 * The entries are split across STRIPES independently locked stripes, and p-values are calculated
+	 * outside any lock, so that threads sharing the cache only wait on one another to look up or store
+	 * a p-value in the same stripe. Each stripe evicts its own least-recently-used entry.
+	 *
+	 * Optionally, tables whose total read count exceeds approxAbove, and whose expected cells are all large
+	 * enough for FishersExact.isNormalApproximable, are answered with the normal approximation of
+	 * getApproximateSignificance. Every VALIDATE_EVERY-th approximation is checked against the exact test
+	 * and the largest error seen is recorded.
+	 */
+	static public class PValueCache {
+		// Cells are packed 16 bits apiece into the key; larger tables bypass the cache //
+		private static final int MAX_CELL = 0xFFFF;
+
+		private static final int VALIDATE_EVERY = 1000;
+
+		// Number of stripes, a power of two //
+		private static final int STRIPES = 16;
+
+		// Exact p-values are stored as-is; lower bounds from threshold tests are stored negated //
+		private final int maxEntries;
+		private final int approxAbove;
+		private final Stripe[] stripes;
+
+		private long approximated = 0;
+		private long validated = 0;
+		private double maxApproxError = 0;
+		private double maxApproxLog10Error = 0;
+
+		/**
+		 * One stripe of the cache, locked on itself, with the hits and misses of the keys it holds
+		 */
+		private static class Stripe extends LinkedHashMap<Long, Double> {
+			private final int maxEntries;
+			private long hits = 0;
+			private long misses = 0;
+
+			Stripe(int maxEntries) {
+				super(16, 0.75f, true);
+				this.maxEntries = maxEntries;
+			}
+
+			protected boolean removeEldestEntry(Map.Entry<Long, Double> eldest) {
+				return size() > maxEntries;
+			}
+		}
+
+		/**
+		 * constructor for PValueCache
+		 *
+		 * @param maxEntries	the maximum number of p-values held, or 0 to disable caching
+		 */
+		public PValueCache(int maxEntries) {
+			this(maxEntries, 0);
+		}
+
+		/**
+		 * constructor for PValueCache
+		 *
+		 * @param maxEntries	the maximum number of p-values held, or 0 to disable caching
+		 * @param approxAbove	total read count above which p-values are approximated, or 0 to always be exact
+		 */
+		public PValueCache(int maxEntries, int approxAbove) {
+			this.maxEntries = maxEntries;
+			this.approxAbove = approxAbove;
+			this.stripes = new Stripe[STRIPES];
+			for (int i = 0; i < STRIPES; i++) {
+				stripes[i] = new Stripe((maxEntries + STRIPES - 1) / STRIPES);
+			}
+		}
+
+		/**
+		 * Returns the p-value of VarScan.getSignificance for these read counts, computing it only on a miss
+		 *
+		 * @param	expReads1	Reads supporting allele 1 (expected)
+		 * @param	expReads2	Reads supporting allele 2 (expected)
+		 * @param	obsReads1	Reads supporting allele 1 (observed)
+		 * @param	obsReads2	Reads supporting allele 2 (observed)
+		 * @return	p-value 	P-value from Fisher's Exact Test
+		 */
+		public double getSignificance(int expReads1, int expReads2, int obsReads1, int obsReads2) {
+			return getSignificance(expReads1, expReads2, obsReads1, obsReads2, Double.NaN);
+		}
+
+		/**
+		 * Returns VarScan.getSignificance with a threshold for these read counts, computing it only on a miss
+		 *
+		 * @param	expReads1	Reads supporting allele 1 (expected)
+		 * @param	expReads2	Reads supporting allele 2 (expected)
+		 * @param	obsReads1	Reads supporting allele 1 (observed)
+		 * @param	obsReads2	Reads supporting allele 2 (observed)
+		 * @param	threshold	P-value threshold the result will be compared against, or NaN for an exact p-value
+		 * @return	p-value 	P-value if it is below threshold (or NaN), otherwise a lower bound >= threshold
+		 */
+		public double getSignificance(int expReads1, int expReads2, int obsReads1, int obsReads2, double threshold) {
+			long key = packKey(expReads1, expReads2, obsReads1, obsReads2);
+			Stripe stripe = stripes[stripeIndex(key)];
+
+			if (maxEntries <= 0 || !cacheable(expReads1) || !cacheable(expReads2) || !cacheable(obsReads1) || !cacheable(obsReads2)) {
+				synchronized (stripe) {
+					stripe.misses++;
+				}
+				return calculateSignificance(expReads1, expReads2, obsReads1, obsReads2, threshold);
+			}
+
+			synchronized (stripe) {
+				Double cached = stripe.get(Long.valueOf(key));
+				if (cached != null) {
+					double p = cached.doubleValue();
+					if (!(p < 0)) {
+						stripe.hits++;
+						return p;
+					}
+					if (-p >= threshold) {
+						stripe.hits++;
+						return -p;
+					}
+				}
+				stripe.misses++;
+			}
+
+			// Calculate outside the lock; a thread missing on the same table meanwhile computes the same result //
+			double p = calculateSignificance(expReads1, expReads2, obsReads1, obsReads2, threshold);
+
+			// A result at or above the threshold may only be a lower bound //
+			boolean lowerBound = p >= threshold;
+			synchronized (stripe) {
+				Double cached = stripe.get(Long.valueOf(key));
+				if (!lowerBound || cached == null || cached.doubleValue() < 0) {
+					stripe.put(Long.valueOf(key), Double.valueOf(lowerBound ? -p : p));
+				}
+			}
+			return p;
+		}
+
+		/**
+		 * Calculates the p-value without caching, approximating it for large tables if enabled
+		 *
+		 * @param	expReads1	Reads supporting allele 1 (expected)
+		 * @param	expReads2	Reads supporting allele 2 (expected)
+		 * @param	obsReads1	Reads supporting allele 1 (observed)
+		 * @param	obsReads2	Reads supporting allele 2 (observed)
+		 * @param	threshold	P-value threshold the result will be compared against, or NaN for an exact p-value
+		 * @return	p-value 	as from VarScan.getSignificance with or without the threshold
+		 */
+		public double calculateSignificance(int expReads1, int expReads2, int obsReads1, int obsReads2, double threshold) {
+			long totalReads = (long) expReads1 + expReads2 + obsReads1 + obsReads2;
+			if (approxAbove > 0 && totalReads > approxAbove && FishersExact.isNormalApproximable(expReads1, expReads2, obsReads1, obsReads2)) {
+				double p = VarScan.getApproximateSignificance(expReads1, expReads2, obsReads1, obsReads2);
+				if (countApproximation()) {
+					validate(p, VarScan.getSignificance(expReads1, expReads2, obsReads1, obsReads2));
+				}
+				return p;
+			}
+
+			if (Double.isNaN(threshold)) {
+				return VarScan.getSignificance(expReads1, expReads2, obsReads1, obsReads2);
+			}
+			return VarScan.getSignificance(expReads1, expReads2, obsReads1, obsReads2, threshold);
+		}
+
+		// Counts an approximation, returning true for those that are to be validated //
+		private synchronized boolean countApproximation() {
+			return approximated++ % VALIDATE_EVERY == 0;
+		}
+
+		private synchronized void validate(double approximate, double exact) {
+			validated++;
+			maxApproxError = Math.max(maxApproxError, Math.abs(approximate - exact));
+			if (approximate > 0 && exact > 0) {
+				maxApproxLog10Error = Math.max(maxApproxLog10Error, Math.abs(Math.log10(approximate / exact)));
+			}
+		}
+
+		private static long packKey(int expReads1, int expReads2, int obsReads1, int obsReads2) {
+			return ((long) expReads1 << 48) | ((long) expReads2 << 32) | ((long) obsReads1 << 16) | (long) obsReads2;
+		}
+
+		// Spreads keys that differ only in their low cells across the stripes //
+		private static int stripeIndex(long key) {
+			return (int) ((key * 0x9E3779B97F4A7C15L) >>> 60) & (STRIPES - 1);
+		}
+
+		private static boolean cacheable(int reads) {
+			return reads >= 0 && reads <= MAX_CELL;
+		}
+
+		public long getHits() {
+			long hits = 0;
+			for (Stripe stripe : stripes) {
+				synchronized (stripe) {
+					hits += stripe.hits;
+				}
+			}
+			return hits;
+		}
+
+		public long getMisses() {
+			long misses = 0;
+			for (Stripe stripe : stripes) {
+				synchronized (stripe) {
+					misses += stripe.misses;
+				}
+			}
+			return misses;
+		}
+
+		public int getApproxAbove() {
+			return approxAbove;
+		}
+
+		public synchronized long getApproximated() {
+			return approximated;
+		}
+
+		public synchronized long getValidated() {
+			return validated;
+		}
+
+		public synchronized double getMaxApproxError() {
+			return maxApproxError;
+		}
+
+		public synchronized double getMaxApproxLog10Error() {
+			return maxApproxLog10Error;
+		}
+	}
+
+
+	/**
+	 * Bounded cache of the critical tumor depths at which a copy number change-point becomes significant.
+	 *
+	 * For a fixed segment anchor (normal, tumor depth), normal depth and p-value threshold, the right tail
+	 * of the Fisher's exact test falls and the left tail rises as tumor depth grows, so the tumor depths
+	 * that are NOT significant form one interval [lo, hi]. Each interval is found once by binary search,
+	 * after which a change-point test is two integer comparisons.
+	 *
+	 * As in PValueCache, the intervals are held in independently locked stripes and searched for outside
+	 * any lock, so that threads sharing the cache do not serialize on one another's searches.
+	 */
+	static public class CriticalDepthCache {
+		// Depths are packed 21 bits apiece into the key; larger depths are tested directly //
+		private static final int MAX_DEPTH = 0x1FFFFF;
+
+		// Bounds are {lo, hi, limit}; tumor depths above limit were not searched and are tested directly //
+		private static final int[] NO_INTERVAL = new int[] {1, 0, -1};
+
+		// Number of stripes, a power of two //
+		private static final int STRIPES = 16;
+
+		private final double threshold;
+		private final int maxEntries;
+		private final PValueCache pValueCache;
+		private final Stripe[] stripes;
+
+		/**
+		 * One stripe of the cache, locked on itself, with the bounds computed and lookups made for its keys
+		 */
+		private static class Stripe extends LinkedHashMap<Long, int[]> {
+			private final int maxEntries;
+			private long computed = 0;
+			private long lookups = 0;
+
+			Stripe(int maxEntries) {
+				super(16, 0.75f, true);
+				this.maxEntries = maxEntries;
+			}
+
+			protected boolean removeEldestEntry(Map.Entry<Long, int[]> eldest) {
+				return size() > maxEntries;
+			}
+		}
+
+		/**
+		 * constructor for CriticalDepthCache
+		 *
+		 * @param threshold		P-value threshold for a significant change-point
+		 * @param maxEntries	the maximum number of bounds held, or 0 to always test directly
+		 * @param pValueCache	cache used for direct tests
+		 */
+		public CriticalDepthCache(double threshold, int maxEntries, PValueCache pValueCache) {
+			this.threshold = threshold;
+			this.maxEntries = maxEntries;
+			this.pValueCache = pValueCache;
+			this.stripes = new Stripe[STRIPES];
+			for (int i = 0; i < STRIPES; i++) {
+				stripes[i] = new Stripe((maxEntries + STRIPES - 1) / STRIPES);
+			}
+		}
+
+		/**
+		 * Determines whether the change from the segment anchor to this position is significant
+		 *
+		 * @param	copyDepthNormal	Normal depth at the segment anchor
+		 * @param	copyDepthTumor	Tumor depth at the segment anchor
+		 * @param	normalDepth		Normal depth at this position
+		 * @param	tumorDepth		Tumor depth at this position
+		 * @return	true unless the getSignificance p-value is at or above the threshold
+		 */
+		public boolean isSignificant(int copyDepthNormal, int copyDepthTumor, int normalDepth, int tumorDepth) {
+			long key = ((long) copyDepthNormal << 42) | ((long) copyDepthTumor << 21) | (long) normalDepth;
+			Stripe stripe = stripes[PValueCache.stripeIndex(key) & (STRIPES - 1)];
+
+			boolean cached = maxEntries > 0 && cacheable(copyDepthNormal) && cacheable(copyDepthTumor) && cacheable(normalDepth) && tumorDepth >= 0;
+
+			int[] bounds = null;
+			synchronized (stripe) {
+				stripe.lookups++;
+				if (cached) {
+					bounds = stripe.get(Long.valueOf(key));
+				}
+			}
+
+			if (!cached) {
+				return testDirectly(copyDepthNormal, copyDepthTumor, normalDepth, tumorDepth);
+			}
+
+			if (bounds == null) {
+				// Search outside the lock, keeping the bounds of any thread that published first //
+				bounds = findBounds(copyDepthNormal, copyDepthTumor, normalDepth);
+				synchronized (stripe) {
+					int[] published = stripe.get(Long.valueOf(key));
+					if (published == null) {
+						stripe.put(Long.valueOf(key), bounds);
+						stripe.computed++;
+					}
+					else {
+						bounds = published;
+					}
+				}
+			}
+
+			if (tumorDepth > bounds[2]) {
+				return testDirectly(copyDepthNormal, copyDepthTumor, normalDepth, tumorDepth);
+			}
+
+			return (tumorDepth < bounds[0] || tumorDepth > bounds[1]);
+		}
+
+		/**
+		 * Finds the interval of tumor depths that are not significant for this anchor and normal depth
+		 *
+		 * @return	bounds {lo, hi, limit}
+		 */
+		private int[] findBounds(int copyDepthNormal, int copyDepthTumor, int normalDepth) {
+			if (copyDepthNormal == 0) {
+				return NO_INTERVAL;
+			}
+
+			// Start from the tumor depth proportional to the anchor, the least likely to be significant //
+			int limit = 64 * (copyDepthNormal + copyDepthTumor + normalDepth) + 1024;
+			int seed = (int) Math.round((double) copyDepthTumor * normalDepth / copyDepthNormal);
+			if (seed >= limit) {
+				return NO_INTERVAL;
+			}
+
+			if (significant(copyDepthNormal, copyDepthTumor, normalDepth, seed)) {
+				if (seed > 0 && !significant(copyDepthNormal, copyDepthTumor, normalDepth, seed - 1))
+					seed = seed - 1;
+				else if (!significant(copyDepthNormal, copyDepthTumor, normalDepth, seed + 1))
+					seed = seed + 1;
+				else
+					return NO_INTERVAL;
+			}
+
+			// Lowest non-significant depth: bisect [0, seed] //
+			int low = 0;
+			int high = seed;
+			while (low < high) {
+				int mid = (low + high) >>> 1;
+				if (significant(copyDepthNormal, copyDepthTumor, normalDepth, mid))
+					low = mid + 1;
+				else
+					high = mid;
+			}
+			int lo = low;
+
+			// Highest non-significant depth: gallop up from the seed, then bisect //
+			int step = 1;
+			low = seed;
+			high = seed + step;
+			while (high <= limit && !significant(copyDepthNormal, copyDepthTumor, normalDepth, high)) {
+				low = high;
+				step *= 2;
+				high = seed + step;
+			}
+
+			if (high > limit) {
+				// Only depths up to the limit are searched //
+				if (!significant(copyDepthNormal, copyDepthTumor, normalDepth, limit))
+					return new int[] {lo, limit, limit};
+				high = limit;
+			}
+
+			while (high - low > 1) {
+				int mid = (low + high) >>> 1;
+				if (significant(copyDepthNormal, copyDepthTumor, normalDepth, mid))
+					high = mid;
+				else
+					low = mid;
+			}
+
+			return new int[] {lo, low, limit};
+		}
+
+		private boolean significant(int copyDepthNormal, int copyDepthTumor, int normalDepth, int tumorDepth) {
+			return !(pValueCache.calculateSignificance(copyDepthNormal, copyDepthTumor, normalDepth, tumorDepth, threshold) >= threshold);
+		}
+
+		private boolean testDirectly(int copyDepthNormal, int copyDepthTumor, int normalDepth, int tumorDepth) {
+			return !(pValueCache.getSignificance(copyDepthNormal, copyDepthTumor, normalDepth, tumorDepth, threshold) >= threshold);
+		}
+
+		private static boolean cacheable(int depth) {
+			return depth >= 0 && depth <= MAX_DEPTH;
+		}
+
+		public long getComputed() {
+			long computed = 0;
+			for (Stripe stripe : stripes) {
+				synchronized (stripe) {
+					computed += stripe.computed;
+				}
+			}
+			return computed;
+		}
+
+		public long getLookups() {
+			long lookups = 0;
+			for (Stripe stripe : stripes) {
+				synchronized (stripe) {
+					lookups += stripe.lookups;
+				}
+			}
+			return lookups;
+		}
+
+		public double getThreshold() {
+			return threshold;
+		}
+
+		public PValueCache getPValueCache() {
+			return pValueCache;
+		}
+	}
+
+
+	/**
+	 * Change-point caches shared by the samples of a copynumber batch. Samples run with the same p-value
+	 * threshold and cache settings share one CriticalDepthCache and its PValueCache, so that bounds and
+	 * p-values found for one sample are hits for the rest. Both caches lock stripes of their entries
+	 * rather than the whole cache, and the log-factorial table of FishersExact is already shared process-wide.
+	 */
+	static public class SharedCaches {
+		private final LinkedHashMap<String, CriticalDepthCache> caches = new LinkedHashMap<String, CriticalDepthCache>();
+
+		/**
+		 * Gets the caches for these settings, creating them for the first sample that uses them
+		 *
+		 * @param	threshold			P-value threshold for a significant change-point
+		 * @param	pValueCacheSize		Maximum number of p-values held
+		 * @param	criticalCacheSize	Maximum number of critical tumor-depth bounds held
+		 * @param	approxAbove			Total read count above which p-values are approximated, or 0
+		 * @return	Critical-depth cache, whose getPValueCache() is the shared p-value cache
+		 */
+		public synchronized CriticalDepthCache get(double threshold, int pValueCacheSize, int criticalCacheSize, int approxAbove) {
+			String key = threshold + "\t" + pValueCacheSize + "\t" + criticalCacheSize + "\t" + approxAbove;
+			CriticalDepthCache cache = caches.get(key);
+			if (cache == null) {
+				cache = new CriticalDepthCache(threshold, criticalCacheSize, new PValueCache(pValueCacheSize, approxAbove));
+				caches.put(key, cache);
+			}
+			return cache;
+		}
+
+		/**
+		 * Gets every set of caches created so far, in the order they were first used
+		 */
+		public synchronized CriticalDepthCache[] getCaches() {
+			return caches.values().toArray(new CriticalDepthCache[caches.size()]);
+		}
+	}
+
+
+	/**
+	 * A copy number segment: a run of positions on one chromosome whose normal and tumor depths do not
+	 * change significantly, with the averages and log2 ratio that the copynumber output reports.
+	 */
+	static public class CopySegment {
+		private final String chrom;
+		private final int chromId;
+		private final int start;
+		private final int stop;
+		private final long positions;
+		private final long positionsGC;
+		private final long sumNormal;
+		private final long sumTumor;
+		private final float normalDepth;
+		private final float tumorDepth;
+		private final float gcContent;
+		private final double log2Ratio;
+
+		/**
+		 * constructor for CopySegment
+		 *
+		 * @param chrom			the chromosome
+		 * @param chromId		the chromosome's id in the segmenter's registry
+		 * @param start			the first position
+		 * @param stop			the last position
+		 * @param positions		the number of positions in the segment
+		 * @param positionsGC	the number of them with a G or C reference base
+		 * @param sumNormal		the normal depth summed over the positions
+		 * @param sumTumor		the tumor depth summed over the positions
+		 * @param dataRatio		the normal/tumor input data ratio, applied to the tumor depth for the log2 ratio
+		 */
+		public CopySegment(String chrom, int chromId, int start, int stop, long positions, long positionsGC, long sumNormal, long sumTumor, double dataRatio) {
+			this.chrom = chrom;
+			this.chromId = chromId;
+			this.start = start;
+			this.stop = stop;
+			this.positions = positions;
+			this.positionsGC = positionsGC;
+			this.sumNormal = sumNormal;
+			this.sumTumor = sumTumor;
+
+			// Calculate average depth //
+			normalDepth = (float) sumNormal / (float) positions;
+			tumorDepth = (float) sumTumor / (float) positions;
+			// Adjust tumor depth for ratio
+			float adjustedTumorDepth = (float) dataRatio * (float) tumorDepth;
+
+			gcContent = (float) positionsGC / (float) positions * 100;
+
+			// Determine ratio and diff //
+			if (normalDepth >= 0.01 && tumorDepth >= 0.01) {
+				float tumorNormalRatio = adjustedTumorDepth / normalDepth;
+				log2Ratio = Math.log(tumorNormalRatio) / Math.log(2);
+			}
+			else if (tumorDepth >= 0.01) {
+				// If only tumor has coverage, handle it //
+				log2Ratio = 2.00;
+			}
+			else {
+				// If only normal has coverage, mark as homozygyous deletion //
+				log2Ratio = -2.00;
+			}
+		}
+
+		/**
+		 * @param minCoverage	the minimum average depth
+		 * @return	true if either sample's average depth meets the minimum, so the segment is reported
+		 */
+		public boolean hasCoverage(int minCoverage) {
+			return normalDepth >= minCoverage || tumorDepth >= minCoverage;
+		}
+
+		public String getChrom() {
+			return chrom;
+		}
+
+		public int getChromId() {
+			return chromId;
+		}
+
+		public int getStart() {
+			return start;
+		}
+
+		public int getStop() {
+			return stop;
+		}
+
+		public long getPositions() {
+			return positions;
+		}
+
+		public long getPositionsGC() {
+			return positionsGC;
+		}
+
+		public long getSumNormal() {
+			return sumNormal;
+		}
+
+		public long getSumTumor() {
+			return sumTumor;
+		}
+
+		/**
+		 * @return	the average normal depth
+		 */
+		public float getNormalDepth() {
+			return normalDepth;
+		}
+
+		/**
+		 * @return	the average tumor depth, before the data ratio is applied
+		 */
+		public float getTumorDepth() {
+			return tumorDepth;
+		}
+
+		/**
+		 * @return	the percentage of positions with a G or C reference base
+		 */
+		public float getGCContent() {
+			return gcContent;
+		}
+
+		/**
+		 * @return	the log2 of the ratio-adjusted tumor depth over the normal depth; 2 or -2 if only one sample has reads
+		 */
+		public double getLog2Ratio() {
+			return log2Ratio;
+		}
+	}
+
+
+	/**
+	 * Streaming copy number segmenter. Positions shared by the normal and tumor are pushed in sorted
+	 * order with their base-quality depths; a segment is extended while the positions stay contiguous
+	 * and the depths do not change significantly from its first position, by Fisher's exact test. Each
+	 * finished segment of at least the minimum size with enough average coverage is passed to a
+	 * Listener, such as a Copynumber.SegmentWriter to write it as text or as a SegmentTable.
+	 *
+	 * A segmenter is not thread-safe, but its CriticalDepthCache may be shared.
+	 */
+	static public class CopySegmenter {
+
+		/**
+		 * Receives the segments of a CopySegmenter, in input order
+		 */
+		public interface Listener {
+			void segment(CopySegment segment);
+		}
+
+		private final int minCoverage;
+		private final int minSegmentSize;
+		private final int maxSegmentSize;
+		private final double dataRatio;
+		private final CriticalDepthCache criticalDepths;
+		private final ChromosomeRegistry chroms;
+		private final Listener listener;
+		private final int blankChrom;
+
+		// Statistics counters //
+		private long comparedPositions = 0;
+		private long rawSegments = 0;
+		private long goodSegments = 0;
+
+		// Parameters for copy number calling //
+		private int copyChrom;
+		private int copyStart = 0;
+		private int copyStop = 0;
+		private int copyDepthNormal = 0;
+		private int copyDepthTumor = 0;
+		private long copySumNormal = 0;
+		private long copySumTumor = 0;
+		private long copyPositions = 0;
+		private long copyPositionsGC = 0;
+
+		/**
+		 * constructor for CopySegmenter
+		 *
+		 * @param minCoverage		minimum average depth of either sample for a segment to be reported
+		 * @param minSegmentSize	minimum number of positions for a segment to be reported
+		 * @param maxSegmentSize	number of positions after which a new segment is started
+		 * @param dataRatio			the normal/tumor input data ratio, applied to the tumor depth
+		 * @param criticalDepths	change-point test, with its p-value threshold
+		 * @param chroms			registry of the chromosome ids that positions are given with
+		 * @param listener			receives the segments
+		 */
+		public CopySegmenter(int minCoverage, int minSegmentSize, int maxSegmentSize, double dataRatio, CriticalDepthCache criticalDepths, ChromosomeRegistry chroms, Listener listener) {
+			this.minCoverage = minCoverage;
+			this.minSegmentSize = minSegmentSize;
+			this.maxSegmentSize = maxSegmentSize;
+			this.dataRatio = dataRatio;
+			this.criticalDepths = criticalDepths;
+			this.chroms = chroms;
+			this.listener = listener;
+			this.blankChrom = chroms.id("");
+			this.copyChrom = blankChrom;
+		}
+
+		/**
+		 * Adds a position that both samples share and where the normal has the minimum coverage,
+		 * extending the current segment or reporting it and starting another
+		 *
+		 * @param chromId		the chromosome's id in the registry
+		 * @param position		the position, after the previous one on the chromosome
+		 * @param normalDepth	the normal depth of bases above the minimum quality
+		 * @param tumorDepth	the tumor depth of bases above the minimum quality
+		 * @param isGC			true if the reference base is G or C
+		 */
+		public void add(int chromId, int position, int normalDepth, int tumorDepth, boolean isGC) {
+			comparedPositions++;
+
+			// DETERMINE IF WE CONTINUE THIS REGION OR PROCESS IT AND START A NEW ONE //
+
+			boolean continueFlag = false;
+
+			// If chromosomes differ or contiguity broken, process the region //
+
+			if (position - copyStop > 2 || copyChrom != chromId) {
+				continueFlag = false;
+			}
+			else if (copyPositions >= maxSegmentSize) {
+				continueFlag = false;
+			}
+			else if (Math.abs(copyDepthNormal - normalDepth) <= 2 && Math.abs(copyDepthTumor - tumorDepth) <= 2) {
+				continueFlag = true;
+			}
+			else {
+				// If depth change not significant by Fisher's exact test, continue with region //
+				continueFlag = !criticalDepths.isSignificant(copyDepthNormal, copyDepthTumor, normalDepth, tumorDepth);
+			}
+
+			// If continuing, extend this region and don't process yet //
+
+			if (continueFlag) {
+				copySumNormal += normalDepth;
+				copySumTumor += tumorDepth;
+				copyPositions++;
+				if (isGC)
+					copyPositionsGC++;
+				copyStop = position;
+			}
+
+			// Otherwise, process this region (if it qualifies) and start a new one //
+
+			else {
+				if (copyPositions >= minSegmentSize)
+					reportSegment();
+
+				copyChrom = chromId;
+				copyStart = position;
+				copyStop = position;
+				copyDepthNormal = normalDepth;
+				copyDepthTumor = tumorDepth;
+				copySumNormal = normalDepth;
+				copySumTumor = tumorDepth;
+				copyPositions = 1;
+				copyPositionsGC = isGC ? 1 : 0;
+			}
+		}
+
+		/**
+		 * Ends the current segment, reporting it if it has the minimum size, as at a shared position
+		 * where the normal lacks the minimum coverage
+		 */
+		public void endSegment() {
+			if (copyPositions >= minSegmentSize)
+				reportSegment();
+			reset();
+		}
+
+		/**
+		 * Ends the input, reporting the last segment if it exceeds the minimum size
+		 */
+		public void finish() {
+			if (copyPositions > minSegmentSize)
+				reportSegment();
+			reset();
+		}
+
+		private void reset() {
+			copyChrom = blankChrom;
+			copyStart = 0;
+			copyStop = 0;
+			copyDepthNormal = 0;
+			copyDepthTumor = 0;
+			copySumNormal = 0;
+			copySumTumor = 0;
+			copyPositions = 0;
+			copyPositionsGC = 0;
+		}
+
+		private void reportSegment() {
+			rawSegments++;
+			CopySegment segment = new CopySegment(chroms.name(copyChrom), copyChrom, copyStart, copyStop, copyPositions, copyPositionsGC, copySumNormal, copySumTumor, dataRatio);
+			if (segment.hasCoverage(minCoverage)) {
+				goodSegments++;
+				listener.segment(segment);
+			}
+		}
+
+		/**
+		 * Adds the counters of another segmenter to this one
+		 */
+		void addCounts(CopySegmenter other) {
+			comparedPositions += other.comparedPositions;
+			rawSegments += other.rawSegments;
+			goodSegments += other.goodSegments;
+		}
+
+		/**
+		 * @return	the number of positions added
+		 */
+		public long getComparedPositions() {
+			return comparedPositions;
+		}
+
+		/**
+		 * @return	the number of segments of the minimum size
+		 */
+		public long getRawSegments() {
+			return rawSegments;
+		}
+
+		/**
+		 * @return	the number of segments with enough coverage, which were passed to the listener
+		 */
+		public long getGoodSegments() {
+			return goodSegments;
+		}
+	}
+
+	/**
+	 * Buffered line reader for ASCII input such as pileups. Lines are returned as slices of an internal
+	 * byte buffer rather than decoded into Strings; a slice is only valid until the next call to next().
+	 * Lines end at "\n" or "\r\n". A line longer than the buffer grows it.
+	 */
+	static public class ByteLineReader {
+		public static final int DEFAULT_BUFFER_SIZE = 1 << 20;
+		private static final Charset LATIN1 = Charset.forName("ISO-8859-1");
+
+		private InputStream in;
+		private final boolean fromFile;
+		private byte[] buffer;
+		private int pos = 0;
+		private int limit = 0;
+		private int scan = 0;
+		private int lineStart = 0;
+		private int lineEnd = 0;
+		private boolean eof = false;
+		private long lines = 0;
+		private long firstLineTime = 0;
+		private long bufferOffset = 0;
+		private RegionFilter filter = null;
+
+		// Offset of the first line of each chromosome, recorded on a first pass from the start //
+		private LinkedHashMap<String, Long> chromOffsets = null;
+		private boolean chromOffsetsVirtual = false;
+		private boolean chromOffsetsComplete = false;
+		private boolean recordingChroms = false;
+		private String lastChrom = "";
+
+		/**
+		 * constructor for ByteLineReader
+		 *
+		 * @param in			the stream to read
+		 * @param bufferSize	initial size in bytes of the read buffer
+		 */
+		public ByteLineReader(InputStream in, int bufferSize) {
+			this(in, bufferSize, false);
+		}
+
+		private ByteLineReader(InputStream in, int bufferSize, boolean fromFile) {
+			this.in = in;
+			this.fromFile = fromFile;
+			this.buffer = new byte[Math.max(bufferSize, 1024)];
+		}
+
+		/**
+		 * Opens a file for reading
+		 *
+		 * @param fileName		the file to read
+		 * @param bufferSize	initial size in bytes of the read buffer
+		 * @return	a reader positioned at the start of the file
+		 */
+		public static ByteLineReader open(String fileName, int bufferSize) throws IOException {
+			return open(fileName, bufferSize, 1);
+		}
+
+		/**
+		 * Opens a plain, gzip or BGZF file for reading, detecting compression from its header
+		 *
+		 * @param fileName		the file to read
+		 * @param bufferSize	initial size in bytes of the read buffer
+		 * @param threads		threads for decompressing BGZF blocks
+		 * @return	a reader positioned at the start of the decompressed data
+		 */
+		public static ByteLineReader open(String fileName, int bufferSize, int threads) throws IOException {
+			return new ByteLineReader(openDecompressed(fileName, threads), bufferSize, true);
+		}
+
+		/**
+		 * Opens a plain or BGZF file for reading from an offset recorded in a PileupIndex
+		 *
+		 * @param fileName		the file to read
+		 * @param bufferSize	initial size in bytes of the read buffer
+		 * @param threads		threads for decompressing BGZF blocks
+		 * @param offset		byte offset, or virtual offset if bgzf is set
+		 * @param bgzf			true if the file is BGZF-compressed
+		 * @return	a reader positioned at the offset
+		 */
+		public static ByteLineReader openAt(String fileName, int bufferSize, int threads, long offset, boolean bgzf) throws IOException {
+			return new ByteLineReader(openStreamAt(fileName, threads, offset, bgzf), bufferSize, true);
+		}
+
+		/**
+		 * Opens a plain or BGZF file as a stream of its uncompressed data, from an offset recorded in a PileupIndex
+		 *
+		 * @param fileName		the file to read
+		 * @param threads		threads for decompressing BGZF blocks
+		 * @param offset		byte offset, or virtual offset if bgzf is set
+		 * @param bgzf			true if the file is BGZF-compressed
+		 * @return	a stream positioned at the offset
+		 */
+		static InputStream openStreamAt(String fileName, int threads, long offset, boolean bgzf) throws IOException {
+			return openStreamAt(fileName, null, threads, offset, bgzf);
+		}
+
+		/**
+		 * Opens a plain or BGZF file as a stream of its uncompressed data, from an offset recorded in a PileupIndex,
+		 * inflating BGZF blocks on a shared pool
+		 *
+		 * @param fileName		the file to read
+		 * @param pool			pool for inflating BGZF blocks, or null for one of the stream's own
+		 * @param threads		threads for decompressing BGZF blocks
+		 * @param offset		byte offset, or virtual offset if bgzf is set
+		 * @param bgzf			true if the file is BGZF-compressed
+		 * @return	a stream positioned at the offset
+		 */
+		static InputStream openStreamAt(String fileName, ExecutorService pool, int threads, long offset, boolean bgzf) throws IOException {
+			FileInputStream raw = new FileInputStream(fileName);
+			if (!bgzf) {
+				raw.getChannel().position(offset);
+				return raw;
+			}
+
+			raw.getChannel().position(offset >>> 16);
+			InputStream buffered = new BufferedInputStream(raw, BgzfInputStream.MAX_BLOCK_SIZE);
+			BgzfInputStream in = (pool != null) ? new BgzfInputStream(buffered, pool, threads) : new BgzfInputStream(buffered, threads);
+			for (long skip = offset & 0xFFFF; skip > 0; ) {
+				long skipped = in.skip(skip);
+				if (skipped <= 0) {
+					in.close();
+					throw new EOFException("Index offset is past the end of " + fileName);
+				}
+				skip -= skipped;
+			}
+			return in;
+		}
+
+		/**
+		 * Restricts the lines returned by next() and readLine() to a set of regions
+		 *
+		 * @param filter	the region filter, which may reposition this reader using an index
+		 */
+		public void setFilter(RegionFilter filter) {
+			this.filter = filter;
+		}
+
+		/**
+		 * Continues reading from another stream, discarding any buffered input of the current one
+		 *
+		 * @param next	the stream to read from now
+		 */
+		void reopen(InputStream next) throws IOException {
+			// Offsets in the new stream no longer count from the start of the file //
+			recordingChroms = false;
+			in.close();
+			in = next;
+			pos = limit = scan = 0;
+			lineStart = lineEnd = 0;
+			bufferOffset = 0;
+			eof = false;
+		}
+
+		/**
+		 * Opens a plain, gzip or BGZF file as a stream of its uncompressed data
+		 *
+		 * @param fileName		the file to read
+		 * @param threads		threads for decompressing BGZF blocks
+		 * @return	a BgzfInputStream, GZIPInputStream or plain buffered stream
+		 */
+		static InputStream openDecompressed(String fileName, int threads) throws IOException {
+			BufferedInputStream raw = new BufferedInputStream(new FileInputStream(fileName), BgzfInputStream.MAX_BLOCK_SIZE);
+			byte[] header = new byte[BgzfInputStream.HEADER_SIZE];
+
+			raw.mark(header.length);
+			int length = 0;
+			int read = 0;
+			while (length < header.length && (read = raw.read(header, length, header.length - length)) > 0) {
+				length += read;
+			}
+			raw.reset();
+
+			InputStream in = raw;
+			if (BgzfInputStream.isBgzf(header, length)) {
+				in = new BgzfInputStream(raw, threads);
+			}
+			else if (BgzfInputStream.isGzip(header, length)) {
+				in = new GZIPInputStream(raw, BgzfInputStream.MAX_BLOCK_SIZE);
+			}
+			return in;
+		}
+
+		/**
+		 * Advances to the next line
+		 *
+		 * @return	false at the end of the input
+		 */
+		public boolean next() throws IOException {
+			return (filter != null) ? filter.next(this) : nextLine();
+		}
+
+		/**
+		 * Advances to the next line, ignoring any region filter
+		 *
+		 * @return	false at the end of the input
+		 */
+		boolean nextLine() throws IOException {
+			while (true) {
+				for (; scan < limit; scan++) {
+					if (buffer[scan] == '\n') {
+						setLine(pos, scan);
+						pos = scan = scan + 1;
+						return true;
+					}
+				}
+
+				if (eof) {
+					// Last line without a terminator //
+					if (pos < limit) {
+						setLine(pos, limit);
+						pos = scan = limit;
+						return true;
+					}
+					if (recordingChroms) {
+						recordingChroms = false;
+						chromOffsetsComplete = true;
+					}
+					return false;
+				}
+
+				fill();
+			}
+		}
+
+		private void setLine(int start, int end) {
+			if (end > start && buffer[end - 1] == '\r') {
+				end--;
+			}
+			lineStart = start;
+			lineEnd = end;
+
+			if (lines++ == 0) {
+				firstLineTime = System.nanoTime();
+			}
+			if (recordingChroms) {
+				noteChromosome(start, end);
+			}
+		}
+
+		private void noteChromosome(int start, int end) {
+			int tab = start;
+			while (tab < end && buffer[tab] != '\t') {
+				tab++;
+			}
+			if (tab == end) {
+				return;
+			}
+
+			// Only look the chromosome up when it differs from the last line's //
+			boolean same = (tab - start == lastChrom.length());
+			for (int i = 0; same && i < tab - start; i++) {
+				same = ((buffer[start + i] & 0xFF) == lastChrom.charAt(i));
+			}
+			if (same) {
+				return;
+			}
+
+			lastChrom = new String(buffer, start, tab - start, LATIN1);
+			if (!chromOffsets.containsKey(lastChrom)) {
+				long offset = bufferOffset + start;
+				if (chromOffsetsVirtual) {
+					offset = ((BgzfInputStream) in).virtualOffset(offset);
+				}
+				chromOffsets.put(lastChrom, offset);
+			}
+		}
+
+		/**
+		 * Starts recording where each chromosome first appears, so that seekChromosome() can be used
+		 * once the whole file has been read. Call before reading; gzip files cannot be recorded.
+		 *
+		 * @return	true if offsets are being recorded
+		 */
+		public boolean recordChromosomeOffsets() {
+			if (in instanceof GZIPInputStream) {
+				return false;
+			}
+			chromOffsets = new LinkedHashMap<String, Long>();
+			chromOffsetsVirtual = (in instanceof BgzfInputStream);
+			if (chromOffsetsVirtual) {
+				((BgzfInputStream) in).trackBlocks();
+			}
+			recordingChroms = true;
+			return true;
+		}
+
+		/**
+		 * Takes where each chromosome first appears from the file's index instead of a first pass
+		 *
+		 * @param index		up-to-date index of the file being read
+		 */
+		public void setChromosomeOffsets(PileupIndex index) {
+			chromOffsets = new LinkedHashMap<String, Long>();
+			String[] runChroms = index.runChromosomes();
+			long[] runStarts = index.runOffsets();
+			for (int run = 0; run < runChroms.length; run++) {
+				if (!chromOffsets.containsKey(runChroms[run])) {
+					chromOffsets.put(runChroms[run], runStarts[run]);
+				}
+			}
+			chromOffsetsVirtual = index.isBgzf();
+			chromOffsetsComplete = true;
+			recordingChroms = false;
+		}
+
+		/**
+		 * Repositions at the first line of a chromosome, or at the end of the input if the file lacks it
+		 *
+		 * @param fileName	the file being read
+		 * @param chrom		the chromosome
+		 * @param threads	threads for decompressing BGZF blocks
+		 * @return	false if the chromosome offsets are not known, so the file must be reread from the start
+		 */
+		public boolean seekChromosome(String fileName, String chrom, int threads) throws IOException {
+			if (!chromOffsetsComplete) {
+				return false;
+			}
+
+			Long offset = chromOffsets.get(chrom);
+			if (offset == null) {
+				reopen(new ByteArrayInputStream(new byte[0]));
+			}
+			else {
+				reopen(openStreamAt(fileName, threads, offset, chromOffsetsVirtual));
+			}
+			return true;
+		}
+
+		private void fill() throws IOException {
+			// Keep the partial line, moving it to the front or growing the buffer if it fills it //
+			if (pos > 0) {
+				System.arraycopy(buffer, pos, buffer, 0, limit - pos);
+				bufferOffset += pos;
+				limit -= pos;
+				scan -= pos;
+				pos = 0;
+			}
+			if (limit == buffer.length) {
+				buffer = Arrays.copyOf(buffer, 2 * buffer.length);
+			}
+
+			int read = in.read(buffer, limit, buffer.length - limit);
+			if (read < 0) {
+				eof = true;
+			}
+			else {
+				limit += read;
+			}
+		}
+
+		/**
+		 * @return	the buffer holding the current line
+		 */
+		public byte[] buffer() {
+			return buffer;
+		}
+
+		/**
+		 * @return	offset of the first byte of the current line
+		 */
+		public int lineStart() {
+			return lineStart;
+		}
+
+		/**
+		 * @return	offset just past the last byte of the current line, excluding the terminator
+		 */
+		public int lineEnd() {
+			return lineEnd;
+		}
+
+		/**
+		 * @return	the current line as a String
+		 */
+		public String lineString() {
+			return new String(buffer, lineStart, lineEnd - lineStart, LATIN1);
+		}
+
+		/**
+		 * Reads the next line as a String, like BufferedReader.readLine()
+		 *
+		 * @return	the next line, or null at the end of the input
+		 */
+		public String readLine() throws IOException {
+			if (!next()) {
+				return null;
+			}
+			return lineString();
+		}
+
+		/**
+		 * @return	the offset of the current line in the uncompressed input, from where reading began
+		 */
+		public long lineOffset() {
+			return bufferOffset + lineStart;
+		}
+
+		/**
+		 * @return	the number of lines read so far
+		 */
+		public long getLines() {
+			return lines;
+		}
+
+		/**
+		 * @return	the System.nanoTime() at which the first line was read
+		 */
+		public long getFirstLineTime() {
+			return firstLineTime;
+		}
+
+		/**
+		 * Blocks until the first input (or end of input) arrives, so that processing can start on the
+		 * first byte instead of after a polling interval. If the timeout expires, the read is left
+		 * pending on a daemon thread and the reader must not be used further.
+		 *
+		 * @param timeoutMillis	how long to wait, or 0 to wait indefinitely
+		 * @return	true if input or end of input is available, false if the timeout expired
+		 */
+		public boolean awaitInput(long timeoutMillis) throws IOException {
+			if (pos < limit || eof) {
+				return true;
+			}
+
+			FutureTask<Boolean> firstRead = new FutureTask<Boolean>(new Callable<Boolean>() {
+				public Boolean call() throws IOException {
+					fill();
+					return Boolean.TRUE;
+				}
+			});
+			Thread reader = new Thread(firstRead, "input-wait");
+			reader.setDaemon(true);
+			reader.start();
+
+			try {
+				if (timeoutMillis > 0) {
+					firstRead.get(timeoutMillis, TimeUnit.MILLISECONDS);
+				}
+				else {
+					firstRead.get();
+				}
+				return true;
+			}
+			catch (TimeoutException e) {
+				return false;
+			}
+			catch (InterruptedException e) {
+				Thread.currentThread().interrupt();
+				return false;
+			}
+			catch (ExecutionException e) {
+				if (e.getCause() instanceof IOException) {
+					throw (IOException) e.getCause();
+				}
+				throw new IOException(e.getCause());
+			}
+		}
+
+		/**
+		 * Reports whether input can be read; files are always ready, as with SmartFileReader
+		 *
+		 * @return	true if a read will not wait for input
+		 */
+		public boolean ready() throws IOException {
+			return fromFile || pos < limit || eof || in.available() > 0;
+		}
+
+		public void close() throws IOException {
+			if (filter != null) {
+				filter.close();
+			}
+			in.close();
+		}
+	}
+
+
+	/**
+	 * One line of a single-sample pileup, parsed into the fields that the normal/tumor merge-join reads.
+	 * Column layouts follow the dual-pileup parser: depth and base qualities are read from columns 3 and 5
+	 * of a 6-7 column pileup or 7 and 9 of a 10-11 column CNS line, and are zero for any other layout.
+	 */
+	static public class PileupRecord {
+		private String chrom = null;
+		private int chromId = -1;
+		private int position = 0;
+		private int columns = 0;
+		private boolean gc = false;
+		private int depth = 0;
+		private NumberFormatException depthError = null;
+		private int qualityCount = 0;
+		private int qualityDepth = 0;
+
+		/**
+		 * @return	the chromosome, or null if the line has fewer than two columns
+		 */
+		public String getChrom() {
+			return chrom;
+		}
+
+		/**
+		 * @return	the chromosome id from the reader's ChromosomeRegistry, or -1 if the line has fewer than two columns
+		 */
+		public int getChromId() {
+			return chromId;
+		}
+
+		/**
+		 * @return	the position, if getChrom() is not null
+		 */
+		public int getPosition() {
+			return position;
+		}
+
+		/**
+		 * @return	true if the reference base is G or C, in either case
+		 * @throws	ArrayIndexOutOfBoundsException if the line has no reference base column
+		 */
+		public boolean isGC() {
+			if (columns < 3) {
+				throw new ArrayIndexOutOfBoundsException(2);
+			}
+			return gc;
+		}
+
+		/**
+		 * @return	the read depth column
+		 * @throws	NumberFormatException if the depth column is not an integer
+		 */
+		public int getDepth() {
+			if (depthError != null) {
+				throw depthError;
+			}
+			return depth;
+		}
+
+		/**
+		 * @return	the number of base qualities
+		 */
+		public int getQualityCount() {
+			return qualityCount;
+		}
+
+		/**
+		 * @return	the number of base qualities meeting the reader's minimum base quality
+		 */
+		public int getQualityDepth() {
+			return qualityDepth;
+		}
+	}
+
+
+	/**
+	 * Reads a single-sample pileup as PileupRecords. When prefetching, a reader thread parses lines
+	 * ahead of the consumer into a bounded queue of record batches, so that reading and parsing two
+	 * pileups overlap with each other and with the segmentation consuming them.
+	 */
+	static public class PileupRecordReader {
+		static final int BATCH_SIZE = 1024;
+		static final int QUEUE_BATCHES = 16;
+
+		private final ByteLineReader in;
+		private final int minBaseQual;
+		private final ChromosomeRegistry chroms;
+		private final TabTokenizer columns = new TabTokenizer();
+		private final int[] depths = new int[2];
+		private String lastChrom = null;
+
+		// Ids are handed out on the consumer's thread, once per run of lines on a chromosome //
+		private String lastIdChrom = null;
+		private int lastId = -1;
+
+		// Prefetching state: the batch holding a null record ends the input //
+		private final ArrayBlockingQueue<PileupRecord[]> queue;
+		private Thread prefetcher = null;
+		private volatile Exception failure = null;
+		private PileupRecord[] batch = null;
+		private int batchPos = 0;
+		private boolean finished = false;
+
+		/**
+		 * constructor for PileupRecordReader
+		 *
+		 * @param in			the reader to parse lines from; while prefetching, only the prefetch thread may use it
+		 * @param minBaseQual	minimum base quality to count towards getQualityDepth()
+		 * @param chroms		registry assigning chromosome ids, used only on the thread calling next()
+		 * @param prefetch		true to parse lines ahead on a reader thread
+		 * @param name			name of the reader thread
+		 */
+		public PileupRecordReader(ByteLineReader in, int minBaseQual, ChromosomeRegistry chroms, boolean prefetch, String name) {
+			this.in = in;
+			this.minBaseQual = minBaseQual;
+			this.chroms = chroms;
+
+			if (!prefetch) {
+				queue = null;
+				return;
+			}
+
+			queue = new ArrayBlockingQueue<PileupRecord[]>(QUEUE_BATCHES);
+			prefetcher = VarScan.daemonThreadFactory(name).newThread(new Runnable() {
+				public void run() {
+					prefetch();
+				}
+			});
+			prefetcher.start();
+		}
+
+		/**
+		 * Gets the next record, waiting for the reader thread if prefetching
+		 *
+		 * @return	the next record, or null at the end of the input
+		 * @throws	IOException, or a parsing exception, met on the line after the last record returned
+		 */
+		public PileupRecord next() throws IOException {
+			return identify(prefetcher == null ? (in.next() ? parse() : null) : take());
+		}
+
+		/**
+		 * Sets the chromosome id of a record
+		 *
+		 * @param record	the record, or null
+		 * @return	the same record
+		 */
+		private PileupRecord identify(PileupRecord record) {
+			if (record != null && record.chrom != null) {
+				if (record.chrom != lastIdChrom) {
+					lastId = chroms.id(record.chrom);
+					lastIdChrom = record.chrom;
+				}
+				record.chromId = lastId;
+			}
+			return record;
+		}
+
+		/**
+		 * Takes the next record from the reader thread
+		 *
+		 * @return	the next record, or null at the end of the input
+		 */
+		private PileupRecord take() throws IOException {
+			if (finished) {
+				return null;
+			}
+
+			if (batch == null || batchPos == batch.length) {
+				try {
+					batch = queue.take();
+					batchPos = 0;
+				}
+				catch (InterruptedException e) {
+					Thread.currentThread().interrupt();
+					throw new InterruptedIOException("Interrupted while waiting for pileup records");
+				}
+			}
+
+			PileupRecord record = batch[batchPos++];
+			if (record == null) {
+				finished = true;
+				if (failure instanceof IOException) {
+					throw (IOException) failure;
+				}
+				if (failure instanceof RuntimeException) {
+					throw (RuntimeException) failure;
+				}
+			}
+			return record;
+		}
+
+		/**
+		 * Stops the reader thread, leaving the underlying ByteLineReader free to be repositioned or closed.
+		 * Records already read ahead are discarded.
+		 */
+		public void stop() {
+			if (prefetcher == null) {
+				return;
+			}
+
+			prefetcher.interrupt();
+			boolean interrupted = false;
+			while (prefetcher.isAlive()) {
+				try {
+					prefetcher.join();
+				}
+				catch (InterruptedException e) {
+					interrupted = true;
+				}
+			}
+			if (interrupted) {
+				Thread.currentThread().interrupt();
+			}
+			finished = true;
+		}
+
+		/**
+		 * Parses lines into batches until the end of the input, an error or an interrupt from stop()
+		 */
+		private void prefetch() {
+			PileupRecord[] records = new PileupRecord[BATCH_SIZE];
+			int count = 0;
+
+			try {
+				try {
+					while (!Thread.currentThread().isInterrupted() && in.next()) {
+						records[count++] = parse();
+						if (count == BATCH_SIZE) {
+							queue.put(records);
+							records = new PileupRecord[BATCH_SIZE];
+							count = 0;
+						}
+					}
+				}
+				catch (Exception e) {
+					failure = e;
+				}
+
+				// Records parsed before the end or an error are still delivered, ahead of it //
+				queue.put(records);
+			}
+			catch (InterruptedException e) {
+				// Stopped by the consumer //
+			}
+		}
+
+		/**
+		 * Parses the current line of the underlying reader
+		 *
+		 * @return	a new record for the line
+		 */
+		private PileupRecord parse() {
+			PileupRecord record = new PileupRecord();
+			columns.reset(in.buffer(), in.lineStart(), in.lineEnd());
+			record.columns = columns.count();
+
+			if (record.columns > 1) {
+				// Share one String across a run of lines on the same chromosome //
+				if (lastChrom == null || !columns.fieldEquals(0, lastChrom)) {
+					lastChrom = columns.field(0);
+				}
+				record.chrom = lastChrom;
+				record.position = columns.intField(1);
+			}
+
+			if (record.columns > 2) {
+				record.gc = columns.fieldEquals(2, "G") || columns.fieldEquals(2, "C") || columns.fieldEquals(2, "g") || columns.fieldEquals(2, "c");
+			}
+
+			int depthColumn = -1;
+			int qualityColumn = -1;
+
+			// Pileup Files have 6-7 columns //
+			if (record.columns >= 6 && record.columns <= 7) {
+				depthColumn = 3;
+				qualityColumn = 5;
+			}
+			// Pileup lines in CNS files have 10-11 columns //
+			else if (record.columns >= 10 && record.columns <= 11) {
+				depthColumn = 7;
+				qualityColumn = 9;
+			}
+
+			if (depthColumn >= 0) {
+				// A bad depth only matters if the merge-join reaches this line, so hold on to the error //
+				try {
+					record.depth = columns.intField(depthColumn);
+				}
+				catch (NumberFormatException e) {
+					record.depthError = e;
+				}
+				record.qualityCount = columns.fieldLength(qualityColumn);
+				columns.qualityDepths(qualityColumn, -1, minBaseQual, depths);
+				record.qualityDepth = depths[0];
+			}
+
+			return record;
+		}
+	}
+
+
+	/**
+	 * Interns chromosome names as ids and ranks them in a sort order, so that the merge-join compares
+	 * chromosomes as numbers. The order is natural karyotype order (1..22, X, Y, M, then other contigs
+	 * with embedded numbers compared numerically), lexical order, or the order of a .fai or .dict file,
+	 * with chromosomes missing from the file ranked after it in natural order.
+	 *
+	 * Ranks are spaced apart so that a chromosome seen later can usually be ranked between two others
+	 * without renumbering. Not thread-safe; ids are handed out by the consumer of the records.
+	 */
+	static public class ChromosomeRegistry {
+		private static final long RANK_GAP = 1L << 32;
+
+		private final HashMap<String, Integer> ids = new HashMap<String, Integer>();
+		private final ArrayList<String> names = new ArrayList<String>();
+		private final HashMap<String, Integer> referenceOrder = new HashMap<String, Integer>();
+		private final boolean lexical;
+		private final TreeSet<Integer> sorted;
+		private long[] ranks = new long[64];
+
+		/**
+		 * constructor for ChromosomeRegistry
+		 *
+		 * @param lexical	true to sort chromosome names as Strings rather than in karyotype order
+		 */
+		public ChromosomeRegistry(boolean lexical) {
+			this.lexical = lexical;
+			this.sorted = new TreeSet<Integer>(new Comparator<Integer>() {
+				public int compare(Integer a, Integer b) {
+					return compareNames(names.get(a), names.get(b));
+				}
+			});
+		}
+
+		/**
+		 * Creates a registry for a --chrom-order setting
+		 *
+		 * @param order		"natural", "lexical", or a .fai or .dict file listing the reference order
+		 * @return	a registry with any reference chromosomes already ranked
+		 */
+		public static ChromosomeRegistry forOrder(String order) throws IOException {
+			if (order == null || order.equals("natural")) {
+				return new ChromosomeRegistry(false);
+			}
+			if (order.equals("lexical")) {
+				return new ChromosomeRegistry(true);
+			}
+
+			ChromosomeRegistry registry = new ChromosomeRegistry(false);
+			registry.loadReference(order);
+			return registry;
+		}
+
+		/**
+		 * Reads the chromosome order of a samtools .fai index or a Picard .dict sequence dictionary
+		 *
+		 * @param fileName	the .fai or .dict file
+		 */
+		private void loadReference(String fileName) throws IOException {
+			BufferedReader in = new BufferedReader(new FileReader(fileName));
+			try {
+				String line;
+				while ((line = in.readLine()) != null) {
+					String chrom = null;
+					if (line.startsWith("@SQ")) {
+						for (String field : line.split("\t")) {
+							if (field.startsWith("SN:"))
+								chrom = field.substring(3);
+						}
+					}
+					else if (!line.startsWith("@") && line.length() > 0) {
+						chrom = line.split("\t")[0];
+					}
+
+					if (chrom != null && !referenceOrder.containsKey(chrom)) {
+						referenceOrder.put(chrom, referenceOrder.size());
+						id(chrom);
+					}
+				}
+			}
+			finally {
+				in.close();
+			}
+
+			if (referenceOrder.size() == 0) {
+				throw new IOException("No chromosomes found in " + fileName);
+			}
+		}
+
+		/**
+		 * Gets the id of a chromosome, ranking it if it has not been seen before
+		 *
+		 * @param chrom		chromosome name
+		 * @return	its id
+		 */
+		public int id(String chrom) {
+			Integer id = ids.get(chrom);
+			if (id != null) {
+				return id;
+			}
+
+			int newId = names.size();
+			ids.put(chrom, newId);
+			names.add(chrom);
+			if (newId == ranks.length) {
+				ranks = Arrays.copyOf(ranks, 2 * newId);
+			}
+			rank(newId);
+			return newId;
+		}
+
+		/**
+		 * @param id	chromosome id
+		 * @return	the chromosome name
+		 */
+		public String name(int id) {
+			return names.get(id);
+		}
+
+		/**
+		 * @return	the number of chromosomes seen
+		 */
+		public int size() {
+			return names.size();
+		}
+
+		/**
+		 * Determines if one chromosome sorts no later than another
+		 *
+		 * @param id1	first chromosome id
+		 * @param id2	second chromosome id
+		 * @return	true if id1 sorts before id2 or is the same chromosome
+		 */
+		public boolean inOrder(int id1, int id2) {
+			return ranks[id1] <= ranks[id2];
+		}
+
+		/**
+		 * Ranks a new id between its neighbours in sort order, renumbering all ranks if they leave no gap
+		 */
+		private void rank(int id) {
+			sorted.add(id);
+			Integer lower = sorted.lower(id);
+			Integer higher = sorted.higher(id);
+
+			if (lower == null && higher == null) {
+				ranks[id] = 0;
+			}
+			else if (higher == null) {
+				ranks[id] = ranks[lower] + RANK_GAP;
+			}
+			else if (lower == null) {
+				ranks[id] = ranks[higher] - RANK_GAP;
+			}
+			else if (ranks[higher] - ranks[lower] > 1) {
+				ranks[id] = ranks[lower] + (ranks[higher] - ranks[lower]) / 2;
+			}
+			else {
+				long next = 0;
+				for (Integer each : sorted) {
+					ranks[each] = next;
+					next += RANK_GAP;
+				}
+			}
+		}
+
+		/**
+		 * Compares chromosome names in this registry's order
+		 */
+		private int compareNames(String a, String b) {
+			if (a.length() == 0 || b.length() == 0) {
+				return (a.length() == 0 ? 0 : 1) - (b.length() == 0 ? 0 : 1);
+			}
+			if (lexical) {
+				return a.compareTo(b);
+			}
+
+			Integer refA = referenceOrder.get(a);
+			Integer refB = referenceOrder.get(b);
+			if (refA != null || refB != null) {
+				if (refA == null)
+					return 1;
+				if (refB == null)
+					return -1;
+				return refA.compareTo(refB);
+			}
+
+			int result = compareNatural(a, b);
+			return (result != 0) ? result : a.compareTo(b);
+		}
+
+		/**
+		 * Compares chromosome names in karyotype order: an optional "chr" prefix is ignored, numbered
+		 * chromosomes come first in numeric order, then X, Y and M or MT, then any other names with
+		 * runs of digits compared as numbers. A blank name sorts first.
+		 *
+		 * @param a		first chromosome name
+		 * @param b		second chromosome name
+		 * @return	negative, zero or positive as a sorts before, with or after b
+		 */
+		static int compareNatural(String a, String b) {
+			if (a.length() == 0 || b.length() == 0) {
+				return (a.length() == 0 ? 0 : 1) - (b.length() == 0 ? 0 : 1);
+			}
+
+			String x = stripChr(a);
+			String y = stripChr(b);
+			int classX = karyotypeClass(x);
+			int classY = karyotypeClass(y);
+			if (classX != classY) {
+				return classX - classY;
+			}
+
+			int i = 0;
+			int j = 0;
+			while (i < x.length() && j < y.length()) {
+				char cx = x.charAt(i);
+				char cy = y.charAt(j);
+				if (Character.isDigit(cx) && Character.isDigit(cy)) {
+					// Compare digit runs by value: ignoring leading zeros, the longer run is larger //
+					int endX = i;
+					int endY = j;
+					while (endX < x.length() && Character.isDigit(x.charAt(endX)))
+						endX++;
+					while (endY < y.length() && Character.isDigit(y.charAt(endY)))
+						endY++;
+					while (i < endX - 1 && x.charAt(i) == '0')
+						i++;
+					while (j < endY - 1 && y.charAt(j) == '0')
+						j++;
+					if (endX - i != endY - j) {
+						return (endX - i) - (endY - j);
+					}
+					int result = x.substring(i, endX).compareTo(y.substring(j, endY));
+					if (result != 0) {
+						return result;
+					}
+					i = endX;
+					j = endY;
+				}
+				else {
+					if (cx != cy) {
+						return cx - cy;
+					}
+					i++;
+					j++;
+				}
+			}
+			return (x.length() - i) - (y.length() - j);
+		}
+
+		private static String stripChr(String chrom) {
+			if (chrom.length() > 3 && chrom.regionMatches(true, 0, "chr", 0, 3)) {
+				return chrom.substring(3);
+			}
+			return chrom;
+		}
+
+		/**
+		 * @return	0 for numbered chromosomes, 1 for X, 2 for Y, 3 for M or MT, 4 for anything else
+		 */
+		private static int karyotypeClass(String chrom) {
+			boolean digits = true;
+			for (int i = 0; i < chrom.length() && digits; i++) {
+				digits = Character.isDigit(chrom.charAt(i));
+			}
+			if (digits) {
+				return 0;
+			}
+			if (chrom.equalsIgnoreCase("X")) {
+				return 1;
+			}
+			if (chrom.equalsIgnoreCase("Y")) {
+				return 2;
+			}
+			if (chrom.equalsIgnoreCase("M") || chrom.equalsIgnoreCase("MT")) {
+				return 3;
+			}
+			return 4;
+		}
+	}
+
+
+	/**
+	 * Decompresses a BGZF file, the series of independent gzip blocks written by bgzip. Blocks are
+	 * read ahead of the consumer and inflated on a pool of worker threads, then handed back in order.
+	 *
+	 */
+	static public class BgzfInputStream extends InputStream {
+		static final int HEADER_SIZE = 18;
+		static final int MAX_BLOCK_SIZE = 1 << 16;
+		private static final int FIXED_HEADER_SIZE = 12;
+		private static final int TRAILER_SIZE = 8;
+
+		private final InputStream in;
+		private final ExecutorService pool;
+		private final boolean ownPool;
+		private final int maxReadAhead;
+		private int readAhead;
+		private final ArrayDeque<Future<byte[]>> pending = new ArrayDeque<Future<byte[]>>();
+		private byte[] block = new byte[0];
+		private int blockPos = 0;
+		private boolean inputDone = false;
+
+		// Compressed and uncompressed offsets of the blocks read, kept only for virtualOffset() //
+		private long compressedOffset = 0;
+		private long dataOffset = 0;
+		private boolean trackBlocks = false;
+		private long[] blockStarts = new long[0];
+		private long[] blockDataStarts = new long[0];
+		private int firstBlock = 0;
+		private int blockCount = 0;
+
+		/**
+		 * constructor for BgzfInputStream
+		 *
+		 * @param in		the compressed stream
+		 * @param threads	threads for inflating blocks
+		 */
+		public BgzfInputStream(InputStream in, int threads) {
+			threads = Math.max(threads, 1);
+			this.in = in;
+			this.maxReadAhead = 4 * threads;
+			this.readAhead = maxReadAhead;
+			this.pool = newInflatePool(threads);
+			this.ownPool = true;
+		}
+
+		/**
+		 * constructor for BgzfInputStream on a pool shared with other streams, such as those opened at each
+		 * seek of a RegionFilter. Read-ahead starts at one block and doubles with each block read, so that
+		 * a short read after a seek inflates little more than it uses.
+		 *
+		 * @param in		the compressed stream
+		 * @param pool		pool for inflating blocks, left running on close
+		 * @param threads	threads in the pool
+		 */
+		BgzfInputStream(InputStream in, ExecutorService pool, int threads) {
+			this.in = in;
+			this.maxReadAhead = 4 * Math.max(threads, 1);
+			this.readAhead = 1;
+			this.pool = pool;
+			this.ownPool = false;
+		}
+
+		/**
+		 * Creates a pool for inflating blocks, which streams may share
+		 *
+		 * @param threads	threads for inflating blocks
+		 * @return	the pool
+		 */
+		static ExecutorService newInflatePool(int threads) {
+			return Executors.newFixedThreadPool(Math.max(threads, 1), VarScan.daemonThreadFactory("bgzf-inflate"));
+		}
+
+		/**
+		 * Checks for the gzip magic number
+		 *
+		 * @param header	the first bytes of a file
+		 * @param length	the number of bytes in header
+		 * @return	true if the file is gzip-compressed
+		 */
+		static boolean isGzip(byte[] header, int length) {
+			return length >= 2 && (header[0] & 0xFF) == 0x1F && (header[1] & 0xFF) == 0x8B;
+		}
+
+		/**
+		 * Checks for a gzip header carrying the BGZF "BC" extra subfield
+		 *
+		 * @param header	the first bytes of a file
+		 * @param length	the number of bytes in header
+		 * @return	true if the file is BGZF-compressed
+		 */
+		static boolean isBgzf(byte[] header, int length) {
+			return length >= HEADER_SIZE && isGzip(header, length) && (header[3] & 4) != 0
+				&& header[12] == 'B' && header[13] == 'C';
+		}
+
+		public int read() throws IOException {
+			byte[] one = new byte[1];
+			return (read(one, 0, 1) < 0) ? -1 : (one[0] & 0xFF);
+		}
+
+		public int read(byte[] b, int off, int len) throws IOException {
+			if (len == 0) {
+				return 0;
+			}
+			while (blockPos == block.length) {
+				if (!nextBlock()) {
+					return -1;
+				}
+			}
+
+			int n = Math.min(len, block.length - blockPos);
+			System.arraycopy(block, blockPos, b, off, n);
+			blockPos += n;
+			return n;
+		}
+
+		public int available() {
+			return block.length - blockPos;
+		}
+
+		public void close() throws IOException {
+			if (ownPool) {
+				pool.shutdownNow();
+			}
+			else {
+				// Blocks read ahead are no longer wanted //
+				for (Future<byte[]> future : pending) {
+					future.cancel(true);
+				}
+				pending.clear();
+			}
+			in.close();
+		}
+
+		private boolean nextBlock() throws IOException {
+			// Keep the pool busy with the blocks after this one //
+			while (!inputDone && pending.size() < readAhead) {
+				final byte[] raw = readRawBlock();
+				if (raw == null) {
+					inputDone = true;
+				}
+				else {
+					pending.add(pool.submit(new Callable<byte[]>() {
+						public byte[] call() throws IOException {
+							return inflate(raw);
+						}
+					}));
+				}
+			}
+
+			Future<byte[]> next = pending.poll();
+			if (next == null) {
+				return false;
+			}
+			readAhead = Math.min(2 * readAhead, maxReadAhead);
+
+			try {
+				block = next.get();
+			}
+			catch (InterruptedException e) {
+				Thread.currentThread().interrupt();
+				throw new InterruptedIOException("Interrupted while decompressing BGZF input");
+			}
+			catch (ExecutionException e) {
+				if (e.getCause() instanceof IOException) {
+					throw (IOException) e.getCause();
+				}
+				throw new IOException(e.getCause());
+			}
+			blockPos = 0;
+			return true;
+		}
+
+		private byte[] readRawBlock() throws IOException {
+			byte[] header = new byte[FIXED_HEADER_SIZE];
+			int length = readFully(header, 0, header.length);
+			if (length == 0) {
+				return null;
+			}
+			if (length < header.length || !isGzip(header, length) || (header[3] & 4) == 0) {
+				throw new IOException("Invalid BGZF block header");
+			}
+
+			// Find the block size in the BC subfield of the extra field //
+			int extraLength = unsignedShort(header, 10);
+			byte[] extra = new byte[extraLength];
+			if (readFully(extra, 0, extraLength) < extraLength) {
+				throw new IOException("Truncated BGZF block header");
+			}
+
+			int blockSize = -1;
+			for (int i = 0; i + 4 <= extraLength; i += 4 + unsignedShort(extra, i + 2)) {
+				if (extra[i] == 'B' && extra[i + 1] == 'C') {
+					blockSize = unsignedShort(extra, i + 4) + 1;
+				}
+			}
+			if (blockSize < FIXED_HEADER_SIZE + extraLength + TRAILER_SIZE) {
+				throw new IOException("Missing BGZF block size");
+			}
+
+			byte[] raw = new byte[blockSize];
+			System.arraycopy(header, 0, raw, 0, FIXED_HEADER_SIZE);
+			System.arraycopy(extra, 0, raw, FIXED_HEADER_SIZE, extraLength);
+			int rest = blockSize - FIXED_HEADER_SIZE - extraLength;
+			if (readFully(raw, FIXED_HEADER_SIZE + extraLength, rest) < rest) {
+				throw new IOException("Truncated BGZF block");
+			}
+
+			if (trackBlocks) {
+				if (blockCount == blockStarts.length) {
+					// Drop blocks that virtualOffset() has moved past before growing //
+					blockCount -= firstBlock;
+					System.arraycopy(blockStarts, firstBlock, blockStarts, 0, blockCount);
+					System.arraycopy(blockDataStarts, firstBlock, blockDataStarts, 0, blockCount);
+					firstBlock = 0;
+					if (2 * blockCount >= blockStarts.length) {
+						blockStarts = Arrays.copyOf(blockStarts, Math.max(1024, 2 * blockStarts.length));
+						blockDataStarts = Arrays.copyOf(blockDataStarts, blockStarts.length);
+					}
+				}
+				blockStarts[blockCount] = compressedOffset;
+				blockDataStarts[blockCount] = dataOffset;
+				blockCount++;
+			}
+			compressedOffset += blockSize;
+			dataOffset += unsignedInt(raw, blockSize - 4) & 0xFFFFFFFFL;
+			return raw;
+		}
+
+		/**
+		 * Starts recording block offsets, so that virtualOffset() can be used. Call before reading.
+		 */
+		void trackBlocks() {
+			trackBlocks = true;
+		}
+
+		/**
+		 * Converts an offset in the uncompressed data to a BGZF virtual offset: the compressed offset
+		 * of its block in the upper 48 bits and the offset within the block in the lower 16. Offsets
+		 * must be asked for in increasing order.
+		 *
+		 * @param uncompressedOffset	offset in the uncompressed data, from the start of the file
+		 * @return	the virtual offset
+		 */
+		long virtualOffset(long uncompressedOffset) {
+			while (firstBlock + 1 < blockCount && blockDataStarts[firstBlock + 1] <= uncompressedOffset) {
+				firstBlock++;
+			}
+			if (firstBlock >= blockCount) {
+				return compressedOffset << 16;
+			}
+			return (blockStarts[firstBlock] << 16) | (uncompressedOffset - blockDataStarts[firstBlock]);
+		}
+
+		private static byte[] inflate(byte[] raw) throws IOException {
+			int dataStart = FIXED_HEADER_SIZE + unsignedShort(raw, 10);
+			int dataLength = raw.length - dataStart - TRAILER_SIZE;
+			byte[] data = new byte[unsignedInt(raw, raw.length - 4)];
+
+			Inflater inflater = new Inflater(true);
+			try {
+				inflater.setInput(raw, dataStart, dataLength);
+				int length = 0;
+				while (length < data.length) {
+					int n = inflater.inflate(data, length, data.length - length);
+					if (n == 0 && (inflater.finished() || inflater.needsInput())) {
+						break;
+					}
+					length += n;
+				}
+				if (length < data.length) {
+					throw new IOException("Truncated BGZF block data");
+				}
+			}
+			catch (DataFormatException e) {
+				throw new IOException("Corrupt BGZF block: " + e.getMessage());
+			}
+			finally {
+				inflater.end();
+			}
+
+			CRC32 crc = new CRC32();
+			crc.update(data, 0, data.length);
+			if ((int) crc.getValue() != unsignedInt(raw, raw.length - TRAILER_SIZE)) {
+				throw new IOException("BGZF block failed its CRC check");
+			}
+			return data;
+		}
+
+		private int readFully(byte[] b, int off, int len) throws IOException {
+			int total = 0;
+			while (total < len) {
+				int n = in.read(b, off + total, len - total);
+				if (n < 0) {
+					break;
+				}
+				total += n;
+			}
+			return total;
+		}
+
+		private static int unsignedShort(byte[] b, int i) {
+			return (b[i] & 0xFF) | ((b[i + 1] & 0xFF) << 8);
+		}
+
+		private static int unsignedInt(byte[] b, int i) {
+			return unsignedShort(b, i) | (unsignedShort(b, i + 2) << 16);
+		}
+	}
+
+	/**
+	 * Compresses a stream as BGZF, the series of independent gzip blocks that bgzip writes, so that it
+	 * can be read by BgzfInputStream, samtools and tabix. Full blocks are deflated on a pool of worker
+	 * threads and written in order; a BGZF end-of-file block is written on close.
+	 *
+	 */
+	static public class BgzfOutputStream extends OutputStream {
+		// Uncompressed data per block, as bgzip uses, so that a stored block still fits in 64 KB //
+		static final int BLOCK_DATA_SIZE = 0xFF00;
+		private static final int TRAILER_SIZE = 8;
+		private static final byte[] EOF_BLOCK = {
+			0x1F, (byte) 0x8B, 8, 4, 0, 0, 0, 0, 0, (byte) 0xFF, 6, 0, 'B', 'C', 2, 0,
+			0x1B, 0, 3, 0, 0, 0, 0, 0, 0, 0, 0, 0
+		};
+
+		private final OutputStream out;
+		private final ExecutorService pool;
+		private final int maxPending;
+		private final ArrayDeque<Future<byte[]>> pending = new ArrayDeque<Future<byte[]>>();
+		private byte[] block = new byte[BLOCK_DATA_SIZE];
+		private int count = 0;
+		private boolean closed = false;
+
+		// Compressed offset of each block written, kept for virtualOffset() //
+		private long compressedOffset = 0;
+		private long[] blockStarts = new long[1024];
+		private int blocksWritten = 0;
+
+		/**
+		 * constructor for BgzfOutputStream
+		 *
+		 * @param out		the stream for the compressed data
+		 * @param threads	threads for deflating blocks, or 1 to deflate on the caller's thread
+		 */
+		public BgzfOutputStream(OutputStream out, int threads) {
+			this.out = out;
+			this.maxPending = 4 * Math.max(threads, 1);
+			this.pool = (threads > 1) ? Executors.newFixedThreadPool(threads, VarScan.daemonThreadFactory("bgzf-deflate")) : null;
+		}
+
+		public void write(int b) throws IOException {
+			write(new byte[] {(byte) b}, 0, 1);
+		}
+
+		public void write(byte[] b, int off, int len) throws IOException {
+			while (len > 0) {
+				int n = Math.min(len, BLOCK_DATA_SIZE - count);
+				System.arraycopy(b, off, block, count, n);
+				count += n;
+				off += n;
+				len -= n;
+				if (count == BLOCK_DATA_SIZE) {
+					endBlock();
+				}
+			}
+		}
+
+		/**
+		 * Writes the blocks compressed so far. The current partial block is kept, so that flushing
+		 * does not shrink the blocks.
+		 */
+		public void flush() throws IOException {
+			drain(true);
+			out.flush();
+		}
+
+		public void close() throws IOException {
+			if (closed) {
+				return;
+			}
+			closed = true;
+			try {
+				if (count > 0) {
+					endBlock();
+				}
+				drain(true);
+				out.write(EOF_BLOCK);
+			}
+			finally {
+				if (pool != null) {
+					pool.shutdownNow();
+				}
+				out.close();
+			}
+		}
+
+		/**
+		 * Converts an offset in the uncompressed data to a BGZF virtual offset: the compressed offset
+		 * of its block in the upper 48 bits and the offset within the block in the lower 16. Only
+		 * offsets in blocks already written, as after close(), can be converted; the end of the data
+		 * maps to the start of the end-of-file block.
+		 *
+		 * @param uncompressedOffset	offset in the uncompressed data, from the start of the stream
+		 * @return	the virtual offset
+		 */
+		long virtualOffset(long uncompressedOffset) {
+			long blockNumber = uncompressedOffset / BLOCK_DATA_SIZE;
+			if (blockNumber >= blocksWritten) {
+				return compressedOffset << 16;
+			}
+			return (blockStarts[(int) blockNumber] << 16) | (uncompressedOffset % BLOCK_DATA_SIZE);
+		}
+
+		private void endBlock() throws IOException {
+			final byte[] data = block;
+			final int length = count;
+			block = new byte[BLOCK_DATA_SIZE];
+			count = 0;
+
+			if (pool == null) {
+				writeBlock(deflate(data, length));
+				return;
+			}
+			pending.add(pool.submit(new Callable<byte[]>() {
+				public byte[] call() {
+					return deflate(data, length);
+				}
+			}));
+			drain(false);
+		}
+
+		/**
+		 * Writes compressed blocks in order, waiting for them if too many are pending or all are wanted
+		 */
+		private void drain(boolean all) throws IOException {
+			while (!pending.isEmpty() && (all || pending.size() > maxPending || pending.peek().isDone())) {
+				writeBlock(await(pending.poll()));
+			}
+		}
+
+		private byte[] await(Future<byte[]> next) throws IOException {
+			try {
+				return next.get();
+			}
+			catch (InterruptedException e) {
+				Thread.currentThread().interrupt();
+				throw new InterruptedIOException("Interrupted while compressing BGZF output");
+			}
+			catch (ExecutionException e) {
+				throw new IOException(e.getCause());
+			}
+		}
+
+		private void writeBlock(byte[] compressed) throws IOException {
+			if (blocksWritten == blockStarts.length) {
+				blockStarts = Arrays.copyOf(blockStarts, 2 * blocksWritten);
+			}
+			blockStarts[blocksWritten++] = compressedOffset;
+			out.write(compressed);
+			compressedOffset += compressed.length;
+		}
+
+		private static byte[] deflate(byte[] data, int length) {
+			byte[] raw = new byte[BgzfInputStream.MAX_BLOCK_SIZE];
+			int maxData = raw.length - BgzfInputStream.HEADER_SIZE - TRAILER_SIZE;
+			int size = deflate(data, length, raw, maxData, Deflater.DEFAULT_COMPRESSION);
+			if (size < 0) {
+				// Incompressible data: stored blocks always fit, since the block data is under 64 KB //
+				size = deflate(data, length, raw, maxData, Deflater.NO_COMPRESSION);
+			}
+
+			int blockSize = BgzfInputStream.HEADER_SIZE + size + TRAILER_SIZE;
+			byte[] header = {
+				0x1F, (byte) 0x8B, 8, 4, 0, 0, 0, 0, 0, (byte) 0xFF, 6, 0, 'B', 'C', 2, 0,
+				(byte) (blockSize - 1), (byte) ((blockSize - 1) >> 8)
+			};
+			System.arraycopy(header, 0, raw, 0, header.length);
+
+			CRC32 crc = new CRC32();
+			crc.update(data, 0, length);
+			putInt(raw, blockSize - TRAILER_SIZE, (int) crc.getValue());
+			putInt(raw, blockSize - 4, length);
+			return Arrays.copyOf(raw, blockSize);
+		}
+
+		/**
+		 * @return	the size of the raw deflated data, or -1 if it does not fit in maxSize
+		 */
+		private static int deflate(byte[] data, int length, byte[] raw, int maxSize, int level) {
+			Deflater deflater = new Deflater(level, true);
+			try {
+				deflater.setInput(data, 0, length);
+				deflater.finish();
+				int size = 0;
+				while (!deflater.finished() && size < maxSize) {
+					size += deflater.deflate(raw, BgzfInputStream.HEADER_SIZE + size, maxSize - size);
+				}
+				return deflater.finished() ? size : -1;
+			}
+			finally {
+				deflater.end();
+			}
+		}
+
+		private static void putInt(byte[] b, int i, int value) {
+			b[i] = (byte) value;
+			b[i + 1] = (byte) (value >> 8);
+			b[i + 2] = (byte) (value >> 16);
+			b[i + 3] = (byte) (value >> 24);
+		}
+	}
+
+	/**
+	 * Sidecar index of byte offsets in a position-sorted pileup or mpileup, plain or BGZF. Each run of
+	 * lines on one chromosome gets an entry at its first line, then one at the first line at least
+	 * interval positions past the previous entry. BGZF files get virtual offsets (block offset << 16 |
+	 * offset in block). The index is written next to the file as file + EXTENSION.
+	 *
+	 */
+	static public class PileupIndex {
+		public static final String EXTENSION = ".idx";
+		public static final int DEFAULT_INTERVAL = 16384;
+		private static final int MAGIC = 0x56534958;
+		private static final int VERSION = 1;
+
+		private final boolean bgzf;
+		private final int interval;
+		private final long fileLength;
+		private final long fileModified;
+		private final ArrayList<String> runChroms = new ArrayList<String>();
+		private final ArrayList<int[]> runPositions = new ArrayList<int[]>();
+		private final ArrayList<long[]> runOffsets = new ArrayList<long[]>();
+
+		private PileupIndex(boolean bgzf, int interval, long fileLength, long fileModified) {
+			this.bgzf = bgzf;
+			this.interval = interval;
+			this.fileLength = fileLength;
+			this.fileModified = fileModified;
+		}
+
+		/**
+		 * Builds the index by reading the first two columns of every line
+		 *
+		 * @param fileName	the pileup to index
+		 * @param interval	positions between entries within a chromosome
+		 * @param threads	threads for decompressing BGZF blocks
+		 * @return	the index
+		 */
+		public static PileupIndex build(String fileName, int interval, int threads) throws IOException {
+			File file = new File(fileName);
+			InputStream in = ByteLineReader.openDecompressed(fileName, threads);
+			if (in instanceof GZIPInputStream) {
+				in.close();
+				throw new IOException(fileName + " is gzip- but not BGZF-compressed; recompress it with bgzip to index it");
+			}
+
+			BgzfInputStream blocks = null;
+			if (in instanceof BgzfInputStream) {
+				blocks = (BgzfInputStream) in;
+				blocks.trackBlocks();
+			}
+
+			PileupIndex index = new PileupIndex(blocks != null, interval, file.length(), file.lastModified());
+			ByteLineReader reader = new ByteLineReader(in, ByteLineReader.DEFAULT_BUFFER_SIZE, true);
+			TabTokenizer columns = new TabTokenizer();
+
+			String chrom = null;
+			int lastPosition = 0;
+			int lastEntry = 0;
+			int[] positions = new int[16];
+			long[] offsets = new long[16];
+			int count = 0;
+
+			try {
+				while (reader.next()) {
+					columns.resetLeading(reader.buffer(), reader.lineStart(), reader.lineEnd(), 2);
+					if (columns.count() < 2) {
+						continue;
+					}
+
+					int position;
+					try {
+						position = columns.intField(1);
+					}
+					catch (NumberFormatException e) {
+						continue;
+					}
+
+					boolean newRun = (chrom == null || !columns.fieldEquals(0, chrom));
+					if (!newRun && position < lastPosition) {
+						throw new IOException(fileName + " is not sorted by position: " + chrom + " " + position + " follows " + lastPosition);
+					}
+
+					if (newRun || position - lastEntry >= interval) {
+						if (newRun) {
+							if (chrom != null) {
+								index.addRun(chrom, positions, offsets, count);
+							}
+							chrom = columns.field(0);
+							count = 0;
+						}
+						if (count == positions.length) {
+							positions = Arrays.copyOf(positions, 2 * count);
+							offsets = Arrays.copyOf(offsets, 2 * count);
+						}
+						positions[count] = position;
+						offsets[count] = (blocks != null) ? blocks.virtualOffset(reader.lineOffset()) : reader.lineOffset();
+						count++;
+						lastEntry = position;
+					}
+					lastPosition = position;
+				}
+				if (chrom != null) {
+					index.addRun(chrom, positions, offsets, count);
+				}
+			}
+			finally {
+				reader.close();
+			}
+			return index;
+		}
+
+		private void addRun(String chrom, int[] positions, long[] offsets, int count) {
+			runChroms.add(chrom);
+			runPositions.add(Arrays.copyOf(positions, count));
+			runOffsets.add(Arrays.copyOf(offsets, count));
+		}
+
+		/**
+		 * Writes the index
+		 *
+		 * @param indexFile	the file to write
+		 */
+		public void write(String indexFile) throws IOException {
+			DataOutputStream out = new DataOutputStream(new BufferedOutputStream(new FileOutputStream(indexFile)));
+			try {
+				out.writeInt(MAGIC);
+				out.writeInt(VERSION);
+				out.writeBoolean(bgzf);
+				out.writeInt(interval);
+				out.writeLong(fileLength);
+				out.writeLong(fileModified);
+				out.writeInt(runChroms.size());
+				for (int run = 0; run < runChroms.size(); run++) {
+					int[] positions = runPositions.get(run);
+					long[] offsets = runOffsets.get(run);
+					out.writeUTF(runChroms.get(run));
+					out.writeInt(positions.length);
+					for (int i = 0; i < positions.length; i++) {
+						out.writeInt(positions[i]);
+						out.writeLong(offsets[i]);
+					}
+				}
+			}
+			finally {
+				out.close();
+			}
+		}
+
+		/**
+		 * Loads the index of a pileup, if it has an up-to-date one
+		 *
+		 * @param fileName	the indexed pileup
+		 * @return	the index, or null if there is none or it is older than the file
+		 */
+		public static PileupIndex load(String fileName) throws IOException {
+			return load(fileName, System.err);
+		}
+
+		/**
+		 * Loads the index of a pileup, if it has an up-to-date one
+		 *
+		 * @param fileName	the indexed pileup
+		 * @param log		stream for the warning about an out-of-date index
+		 * @return	the index, or null if there is none or it is older than the file
+		 */
+		public static PileupIndex load(String fileName, PrintStream log) throws IOException {
+			File file = new File(fileName);
+			File indexFile = new File(fileName + EXTENSION);
+			if (!indexFile.exists()) {
+				return null;
+			}
+
+			DataInputStream in = new DataInputStream(new BufferedInputStream(new FileInputStream(indexFile)));
+			try {
+				if (in.readInt() != MAGIC || in.readInt() != VERSION) {
+					throw new IOException(indexFile + " is not a VarScan pileup index");
+				}
+
+				PileupIndex index = new PileupIndex(in.readBoolean(), in.readInt(), in.readLong(), in.readLong());
+				if (index.fileLength != file.length() || index.fileModified != file.lastModified()) {
+					log.println("Warning: Ignoring " + indexFile + " because " + fileName + " has changed since it was indexed");
+					return null;
+				}
+
+				int runs = in.readInt();
+				for (int run = 0; run < runs; run++) {
+					String chrom = in.readUTF();
+					int count = in.readInt();
+					int[] positions = new int[count];
+					long[] offsets = new long[count];
+					for (int i = 0; i < count; i++) {
+						positions[i] = in.readInt();
+						offsets[i] = in.readLong();
+					}
+					index.addRun(chrom, positions, offsets, count);
+				}
+				return index;
+			}
+			finally {
+				in.close();
+			}
+		}
+
+		/**
+		 * Finds where to start reading for a position: in each run of the chromosome, the offset of the
+		 * last entry at or before the position. Lines before the position may follow it.
+		 *
+		 * @param chrom		the chromosome
+		 * @param position	the first position wanted
+		 * @return	one offset per run of the chromosome, in file order; empty if it is not in the file
+		 */
+		public long[] seekOffsets(String chrom, int position) {
+			long[] found = new long[0];
+			for (int run = 0; run < runChroms.size(); run++) {
+				if (runChroms.get(run).equals(chrom)) {
+					found = Arrays.copyOf(found, found.length + 1);
+					found[found.length - 1] = entryOffset(run, seekEntry(run, position));
+				}
+			}
+			return found;
+		}
+
+		/**
+		 * Finds the last entry of a chromosome run at or before a position, or its first entry
+		 *
+		 * @param run		the run, in file order
+		 * @param position	the position
+		 * @return	the entry number within the run
+		 */
+		public int seekEntry(int run, int position) {
+			int entry = Arrays.binarySearch(runPositions.get(run), position);
+			return (entry < 0) ? Math.max(0, -entry - 2) : entry;
+		}
+
+		/**
+		 * @return	the position of the line at an entry
+		 */
+		public int entryPosition(int run, int entry) {
+			return runPositions.get(run)[entry];
+		}
+
+		/**
+		 * @return	the offset of the line at an entry
+		 */
+		public long entryOffset(int run, int entry) {
+			return runOffsets.get(run)[entry];
+		}
+
+		/**
+		 * @return	the offset of the start of each chromosome run, in file order
+		 */
+		public long[] runOffsets() {
+			long[] starts = new long[runChroms.size()];
+			for (int run = 0; run < starts.length; run++) {
+				starts[run] = runOffsets.get(run)[0];
+			}
+			return starts;
+		}
+
+		/**
+		 * @return	the chromosome of each run, in file order
+		 */
+		public String[] runChromosomes() {
+			return runChroms.toArray(new String[runChroms.size()]);
+		}
+
+		/**
+		 * @return	the number of entries in the index
+		 */
+		public long getEntries() {
+			long entries = 0;
+			for (int run = 0; run < runOffsets.size(); run++) {
+				entries += runOffsets.get(run).length;
+			}
+			return entries;
+		}
+
+		public boolean isBgzf() {
+			return bgzf;
+		}
+
+		public int getInterval() {
+			return interval;
+		}
+	}
+
+	/**
+	 * Tabix index of a position-sorted, tab-delimited BGZF file, in the .tbi format that tabix and
+	 * htslib read. Records are placed in the UCSC binning scheme's smallest bin containing them, each
+	 * bin holding the virtual offset ranges (chunks) of its records, and a linear index keeps the
+	 * offset of the first record overlapping each 16 kb window. Positions are 0-based and half-open.
+	 *
+	 */
+	static public class TabixIndex {
+		public static final String EXTENSION = ".tbi";
+		private static final byte[] MAGIC = {'T', 'B', 'I', 1};
+		private static final int MIN_SHIFT = 14;
+		private static final int MAX_POSITION = 1 << 29;
+		private static final int UCSC_FORMAT = 0x10000;
+
+		private final int format;
+		private final int colSeq;
+		private final int colBeg;
+		private final int colEnd;
+		private final int meta;
+		private final int skip;
+		private final ArrayList<Reference> refs = new ArrayList<Reference>();
+		private final HashMap<String, Reference> refsByName = new HashMap<String, Reference>();
+
+		// Building state: the index is only usable if every record arrived in sorted order //
+		private final TabTokenizer columns = new TabTokenizer();
+		private Reference last = null;
+		private int lastBeg = 0;
+		private long lines = 0;
+		private String error = null;
+
+		/**
+		 * The bins and linear index of one sequence
+		 */
+		private static class Reference {
+			final String name;
+			final TreeMap<Integer, ArrayList<long[]>> bins = new TreeMap<Integer, ArrayList<long[]>>();
+			long[] linear = new long[16];
+			int windows = 0;
+
+			Reference(String name) {
+				this.name = name;
+			}
+		}
+
+		/**
+		 * constructor for TabixIndex
+		 *
+		 * @param format	0 for generic 1-based columns, or with UCSC_FORMAT set for 0-based starts
+		 * @param colSeq	the 1-based column of the sequence name
+		 * @param colBeg	the 1-based column of the start position
+		 * @param colEnd	the 1-based column of the end position, or 0 if records are one position long
+		 * @param meta		the first character of comment lines
+		 * @param skip		the number of header lines at the start of the file
+		 */
+		public TabixIndex(int format, int colSeq, int colBeg, int colEnd, int meta, int skip) {
+			this.format = format;
+			this.colSeq = colSeq;
+			this.colBeg = colBeg;
+			this.colEnd = colEnd;
+			this.meta = meta;
+			this.skip = skip;
+		}
+
+		/**
+		 * @return	an empty index for VarScan copynumber output: chrom, chr_start, chr_stop after a header line
+		 */
+		public static TabixIndex forCopynumber() {
+			return new TabixIndex(0, 1, 2, 3, '#', 1);
+		}
+
+		/**
+		 * Finds the sequence and interval of a data line
+		 *
+		 * @param columns	tokenizer left holding the leading columns of the line
+		 * @param line		buffer holding the line
+		 * @param start		offset of the first byte of the line
+		 * @param end		offset just past the last byte of the line, without its newline
+		 * @param interval	set to the 0-based, half-open start and end of the record
+		 * @return	false for comment lines and lines whose positions do not parse
+		 */
+		public boolean parseLine(TabTokenizer columns, byte[] line, int start, int end, int[] interval) {
+			if (end > start && line[end - 1] == '\r') {
+				end--;
+			}
+			if (end == start || line[start] == meta) {
+				return false;
+			}
+
+			int needed = Math.max(colSeq, Math.max(colBeg, colEnd));
+			columns.resetLeading(line, start, end, needed);
+			if (columns.count() < needed) {
+				return false;
+			}
+			try {
+				int beg = columns.intField(colBeg - 1);
+				int stop = (colEnd > 0) ? columns.intField(colEnd - 1) : beg;
+				if ((format & UCSC_FORMAT) == 0) {
+					beg--;
+				}
+				interval[0] = beg;
+				interval[1] = (stop > beg) ? stop : beg + 1;
+				return true;
+			}
+			catch (NumberFormatException e) {
+				return false;
+			}
+		}
+
+		/**
+		 * @param line			buffer holding the line
+		 * @param start			offset of the first byte of the line
+		 * @param end			offset just past the last byte of the line
+		 * @param lineNumber	the 1-based number of the line in the file
+		 * @return	true if the line is one of the header lines at the start of the file, or a comment
+		 */
+		public boolean isHeader(byte[] line, int start, int end, long lineNumber) {
+			return lineNumber <= skip || (end > start && line[start] == meta);
+		}
+
+		/**
+		 * @return	the 0-based column of the sequence name, for reading it from the tokenizer parseLine() was given
+		 */
+		public int sequenceColumn() {
+			return colSeq - 1;
+		}
+
+		/**
+		 * Indexes the next line of the file. Header and comment lines are skipped.
+		 *
+		 * @param line			buffer holding the line
+		 * @param start			offset of the first byte of the line
+		 * @param end			offset just past the last byte of the line, without its newline
+		 * @param offset		offset of the line in the uncompressed file
+		 * @param endOffset		offset just past the line and its newline
+		 */
+		public void add(byte[] line, int start, int end, long offset, long endOffset) {
+			lines++;
+			if (error != null || isHeader(line, start, end, lines)) {
+				return;
+			}
+
+			int[] interval = new int[2];
+			if (!parseLine(columns, line, start, end, interval)) {
+				if (end > start && line[start] != '\r') {
+					error = "line " + lines + " has no position columns";
+				}
+				return;
+			}
+
+			int seq = colSeq - 1;
+			Reference ref = last;
+			if (ref == null || !columns.fieldEquals(seq, ref.name)) {
+				String name = columns.field(seq);
+				if (refsByName.containsKey(name)) {
+					error = "its rows for " + name + " are not together";
+					return;
+				}
+				ref = new Reference(name);
+				refs.add(ref);
+				refsByName.put(name, ref);
+				last = ref;
+			}
+			else if (interval[0] < lastBeg) {
+				error = "its rows for " + ref.name + " are not sorted by position at line " + lines;
+				return;
+			}
+			if (interval[1] > MAX_POSITION) {
+				error = "line " + lines + " ends past the largest indexable position, " + MAX_POSITION;
+				return;
+			}
+			lastBeg = interval[0];
+
+			// Extend the bin's last chunk if the record follows it directly //
+			Integer bin = Integer.valueOf(reg2bin(interval[0], interval[1]));
+			ArrayList<long[]> chunks = ref.bins.get(bin);
+			if (chunks == null) {
+				chunks = new ArrayList<long[]>();
+				ref.bins.put(bin, chunks);
+			}
+			long[] chunk = chunks.isEmpty() ? null : chunks.get(chunks.size() - 1);
+			if (chunk != null && chunk[1] == offset) {
+				chunk[1] = endOffset;
+			}
+			else {
+				chunks.add(new long[] {offset, endOffset});
+			}
+
+			int lastWindow = (interval[1] - 1) >> MIN_SHIFT;
+			if (lastWindow >= ref.linear.length) {
+				ref.linear = Arrays.copyOf(ref.linear, Math.max(2 * ref.linear.length, lastWindow + 1));
+			}
+			for (int window = ref.windows; window <= lastWindow; window++) {
+				ref.linear[window] = -1;
+			}
+			ref.windows = Math.max(ref.windows, lastWindow + 1);
+			for (int window = interval[0] >> MIN_SHIFT; window <= lastWindow; window++) {
+				if (ref.linear[window] < 0) {
+					ref.linear[window] = offset;
+				}
+			}
+		}
+
+		/**
+		 * @return	why the lines added cannot be indexed, or null if they can
+		 */
+		public String getError() {
+			return error;
+		}
+
+		/**
+		 * @return	the number of sequences indexed
+		 */
+		public int getSequences() {
+			return refs.size();
+		}
+
+		/**
+		 * Writes the index of a file built with add(), converting its offsets to virtual offsets
+		 *
+		 * @param indexFile		the file to write
+		 * @param data			the closed BGZF stream the indexed lines were written to
+		 */
+		public void write(String indexFile, BgzfOutputStream data) throws IOException {
+			ByteArrayOutputStream nameBytes = new ByteArrayOutputStream();
+			for (Reference ref : refs) {
+				nameBytes.write(ref.name.getBytes("ISO-8859-1"));
+				nameBytes.write(0);
+			}
+
+			DataOutputStream out = new DataOutputStream(new BufferedOutputStream(new BgzfOutputStream(new FileOutputStream(indexFile), 1)));
+			try {
+				out.write(MAGIC);
+				out.writeInt(Integer.reverseBytes(refs.size()));
+				out.writeInt(Integer.reverseBytes(format));
+				out.writeInt(Integer.reverseBytes(colSeq));
+				out.writeInt(Integer.reverseBytes(colBeg));
+				out.writeInt(Integer.reverseBytes(colEnd));
+				out.writeInt(Integer.reverseBytes(meta));
+				out.writeInt(Integer.reverseBytes(skip));
+				out.writeInt(Integer.reverseBytes(nameBytes.size()));
+				nameBytes.writeTo(out);
+
+				for (Reference ref : refs) {
+					out.writeInt(Integer.reverseBytes(ref.bins.size()));
+					for (Map.Entry<Integer, ArrayList<long[]>> entry : ref.bins.entrySet()) {
+						out.writeInt(Integer.reverseBytes(entry.getKey().intValue()));
+						out.writeInt(Integer.reverseBytes(entry.getValue().size()));
+						for (long[] chunk : entry.getValue()) {
+							out.writeLong(Long.reverseBytes(data.virtualOffset(chunk[0])));
+							out.writeLong(Long.reverseBytes(data.virtualOffset(chunk[1])));
+						}
+					}
+
+					// Empty windows point at the next record: the first one's for leading windows, else the last one's //
+					long previous = -1;
+					for (int window = 0; window < ref.windows && previous < 0; window++) {
+						previous = ref.linear[window];
+					}
+					out.writeInt(Integer.reverseBytes(ref.windows));
+					for (int window = 0; window < ref.windows; window++) {
+						if (ref.linear[window] >= 0) {
+							previous = ref.linear[window];
+						}
+						out.writeLong(Long.reverseBytes(data.virtualOffset(previous)));
+					}
+				}
+				out.writeLong(0);
+			}
+			finally {
+				out.close();
+			}
+		}
+
+		/**
+		 * Loads a tabix index
+		 *
+		 * @param indexFile		the .tbi file
+		 * @return	the index, with virtual offsets
+		 */
+		public static TabixIndex load(String indexFile) throws IOException {
+			DataInputStream in = new DataInputStream(new BgzfInputStream(new BufferedInputStream(new FileInputStream(indexFile), BgzfInputStream.MAX_BLOCK_SIZE), 1));
+			try {
+				byte[] magic = new byte[MAGIC.length];
+				in.readFully(magic);
+				if (!Arrays.equals(magic, MAGIC)) {
+					throw new IOException(indexFile + " is not a tabix index");
+				}
+
+				int sequences = readInt(in);
+				TabixIndex index = new TabixIndex(readInt(in), readInt(in), readInt(in), readInt(in), readInt(in), readInt(in));
+				byte[] nameBytes = new byte[readInt(in)];
+				in.readFully(nameBytes);
+
+				int nameStart = 0;
+				for (int i = 0; i < sequences; i++) {
+					int nameEnd = nameStart;
+					while (nameEnd < nameBytes.length && nameBytes[nameEnd] != 0) {
+						nameEnd++;
+					}
+					Reference ref = new Reference(new String(nameBytes, nameStart, nameEnd - nameStart, "ISO-8859-1"));
+					nameStart = nameEnd + 1;
+
+					int bins = readInt(in);
+					for (int b = 0; b < bins; b++) {
+						Integer bin = Integer.valueOf(readInt(in));
+						int count = readInt(in);
+						ArrayList<long[]> chunks = new ArrayList<long[]>(count);
+						for (int c = 0; c < count; c++) {
+							long chunkBeg = Long.reverseBytes(in.readLong());
+							long chunkEnd = Long.reverseBytes(in.readLong());
+							chunks.add(new long[] {chunkBeg, chunkEnd});
+						}
+						ref.bins.put(bin, chunks);
+					}
+
+					ref.windows = readInt(in);
+					ref.linear = new long[ref.windows];
+					for (int window = 0; window < ref.windows; window++) {
+						ref.linear[window] = Long.reverseBytes(in.readLong());
+					}
+					index.refs.add(ref);
+					index.refsByName.put(ref.name, ref);
+				}
+				return index;
+			}
+			catch (EOFException e) {
+				throw new IOException(indexFile + " is truncated");
+			}
+			finally {
+				in.close();
+			}
+		}
+
+		/**
+		 * Finds where to start reading for the records overlapping a region. Records before the region
+		 * may follow the offset, but none overlapping it precede it.
+		 *
+		 * @param seq		the sequence name
+		 * @param beg		the 0-based start of the region
+		 * @param end		the 0-based end of the region, exclusive
+		 * @return	the virtual offset, or -1 if no records can overlap the region
+		 */
+		public long seekOffset(String seq, int beg, int end) {
+			Reference ref = refsByName.get(seq);
+			if (ref == null || beg >= end) {
+				return -1;
+			}
+			beg = Math.max(beg, 0);
+			end = Math.min(end, MAX_POSITION);
+
+			long minOffset = 0;
+			if (ref.windows > 0) {
+				minOffset = ref.linear[Math.min(beg >> MIN_SHIFT, ref.windows - 1)];
+			}
+
+			long found = -1;
+			int[] bins = reg2bins(beg, end);
+			for (int i = 0; i < bins.length; i++) {
+				ArrayList<long[]> chunks = ref.bins.get(Integer.valueOf(bins[i]));
+				if (chunks == null) {
+					continue;
+				}
+				for (long[] chunk : chunks) {
+					if (chunk[1] > minOffset) {
+						long start = Math.max(chunk[0], minOffset);
+						if (found < 0 || start < found) {
+							found = start;
+						}
+					}
+				}
+			}
+			return found;
+		}
+
+		/**
+		 * @return	the smallest bin containing the 0-based, half-open interval
+		 */
+		static int reg2bin(int beg, int end) {
+			end--;
+			int[] shifts = {14, 17, 20, 23, 26};
+			for (int level = 0; level < shifts.length; level++) {
+				if (beg >> shifts[level] == end >> shifts[level]) {
+					return ((1 << (15 - 3 * level)) - 1) / 7 + (beg >> shifts[level]);
+				}
+			}
+			return 0;
+		}
+
+		/**
+		 * @return	every bin that may hold records overlapping the 0-based, half-open interval
+		 */
+		static int[] reg2bins(int beg, int end) {
+			end--;
+			int[] bins = new int[64];
+			int count = 0;
+			bins[count++] = 0;
+			int[] shifts = {26, 23, 20, 17, 14};
+			int[] firsts = {1, 9, 73, 585, 4681};
+			for (int level = 0; level < shifts.length; level++) {
+				for (int bin = firsts[level] + (beg >> shifts[level]); bin <= firsts[level] + (end >> shifts[level]); bin++) {
+					if (count == bins.length) {
+						bins = Arrays.copyOf(bins, 2 * count);
+					}
+					bins[count++] = bin;
+				}
+			}
+			return Arrays.copyOf(bins, count);
+		}
+
+		private static int readInt(DataInputStream in) throws IOException {
+			return Integer.reverseBytes(in.readInt());
+		}
+	}
+
+
+	/**
+	 * Writes a position-sorted, tab-delimited table as BGZF and indexes it as it goes, writing the tabix
+	 * index next to the file as file + TabixIndex.EXTENSION on close. If the rows turn out not to be
+	 * sortable by the index, a warning is printed and no index is written.
+	 *
+	 */
+	static public class IndexedBgzfOutputStream extends OutputStream {
+		private final String fileName;
+		private final BgzfOutputStream out;
+		private final TabixIndex index;
+		private final PrintStream log;
+
+		// The start of a line split across writes, and the uncompressed offset of the current line //
+		private byte[] partial = new byte[256];
+		private int partialLength = 0;
+		private long lineOffset = 0;
+		private boolean closed = false;
+
+		/**
+		 * constructor for IndexedBgzfOutputStream
+		 *
+		 * @param fileName	the BGZF file to write
+		 * @param index		an empty index describing the table's columns
+		 * @param threads	threads for compressing blocks
+		 */
+		public IndexedBgzfOutputStream(String fileName, TabixIndex index, int threads) throws IOException {
+			this(fileName, index, threads, System.err);
+		}
+
+		/**
+		 * constructor for IndexedBgzfOutputStream
+		 *
+		 * @param fileName	the BGZF file to write
+		 * @param index		an empty index describing the table's columns
+		 * @param threads	threads for compressing blocks
+		 * @param log		stream for the warning when the rows cannot be indexed
+		 */
+		public IndexedBgzfOutputStream(String fileName, TabixIndex index, int threads, PrintStream log) throws IOException {
+			this.fileName = fileName;
+			this.index = index;
+			this.log = log;
+			this.out = new BgzfOutputStream(new FileOutputStream(fileName), threads);
+		}
+
+		public void write(int b) throws IOException {
+			write(new byte[] {(byte) b}, 0, 1);
+		}
+
+		public void write(byte[] b, int off, int len) throws IOException {
+			out.write(b, off, len);
+
+			int lineStart = off;
+			int end = off + len;
+			for (int i = off; i < end; i++) {
+				if (b[i] != '\n') {
+					continue;
+				}
+				long lineEnd = lineOffset + partialLength + (i - lineStart) + 1;
+				if (partialLength == 0) {
+					index.add(b, lineStart, i, lineOffset, lineEnd);
+				}
+				else {
+					appendPartial(b, lineStart, i);
+					index.add(partial, 0, partialLength, lineOffset, lineEnd);
+					partialLength = 0;
+				}
+				lineOffset = lineEnd;
+				lineStart = i + 1;
+			}
+			appendPartial(b, lineStart, end);
+		}
+
+		public void flush() throws IOException {
+			out.flush();
+		}
+
+		public void close() throws IOException {
+			if (closed) {
+				return;
+			}
+			closed = true;
+			if (partialLength > 0) {
+				index.add(partial, 0, partialLength, lineOffset, lineOffset + partialLength);
+				lineOffset += partialLength;
+				partialLength = 0;
+			}
+			out.close();
+
+			String indexFile = fileName + TabixIndex.EXTENSION;
+			if (index.getError() != null) {
+				log.println("Warning: Not indexing " + fileName + " because " + index.getError());
+				new File(indexFile).delete();
+				return;
+			}
+			index.write(indexFile, out);
+		}
+
+		private void appendPartial(byte[] b, int start, int end) {
+			int n = end - start;
+			if (partialLength + n > partial.length) {
+				partial = Arrays.copyOf(partial, Math.max(2 * partial.length, partialLength + n));
+			}
+			System.arraycopy(b, start, partial, partialLength, n);
+			partialLength += n;
+		}
+	}
+
+	/**
+	 * Binary columnar table of copynumber segments, as written by SegmentTableWriter, read through a
+	 * memory map so that loading a file costs no parsing. Rows are stored in row groups of a fixed size
+	 * (the last may be shorter), each holding one primitive array per column, little-endian: log2_ratio
+	 * as double, then chrom (an id into the chromosome dictionary), chr_start, chr_stop and num_positions
+	 * as int, and normal_depth, tumor_depth and gc_content as float. A footer at the end of the file
+	 * holds the chromosome dictionary and the offset and row count of each group.
+	 *
+	 */
+	static public class SegmentTable {
+		public static final String EXTENSION = ".bin";
+		static final byte[] MAGIC = {'V', 'S', 'C', 'T'};
+		static final int VERSION = 1;
+		static final int HEADER_SIZE = 16;
+		static final int TRAILER_SIZE = 12;
+
+		// The int and float columns of a row group, after its log2_ratio column //
+		static final int CHROM = 0;
+		static final int START = 1;
+		static final int STOP = 2;
+		static final int POSITIONS = 3;
+		static final int NORMAL_DEPTH = 4;
+		static final int TUMOR_DEPTH = 5;
+		static final int GC_CONTENT = 6;
+		static final int INT_COLUMNS = 7;
+
+		private final ByteBuffer data;
+		private final int groupSize;
+		private final String[] chroms;
+		private final int[] groupOffsets;
+		private final int[] groupRows;
+		private final int rows;
+
+		private SegmentTable(ByteBuffer data, int groupSize, String[] chroms, int[] groupOffsets, int[] groupRows, int rows) {
+			this.data = data;
+			this.groupSize = groupSize;
+			this.chroms = chroms;
+			this.groupOffsets = groupOffsets;
+			this.groupRows = groupRows;
+			this.rows = rows;
+		}
+
+		/**
+		 * Maps a segment table into memory. The mapping is released when the table is garbage collected.
+		 *
+		 * @param fileName	the table to read
+		 * @return	the table
+		 */
+		public static SegmentTable open(String fileName) throws IOException {
+			RandomAccessFile file = new RandomAccessFile(fileName, "r");
+			ByteBuffer data;
+			try {
+				long size = file.length();
+				if (size > Integer.MAX_VALUE) {
+					throw new IOException(fileName + " is larger than the 2 GB a segment table can map");
+				}
+				data = file.getChannel().map(FileChannel.MapMode.READ_ONLY, 0, size).order(ByteOrder.LITTLE_ENDIAN);
+			}
+			finally {
+				file.close();
+			}
+
+			try {
+				if (!hasMagic(data, 0) || data.getInt(MAGIC.length) != VERSION || !hasMagic(data, data.capacity() - MAGIC.length)) {
+					throw new IOException(fileName + " is not a VarScan segment table");
+				}
+				int groupSize = data.getInt(MAGIC.length + 4);
+
+				ByteBuffer footer = data.duplicate().order(ByteOrder.LITTLE_ENDIAN);
+				footer.position((int) data.getLong(data.capacity() - TRAILER_SIZE));
+				String[] chroms = new String[footer.getInt()];
+				for (int i = 0; i < chroms.length; i++) {
+					byte[] name = new byte[footer.getInt()];
+					footer.get(name);
+					chroms[i] = new String(name, "UTF-8");
+				}
+
+				int groups = footer.getInt();
+				int[] groupOffsets = new int[groups];
+				int[] groupRows = new int[groups];
+				long rows = 0;
+				for (int i = 0; i < groups; i++) {
+					groupOffsets[i] = (int) footer.getLong();
+					groupRows[i] = footer.getInt();
+					rows += groupRows[i];
+				}
+				if (rows > Integer.MAX_VALUE) {
+					throw new IOException(fileName + " has too many rows");
+				}
+				return new SegmentTable(data, groupSize, chroms, groupOffsets, groupRows, (int) rows);
+			}
+			catch (RuntimeException e) {
+				// A footer offset or count past the end of the map //
+				throw new IOException(fileName + " is truncated or corrupt");
+			}
+		}
+
+		private static boolean hasMagic(ByteBuffer data, int offset) {
+			if (offset < 0 || offset + MAGIC.length > data.capacity()) {
+				return false;
+			}
+			for (int i = 0; i < MAGIC.length; i++) {
+				if (data.get(offset + i) != MAGIC[i]) {
+					return false;
+				}
+			}
+			return true;
+		}
+
+		/**
+		 * @return	the number of segments
+		 */
+		public int getRows() {
+			return rows;
+		}
+
+		/**
+		 * @return	the chromosome dictionary, indexed by getChromId()
+		 */
+		public String[] getChromosomes() {
+			return chroms.clone();
+		}
+
+		public int getChromId(int row) {
+			return data.getInt(intColumn(row, CHROM));
+		}
+
+		public String getChrom(int row) {
+			return chroms[getChromId(row)];
+		}
+
+		public int getStart(int row) {
+			return data.getInt(intColumn(row, START));
+		}
+
+		public int getStop(int row) {
+			return data.getInt(intColumn(row, STOP));
+		}
+
+		public int getPositions(int row) {
+			return data.getInt(intColumn(row, POSITIONS));
+		}
+
+		public float getNormalDepth(int row) {
+			return data.getFloat(intColumn(row, NORMAL_DEPTH));
+		}
+
+		public float getTumorDepth(int row) {
+			return data.getFloat(intColumn(row, TUMOR_DEPTH));
+		}
+
+		public float getGCContent(int row) {
+			return data.getFloat(intColumn(row, GC_CONTENT));
+		}
+
+		public double getLog2Ratio(int row) {
+			int group = group(row);
+			return data.getDouble(groupOffsets[group] + 8 * (row - group * groupSize));
+		}
+
+		/**
+		 * @return	the byte offset of a row's value in one of the 4-byte columns
+		 */
+		private int intColumn(int row, int column) {
+			int group = group(row);
+			int count = groupRows[group];
+			return groupOffsets[group] + 8 * count + 4 * (column * count + row - group * groupSize);
+		}
+
+		private int group(int row) {
+			if (row < 0 || row >= rows) {
+				throw new IndexOutOfBoundsException("Row " + row + " of " + rows);
+			}
+			return row / groupSize;
+		}
+	}
+
+
+	/**
+	 * Writes copynumber segments as a SegmentTable. Rows are collected into a row group and written one
+	 * group at a time; without a stream, all rows are kept in memory, to be appended to another writer.
+	 *
+	 */
+	static public class SegmentTableWriter {
+		public static final int DEFAULT_ROW_GROUP_SIZE = 1 << 16;
+
+		private final OutputStream out;
+		private final int groupSize;
+		private long offset = SegmentTable.HEADER_SIZE;
+		private final ArrayList<String> chromNames = new ArrayList<String>();
+		private final HashMap<String, Integer> chromIds = new HashMap<String, Integer>();
+		private String lastChrom = null;
+		private int lastChromId = 0;
+		private long[] groupOffsets = new long[16];
+		private int[] groupRows = new int[16];
+		private int groups = 0;
+
+		// Rows of the current group //
+		private String[] chroms;
+		private int[] starts;
+		private int[] stops;
+		private int[] positions;
+		private float[] normalDepths;
+		private float[] tumorDepths;
+		private double[] log2Ratios;
+		private float[] gcContents;
+		private int count = 0;
+
+		/**
+		 * constructor for SegmentTableWriter that keeps its rows in memory, for addRows()
+		 */
+		public SegmentTableWriter() {
+			this.out = null;
+			this.groupSize = Integer.MAX_VALUE;
+			allocate(1024);
+		}
+
+		/**
+		 * constructor for SegmentTableWriter
+		 *
+		 * @param out		the stream for the table
+		 * @param groupSize	rows per row group
+		 */
+		public SegmentTableWriter(OutputStream out, int groupSize) throws IOException {
+			this.out = out;
+			this.groupSize = Math.max(groupSize, 1);
+			allocate(Math.min(this.groupSize, 1024));
+
+			ByteBuffer header = ByteBuffer.allocate(SegmentTable.HEADER_SIZE).order(ByteOrder.LITTLE_ENDIAN);
+			header.put(SegmentTable.MAGIC).putInt(SegmentTable.VERSION).putInt(this.groupSize);
+			out.write(header.array());
+		}
+
+		/**
+		 * Adds a segment
+		 */
+		public void add(String chrom, int start, int stop, int positionCount, float normalDepth, float tumorDepth, double log2Ratio, float gcContent) throws IOException {
+			if (count == chroms.length) {
+				allocate((int) Math.min(2L * count, groupSize));
+			}
+			chroms[count] = chrom;
+			starts[count] = start;
+			stops[count] = stop;
+			positions[count] = positionCount;
+			normalDepths[count] = normalDepth;
+			tumorDepths[count] = tumorDepth;
+			log2Ratios[count] = log2Ratio;
+			gcContents[count] = gcContent;
+			count++;
+
+			if (count == groupSize) {
+				writeGroup();
+			}
+		}
+
+		/**
+		 * Adds the rows of an in-memory writer, after this writer's own
+		 *
+		 * @param rows	a writer without a stream
+		 */
+		public void addRows(SegmentTableWriter rows) throws IOException {
+			for (int i = 0; i < rows.count; i++) {
+				add(rows.chroms[i], rows.starts[i], rows.stops[i], rows.positions[i], rows.normalDepths[i], rows.tumorDepths[i], rows.log2Ratios[i], rows.gcContents[i]);
+			}
+		}
+
+		/**
+		 * Writes the last row group and the footer. The stream is flushed but not closed.
+		 */
+		public void finish() throws IOException {
+			if (count > 0) {
+				writeGroup();
+			}
+
+			ByteArrayOutputStream bytes = new ByteArrayOutputStream();
+			DataOutputStream footer = new DataOutputStream(bytes);
+			footer.writeInt(Integer.reverseBytes(chromNames.size()));
+			for (String name : chromNames) {
+				byte[] encoded = name.getBytes("UTF-8");
+				footer.writeInt(Integer.reverseBytes(encoded.length));
+				footer.write(encoded);
+			}
+			footer.writeInt(Integer.reverseBytes(groups));
+			for (int i = 0; i < groups; i++) {
+				footer.writeLong(Long.reverseBytes(groupOffsets[i]));
+				footer.writeInt(Integer.reverseBytes(groupRows[i]));
+			}
+			footer.writeLong(Long.reverseBytes(offset));
+			footer.write(SegmentTable.MAGIC);
+
+			bytes.writeTo(out);
+			offset += bytes.size();
+			out.flush();
+		}
+
+		private void writeGroup() throws IOException {
+			// Groups start on an 8-byte boundary, so the double column is aligned //
+			int size = (8 + 4 * SegmentTable.INT_COLUMNS) * count;
+			ByteBuffer group = ByteBuffer.allocate(size + (size % 8)).order(ByteOrder.LITTLE_ENDIAN);
+			for (int i = 0; i < count; i++) {
+				group.putDouble(log2Ratios[i]);
+			}
+			for (int i = 0; i < count; i++) {
+				group.putInt(chromId(chroms[i]));
+			}
+			for (int i = 0; i < count; i++) {
+				group.putInt(starts[i]);
+			}
+			for (int i = 0; i < count; i++) {
+				group.putInt(stops[i]);
+			}
+			for (int i = 0; i < count; i++) {
+				group.putInt(positions[i]);
+			}
+			for (int i = 0; i < count; i++) {
+				group.putFloat(normalDepths[i]);
+			}
+			for (int i = 0; i < count; i++) {
+				group.putFloat(tumorDepths[i]);
+			}
+			for (int i = 0; i < count; i++) {
+				group.putFloat(gcContents[i]);
+			}
+
+			if (groups == groupOffsets.length) {
+				groupOffsets = Arrays.copyOf(groupOffsets, 2 * groups);
+				groupRows = Arrays.copyOf(groupRows, 2 * groups);
+			}
+			groupOffsets[groups] = offset;
+			groupRows[groups] = count;
+			groups++;
+
+			out.write(group.array());
+			offset += group.capacity();
+			Arrays.fill(chroms, 0, count, null);
+			count = 0;
+		}
+
+		private int chromId(String chrom) {
+			if (chrom != lastChrom) {
+				Integer id = chromIds.get(chrom);
+				if (id == null) {
+					id = Integer.valueOf(chromNames.size());
+					chromNames.add(chrom);
+					chromIds.put(chrom, id);
+				}
+				lastChrom = chrom;
+				lastChromId = id.intValue();
+			}
+			return lastChromId;
+		}
+
+		private void allocate(int capacity) {
+			if (chroms == null) {
+				chroms = new String[capacity];
+				starts = new int[capacity];
+				stops = new int[capacity];
+				positions = new int[capacity];
+				normalDepths = new float[capacity];
+				tumorDepths = new float[capacity];
+				log2Ratios = new double[capacity];
+				gcContents = new float[capacity];
+				return;
+			}
+			chroms = Arrays.copyOf(chroms, capacity);
+			starts = Arrays.copyOf(starts, capacity);
+			stops = Arrays.copyOf(stops, capacity);
+			positions = Arrays.copyOf(positions, capacity);
+			normalDepths = Arrays.copyOf(normalDepths, capacity);
+			tumorDepths = Arrays.copyOf(tumorDepths, capacity);
+			log2Ratios = Arrays.copyOf(log2Ratios, capacity);
+			gcContents = Arrays.copyOf(gcContents, capacity);
+		}
+	}
+
+	/**
+	 * Set of genomic regions from --region (chrom, chrom:start or chrom:start-end) and --regions-file
+	 * (tab-delimited chrom, start, stop; or chrom, position). Positions are 1-based and inclusive, and
+	 * overlapping or adjacent regions are merged.
+	 *
+	 */
+	static public class RegionSet {
+		private final LinkedHashMap<String, ArrayList<int[]>> added = new LinkedHashMap<String, ArrayList<int[]>>();
+		private final HashMap<String, int[]> starts = new HashMap<String, int[]>();
+		private final HashMap<String, int[]> ends = new HashMap<String, int[]>();
+		private boolean merged = true;
+
+		/**
+		 * Adds a region
 		 *
-		 *   In order for a table under consideration to have its p-value included
-		 *   in the final result, it must have a p-value less than the original table's P-value, i.e.
-		 *   Fisher's exact test computes the probability, given the observed marginal
-		 *   frequencies, of obtaining exactly the frequencies observed and any configuration more extreme.
-		 *   By "more extreme," we mean any configuration (given observed marginals) with a smaller probability of
-		 *   occurrence in the same direction (one-tailed) or in both directions (two-tailed).
+		 * @param chrom		the chromosome
+		 * @param start		the first position
+		 * @param end		the last position
+		 */
+		public void add(String chrom, int start, int end) {
+			if (end < start) {
+				throw new IllegalArgumentException("Region " + chrom + ":" + start + "-" + end + " ends before it starts");
+			}
+			ArrayList<int[]> regions = added.get(chrom);
+			if (regions == null) {
+				regions = new ArrayList<int[]>();
+				added.put(chrom, regions);
+			}
+			regions.add(new int[] {start, end});
+			merged = false;
+		}
+
+		/**
+		 * Adds a region given as chrom, chrom:start or chrom:start-end, with optional thousands separators
 		 *
-		 * @param a     a, b, c, d are the four cells in a 2x2 matrix
-		 * @param b
-		 * @param c
-		 * @param d
-		 * @return two-tailed P-value
+		 * @param region	the region
 		 */
-		public final double getTwoTailedP(int a, int b, int c, int d) {
-			int min, i;
-			int n = a + b + c + d;
-			if (n > maxSize) {
-				return Double.NaN;
+		public void add(String region) {
+			int colon = region.lastIndexOf(':');
+			if (colon > 0) {
+				String range = region.substring(colon + 1).replace(",", "");
+				int dash = range.indexOf('-');
+				try {
+					int start = Integer.parseInt((dash < 0) ? range : range.substring(0, dash));
+					int end = (dash < 0) ? Integer.MAX_VALUE : Integer.parseInt(range.substring(dash + 1));
+					add(region.substring(0, colon), start, end);
+					return;
+				}
+				catch (NumberFormatException e) {
+					// Not a range, so the colon is part of the chromosome name //
+				}
 			}
-			double p = 0;
+			add(region, 1, Integer.MAX_VALUE);
+		}
 
-			double baseP = getP(a, b, c, d);
-//         in order for a table under consideration to have its p-value included
-//         in the final result, it must have a p-value less than the baseP, i.e.
-//         Fisher's exact test computes the probability, given the observed marginal
-//         frequencies, of obtaining exactly the frequencies observed and any configuration more extreme.
-//         By "more extreme," we mean any configuration (given observed marginals) with a smaller probability of
-//         occurrence in the same direction (one-tailed) or in both directions (two-tailed).
+		/**
+		 * Adds the regions in a file. Header and comment lines, whose positions do not parse, are skipped.
+		 *
+		 * @param regionsFile	tab-delimited chrom, start, stop or chrom, position
+		 */
+		public void addFile(String regionsFile) throws IOException {
+			BufferedReader in = new BufferedReader(new SmartFileReader(regionsFile));
+			try {
+				String line;
+				while ((line = in.readLine()) != null) {
+					String[] lineContents = line.split("\t");
+					if (lineContents.length < 2 || line.startsWith("#")) {
+						continue;
+					}
+					try {
+						int start = Integer.parseInt(lineContents[1]);
+						int end = (lineContents.length > 2) ? Integer.parseInt(lineContents[2]) : start;
+						add(lineContents[0], start, end);
+					}
+					catch (NumberFormatException e) {
+						continue;
+					}
+				}
+			}
+			finally {
+				in.close();
+			}
+		}
 
-			if (DEBUG) {System.out.println("baseP = " + baseP);}
-			int initialA = a, initialB = b, initialC = c, initialD = d;
-			p += baseP;
-			if (DEBUG) {System.out.println("p = " + p);}
-			if (DEBUG) {System.out.println("Starting with R-tail: a=" + a + " b=" + b + " c=" + c + " d=" + d);}
-			min = (c < b) ? c : b;
-			for (i = 0; i < min; i++) {
-				if (DEBUG) {System.out.print("doing round " + i);}
-				double tempP = getP(++a, --b, --c, ++d);
-				if (tempP <= baseP) {
-					if (DEBUG) {System.out.print("\ttempP (" + tempP + ") is less than baseP (" + baseP + ")");}
-					p += tempP;
+		private void merge() {
+			if (merged) {
+				return;
+			}
+			starts.clear();
+			ends.clear();
+
+			for (Map.Entry<String, ArrayList<int[]>> entry : added.entrySet()) {
+				int[][] regions = entry.getValue().toArray(new int[entry.getValue().size()][]);
+				Arrays.sort(regions, new Comparator<int[]>() {
+					public int compare(int[] a, int[] b) {
+						return (a[0] < b[0]) ? -1 : ((a[0] == b[0]) ? 0 : 1);
+					}
+				});
+
+				int[] chromStarts = new int[regions.length];
+				int[] chromEnds = new int[regions.length];
+				int count = 0;
+				for (int i = 0; i < regions.length; i++) {
+					if (count > 0 && (long) regions[i][0] <= (long) chromEnds[count - 1] + 1) {
+						chromEnds[count - 1] = Math.max(chromEnds[count - 1], regions[i][1]);
+					}
+					else {
+						chromStarts[count] = regions[i][0];
+						chromEnds[count] = regions[i][1];
+						count++;
+					}
 				}
-				if (DEBUG) {System.out.println(" a=" + a + " b=" + b + " c=" + c + " d=" + d);}
+				starts.put(entry.getKey(), Arrays.copyOf(chromStarts, count));
+				ends.put(entry.getKey(), Arrays.copyOf(chromEnds, count));
 			}
+			merged = true;
+		}
 
-			// reset the values to their original so we can repeat this process for the other side
-			a = initialA;
-			b = initialB;
-			c = initialC;
-			d = initialD;
+		/**
+		 * @param chrom		the chromosome
+		 * @param position	the position
+		 * @return	true if a region contains the position
+		 */
+		public boolean contains(String chrom, int position) {
+			merge();
+			int[] chromStarts = starts.get(chrom);
+			if (chromStarts == null) {
+				return false;
+			}
+			int i = Arrays.binarySearch(chromStarts, position);
+			if (i < 0) {
+				i = -i - 2;
+			}
+			return i >= 0 && position <= ends.get(chrom)[i];
+		}
 
-			if (DEBUG) {System.out.println("Now doing L-tail: a=" + a + " b=" + b + " c=" + c + " d=" + d);}
-			min = (a < d) ? a : d;
-			if (DEBUG) {System.out.println("min = " + min);}
-			for (i = 0; i < min; i++) {
-				if (DEBUG) {System.out.print("doing round " + i);}
-				double pTemp = getP(--a, ++b, ++c, --d);
-				if (DEBUG) {System.out.println("  pTemp = " + pTemp);}
-				if (pTemp <= baseP) {
-					if (DEBUG) {System.out.print("\ttempP (" + pTemp + ") is less than baseP (" + baseP + ")");}
-					p += pTemp;
+		/**
+		 * @param chrom		the chromosome
+		 * @return	the merged region starts on the chromosome in order, or null if it has none
+		 */
+		public int[] getStarts(String chrom) {
+			merge();
+			return starts.get(chrom);
+		}
+
+		/**
+		 * @param chrom		the chromosome
+		 * @return	the merged region ends on the chromosome, matching getStarts(), or null if it has none
+		 */
+		public int[] getEnds(String chrom) {
+			merge();
+			return ends.get(chrom);
+		}
+
+		/**
+		 * @return	the chromosomes with regions, in the order they were first added
+		 */
+		public String[] getChromosomes() {
+			return added.keySet().toArray(new String[added.size()]);
+		}
+
+		/**
+		 * @return	the number of merged regions
+		 */
+		public int getCount() {
+			merge();
+			int count = 0;
+			for (int[] chromStarts : starts.values()) {
+				count += chromStarts.length;
+			}
+			return count;
+		}
+	}
+
+	/**
+	 * Restricts a ByteLineReader to the lines of a RegionSet, as if the input had been filtered to those
+	 * positions first. With an up-to-date PileupIndex the reader seeks to each region in file order and
+	 * stops at its end; otherwise every line is read, but only its first two columns are parsed to skip it.
+	 *
+	 */
+	static public class RegionFilter {
+		private final RegionSet regions;
+		private final PileupIndex index;
+		private final String fileName;
+		private final int threads;
+		private final TabTokenizer columns = new TabTokenizer();
+		private String chrom = "";
+
+		// One inflate pool for the streams opened at every seek into a BGZF file //
+		private ExecutorService inflatePool = null;
+
+		// With an index, one target per region and chromosome run, in file order //
+		private int targetCount = 0;
+		private int[] targetRuns = new int[16];
+		private int[] targetStarts = new int[16];
+		private int[] targetEnds = new int[16];
+		private int[] targetEntries = new int[16];
+		private long[] targetOffsets = new long[16];
+		private String[] targetChroms = new String[16];
+		private int target = 0;
+		private boolean positioned = false;
+		private boolean haveLine = false;
+		private int lineRun = -1;
+		private int linePosition = 0;
+		private long seeks = 0;
+
+		/**
+		 * constructor for RegionFilter
+		 *
+		 * @param regions	the regions to keep
+		 * @param index		index of the file, or null to scan it
+		 * @param fileName	the file, for reopening at index offsets
+		 * @param threads	threads for decompressing BGZF blocks
+		 */
+		public RegionFilter(RegionSet regions, PileupIndex index, String fileName, int threads) {
+			this.regions = regions;
+			this.index = index;
+			this.fileName = fileName;
+			this.threads = threads;
+
+			if (index != null) {
+				String[] runChroms = index.runChromosomes();
+				for (int run = 0; run < runChroms.length; run++) {
+					int[] starts = regions.getStarts(runChroms[run]);
+					int[] ends = regions.getEnds(runChroms[run]);
+					for (int i = 0; starts != null && i < starts.length; i++) {
+						int entry = index.seekEntry(run, starts[i]);
+						addTarget(run, runChroms[run], starts[i], ends[i], index.entryPosition(run, entry), index.entryOffset(run, entry));
+					}
 				}
-				if (DEBUG) {System.out.println(" a=" + a + " b=" + b + " c=" + c + " d=" + d);}
 			}
-			return p;
 		}
 
-//		public static void main(String[] args) {
-//
-//			int[][] argInts = new int[15][4];
-//			argInts[0] = new int[]{2, 3, 6, 4};
-//			argInts[1] = new int[]{2, 1, 3, 0};
-//			argInts[2] = new int[]{3, 0, 2, 1};
-//			argInts[3] = new int[]{1, 2, 0, 3};
-//			argInts[4] = new int[]{3, 1, 1, 3};
-//			argInts[5] = new int[]{1, 3, 3, 1};
-//			argInts[6] = new int[]{0, 1, 1, 0};
-//			argInts[7] = new int[]{1, 0, 0, 1};
-//			argInts[8] = new int[]{11, 0, 0, 6};
-//			argInts[9] = new int[]{10, 1, 1, 5};
-//			argInts[10] = new int[]{5, 6, 6, 0};
-//			argInts[11] = new int[]{9, 2, 2, 4};
-//			argInts[12] = new int[]{6, 5, 5, 1};
-//			argInts[13] = new int[]{8, 3, 3, 3};
-//			argInts[14] = new int[]{7, 4, 4, 2};
-//
-//			net.sf.varscan.FishersExact fe = new net.sf.varscan.FishersExact(100);
-//
-//			for (int i = 0; i < argInts.length; i++) {
-//				System.out.println("\na=" + argInts[i][0] + " b=" + argInts[i][1] + " c=" + argInts[i][2] + " d=" + argInts[i][3]);
-//				System.out.print("*****Original algorithm: ");
-//				double cumulativeP = fe.getCumlativeP(argInts[i][0], argInts[i][1], argInts[i][2], argInts[i][3]);
-//				System.out.println("\tcumulativeP = " + cumulativeP);
-//
-//				System.out.print("*****Left Tailed: ");
-//				double leftTailedP = fe.getLeftTailedP(argInts[i][0], argInts[i][1], argInts[i][2], argInts[i][3]);
-//				System.out.println("\tleftTailedP = " + leftTailedP);
-//
-//				System.out.print("*****Right Tailed: ");
-//				double rightTailedP = fe.getRightTailedP(argInts[i][0], argInts[i][1], argInts[i][2], argInts[i][3]);
-//				System.out.println("\trightTailedP = " + rightTailedP);
-//
-//				System.out.print("*****Two Tailed: ");
-//				double twoTailedP = fe.getTwoTailedP(argInts[i][0], argInts[i][1], argInts[i][2], argInts[i][3]);
-//				System.out.println("\ttwoTailedP = " + twoTailedP);
-//			}
-//		}
-
+		/**
+		 * Restricts a reader to a set of regions, using the index of its file if it has an up-to-date one
+		 *
+		 * @param in		the reader
+		 * @param fileName	the file being read, or null for STDIN
+		 * @param regions	the regions to keep
+		 * @param threads	threads for decompressing BGZF blocks
+		 * @param log		stream for the message saying how the regions are found
+		 * @return	the reader
+		 */
+		public static ByteLineReader apply(ByteLineReader in, String fileName, RegionSet regions, int threads, PrintStream log) throws IOException {
+			PileupIndex index = (fileName != null) ? PileupIndex.load(fileName, log) : null;
+			String source = (fileName != null) ? fileName : "STDIN";
+			log.println("Limiting " + source + " to " + regions.getCount() + " regions " + ((index != null) ? "using its index" : "by scanning it"));
+			in.setFilter(new RegionFilter(regions, index, fileName, threads));
+			return in;
+		}
+
+		private void addTarget(int run, String runChrom, int start, int end, int entryPosition, long offset) {
+			if (targetCount == targetRuns.length) {
+				int size = 2 * targetCount;
+				targetRuns = Arrays.copyOf(targetRuns, size);
+				targetStarts = Arrays.copyOf(targetStarts, size);
+				targetEnds = Arrays.copyOf(targetEnds, size);
+				targetEntries = Arrays.copyOf(targetEntries, size);
+				targetOffsets = Arrays.copyOf(targetOffsets, size);
+				targetChroms = Arrays.copyOf(targetChroms, size);
+			}
+			targetRuns[targetCount] = run;
+			targetChroms[targetCount] = runChrom;
+			targetStarts[targetCount] = start;
+			targetEnds[targetCount] = end;
+			targetEntries[targetCount] = entryPosition;
+			targetOffsets[targetCount] = offset;
+			targetCount++;
+		}
+
+		/**
+		 * Advances a reader to its next line in the regions
+		 *
+		 * @param reader	the reader this filter was set on
+		 * @return	false when no lines in the regions remain
+		 */
+		boolean next(ByteLineReader reader) throws IOException {
+			if (index == null) {
+				while (reader.nextLine()) {
+					columns.resetLeading(reader.buffer(), reader.lineStart(), reader.lineEnd(), 2);
+					if (columns.count() >= 2) {
+						chrom = columns.fieldEquals(0, chrom) ? chrom : columns.field(0);
+						try {
+							if (regions.contains(chrom, columns.intField(1))) {
+								return true;
+							}
+						}
+						catch (NumberFormatException e) {
+							// Not a pileup line //
+						}
+					}
+				}
+				return false;
+			}
+
+			while (target < targetCount) {
+				// Seek unless the line already read lies past this region's index entry in the same run //
+				if (!positioned) {
+					if (!haveLine || lineRun != targetRuns[target] || targetEntries[target] > linePosition) {
+						if (inflatePool == null && index.isBgzf()) {
+							inflatePool = BgzfInputStream.newInflatePool(threads);
+						}
+						reader.reopen(ByteLineReader.openStreamAt(fileName, inflatePool, threads, targetOffsets[target], index.isBgzf()));
+						seeks++;
+						haveLine = false;
+						lineRun = targetRuns[target];
+					}
+					positioned = true;
+				}
+
+				if (haveLine) {
+					haveLine = false;
+				}
+				else if (!reader.nextLine()) {
+					lineRun = -1;
+					target++;
+					positioned = false;
+					continue;
+				}
+
+				columns.resetLeading(reader.buffer(), reader.lineStart(), reader.lineEnd(), 2);
+				if (columns.count() < 2) {
+					continue;
+				}
+
+				int position;
+				try {
+					position = columns.intField(1);
+				}
+				catch (NumberFormatException e) {
+					continue;
+				}
+
+				if (!columns.fieldEquals(0, targetChroms[target])) {
+					// The chromosome run has ended //
+					lineRun = -1;
+					target++;
+					positioned = false;
+				}
+				else if (position > targetEnds[target]) {
+					// Keep the line for the next region //
+					haveLine = true;
+					linePosition = position;
+					target++;
+					positioned = false;
+				}
+				else if (position >= targetStarts[target]) {
+					return true;
+				}
+			}
+
+			close();
+			return false;
+		}
+
+		/**
+		 * Stops the inflate pool of the seeks; called once the regions are done and when the reader is closed
+		 */
+		void close() {
+			if (inflatePool != null) {
+				inflatePool.shutdownNow();
+				inflatePool = null;
+			}
+		}
+
+		/**
+		 * @return	the number of index seeks made
+		 */
+		public long getSeeks() {
+			return seeks;
+		}
+	}
+
+	/**
+	 * Reusable tab-delimited line tokenizer over a byte slice. A line is scanned once to record column
+	 * boundaries; columns are only copied into Strings or parsed when asked for, so wide columns that
+	 * are never read (such as pileup read bases) cost a scan but no allocation.
+	 *
+	 * Column counts follow String.split("\t"): trailing empty columns are not counted.
+	 */
+	static public class TabTokenizer {
+		private static final Charset LATIN1 = Charset.forName("ISO-8859-1");
+
+		private byte[] line = new byte[0];
+		private int[] starts = new int[16];
+		private int[] ends = new int[16];
+		private int count = 0;
+
+		/**
+		 * Records the column boundaries of a new line. The bytes are not copied, so they must not
+		 * change while the columns are being read.
+		 *
+		 * @param line	buffer holding the line
+		 * @param start	offset of the first byte of the line
+		 * @param end	offset just past the last byte of the line
+		 */
+		public void reset(byte[] line, int start, int end) {
+			this.line = line;
+			count = 0;
+
+			int fieldStart = start;
+			for (int i = start; i < end; i++) {
+				if (line[i] == '\t') {
+					addField(fieldStart, i);
+					fieldStart = i + 1;
+				}
+			}
+			addField(fieldStart, end);
+
+			// Drop trailing empty columns as split() does, unless the line has no tab at all //
+			if (count > 1) {
+				while (count > 0 && starts[count - 1] == ends[count - 1]) {
+					count--;
+				}
+			}
+		}
+
+		/**
+		 * Records the boundaries of only the first columns of a new line, leaving the rest unscanned.
+		 * count() is then at most the number of columns asked for.
+		 *
+		 * @param line		buffer holding the line
+		 * @param start		offset of the first byte of the line
+		 * @param end		offset just past the last byte of the line
+		 * @param fields	the number of leading columns wanted
+		 */
+		public void resetLeading(byte[] line, int start, int end, int fields) {
+			this.line = line;
+			count = 0;
+
+			int fieldStart = start;
+			for (int i = start; i < end && count < fields; i++) {
+				if (line[i] == '\t') {
+					addField(fieldStart, i);
+					fieldStart = i + 1;
+				}
+			}
+			if (count < fields) {
+				addField(fieldStart, end);
+			}
+		}
+
+		private void addField(int start, int end) {
+			if (count == starts.length) {
+				starts = Arrays.copyOf(starts, 2 * count);
+				ends = Arrays.copyOf(ends, 2 * count);
+			}
+			starts[count] = start;
+			ends[count] = end;
+			count++;
+		}
+
+		/**
+		 * @return	the number of columns, as String.split("\t").length would report
+		 */
+		public int count() {
+			return count;
+		}
+
+		/**
+		 * @param i		column index
+		 * @return	the column as a new String
+		 */
+		public String field(int i) {
+			checkIndex(i);
+			return new String(line, starts[i], ends[i] - starts[i], LATIN1);
+		}
+
+		/**
+		 * @param i		column index
+		 * @return	the number of characters in the column
+		 */
+		public int fieldLength(int i) {
+			checkIndex(i);
+			return ends[i] - starts[i];
+		}
+
+		/**
+		 * Compares a column with a String without copying it
+		 *
+		 * @param i		column index
+		 * @param value	the String to compare with
+		 * @return	true if the column equals value
+		 */
+		public boolean fieldEquals(int i, String value) {
+			checkIndex(i);
+			int length = ends[i] - starts[i];
+			if (value.length() != length) {
+				return false;
+			}
+			for (int j = 0; j < length; j++) {
+				if ((line[starts[i] + j] & 0xFF) != value.charAt(j)) {
+					return false;
+				}
+			}
+			return true;
+		}
+
+		/**
+		 * Parses a column as a decimal integer without copying it
+		 *
+		 * @param i		column index
+		 * @return	the integer value of the column
+		 * @throws	NumberFormatException if the column is not an integer, as Integer.parseInt would
+		 */
+		public int intField(int i) {
+			checkIndex(i);
+			int pos = starts[i];
+			int end = ends[i];
+			boolean negative = false;
+
+			if (pos < end && (line[pos] == '-' || line[pos] == '+')) {
+				negative = (line[pos] == '-');
+				pos++;
+			}
+			if (pos >= end) {
+				throw new NumberFormatException("For input string: \"" + field(i) + "\"");
+			}
+
+			// Accumulate in a long so that out-of-range values are rejected as Integer.parseInt does //
+			long limit = negative ? -(long) Integer.MIN_VALUE : Integer.MAX_VALUE;
+			long value = 0;
+			for (; pos < end; pos++) {
+				int digit = line[pos] - '0';
+				if (digit < 0 || digit > 9) {
+					throw new NumberFormatException("For input string: \"" + field(i) + "\"");
+				}
+				value = value * 10 + digit;
+				if (value > limit) {
+					throw new NumberFormatException("For input string: \"" + field(i) + "\"");
+				}
+			}
+			return (int) (negative ? -value : value);
+		}
+
+		/**
+		 * Counts the bases meeting a minimum quality in two base-quality columns without copying them
+		 *
+		 * @param normalColumn	column of normal base qualities
+		 * @param tumorColumn	column of tumor base qualities, or -1 if there is none
+		 * @param minAvgQual	minimum base quality to count a base
+		 * @param depths		receives the normal depth in [0] and the tumor depth in [1]
+		 */
+		public void qualityDepths(int normalColumn, int tumorColumn, int minAvgQual, int[] depths) {
+			checkIndex(normalColumn);
+			if (tumorColumn < 0) {
+				depths[0] = VarScan.qualityDepth(line, starts[normalColumn], ends[normalColumn], minAvgQual);
+				depths[1] = 0;
+				return;
+			}
+			checkIndex(tumorColumn);
+			VarScan.qualityDepths(line, starts[normalColumn], ends[normalColumn], starts[tumorColumn], ends[tumorColumn], minAvgQual, depths);
+		}
+
+		private void checkIndex(int i) {
+			if (i < 0 || i >= count) {
+				throw new ArrayIndexOutOfBoundsException(i);
+			}
+		}
 	}
 
 
@@ -1540,97 +7265,626 @@ public class VarScan {
 
 	}
 
-	final static double MIN_FREQ_FOR_HOM = 0.70;
+	final static double MIN_FREQ_FOR_HOM = 0.70;
+
+	// Fisher's exact test shared by all callers; backed by the process-wide log-factorial table //
+	final static FishersExact sharedFisher = new FishersExact(1000);
+
+	/**
+	 * Runs the main execution logic
+	 * @param args		Command-line arguments
+	 */
+	public static void main(String[] args) {
+
+		String usage = "VarScan v2.4.4\n\n***NON-COMMERCIAL VERSION***\n\nUSAGE: java -jar VarScan.jar [COMMAND] [OPTIONS] \n\n";
+		usage = usage + "COMMANDS:\n" +
+				"\tcopynumber\t\t\tDetermine relative tumor copy number from tumor-normal pileups\n" +
+				"\tcopynumber-batch\t\tRun copynumber for the samples of a manifest, several at a time\n" +
+				"\tserve\t\t\t\tRun copynumber jobs sent to a local TCP port, keeping caches warm between jobs\n" +
+				"\tindex\t\t\t\tWrite a byte-offset index of a sorted pileup or mpileup, plain or BGZF\n" +
+				"\tquery\t\t\t\tPrint the rows of BGZF copynumber output that overlap regions, using its tabix index\n" +
+				"\tview\t\t\t\tPrint binary copynumber output as the text table\n" +
+				"\n";
+
+		if(args.length > 0)
+		{
+			HashMap<String, String> params = getParams(args);
+
+			if(args[0].equals("copynumber"))
+			{
+				copynumber(args, params);
+			}
+
+			else if(args[0].equals("copynumber-batch"))
+			{
+				copynumberBatch(args, params);
+			}
+
+			else if(args[0].equals("serve"))
+			{
+				serve(args, params);
+			}
+
+			else if(args[0].equals("index"))
+			{
+				index(args, params);
+			}
+
+			else if(args[0].equals("query"))
+			{
+				query(args, params);
+			}
+
+			else if(args[0].equals("view"))
+			{
+				view(args, params);
+			}
+
+			else
+			{
+				System.err.println("Command not recognized\n" + usage);
+			}
+		}
+		else
+		{
+			System.err.println(usage);
+		}
+
+	}
+
+
+	/**
+	 * Calls SNPs from a pileup file
+	 *
+	 * @param	args			Command-line arguments and parameters
+	 * @param	callType		"SNP", "INDEL", or "CNS"
+	 */
+
+
+	/**
+	 * Calls SNPs from an mpileup file
+	 *
+	 * @param	args			Command-line arguments and parameters
+	 * @param	callType		"SNP", "INDEL", or "CNS"
+	 */
+
+
+	/**
+	 * Obtains read counts for a list of variants
+	 *
+	 * @param	args	Command-line arguments
+	 */
+
+
+
+	/**
+	 * Calls somatic/germline/LOH variants from normal and tumor pileup files
+	 *
+	 * @param	args	Command-line arguments
+	 */
+
+
+	/**
+	 * Calls SNPs in a father-mother-child trio from an mpileup file
+	 *
+	 * @param	args			Command-line arguments and parameters
+	 * @param	callType		"SNP", "INDEL", or "CNS"
+	 */
+
+
+
+	/**
+	 * Determines tumor copy number from normal and tumor pileup files
+	 *
+	 * @param	args	Command-line arguments
+	 */
+	public static void copynumber(String[] args, HashMap<String, String> params)
+	{
+		if(params.containsKey("mpileup"))
+		{
+			 Copynumber myCopynumber = new Copynumber(args, true);
+		}
+		else
+		{
+			 Copynumber myCopynumber = new Copynumber(args);
+		}
+
+	}
+
+
+	/**
+	 * Determines tumor copy number for many samples listed in a manifest, several at a time
+	 *
+	 * @param	args	Command-line arguments
+	 */
+	public static void copynumberBatch(String[] args, HashMap<String, String> params)
+	{
+		String usage = "USAGE: java -jar VarScan.jar copynumber-batch [manifest] OPTIONS\n" +
+				"\tmanifest - Tab-delimited samples, one per line: input, output base name, and optional copynumber options\n" +
+				"\tThe input is a normal-tumor mpileup, or the normal and tumor pileups separated by a comma.\n" +
+				"\tThe options are separated by spaces and override those given for the whole batch.\n" +
+				"\nOPTIONS:\n" +
+				"\t--sample-threads - Samples to process at once [number of CPUs]\n" +
+				"\t--summary-file - Write the per-sample summary to this file instead of standard output\n" +
+				"\tAny other copynumber option applies to every sample; see copynumber -h\n";
+
+		if(args.length < 2 || args[1].startsWith("-") || params.containsKey("help") || params.containsKey("h"))
+		{
+			System.err.println(usage);
+			return;
+		}
+
+		int sampleThreads = Runtime.getRuntime().availableProcessors();
+
+		try
+		{
+			if(params.containsKey("sample-threads"))
+				sampleThreads = Math.max(Integer.parseInt(params.get("sample-threads")), 1);
+		}
+		catch(Exception e)
+		{
+			System.err.println("Input Parameter Threw Exception: " + e.getLocalizedMessage());
+			System.exit(1);
+		}
+
+		// Options for every sample: all but the batch's own, which take a value //
+		ArrayList<String> batchOptions = new ArrayList<String>();
+		for(int i = 2; i < args.length; i++)
+		{
+			if(args[i].equals("--sample-threads") || args[i].equals("--summary-file"))
+				i++;
+			else
+				batchOptions.add(args[i]);
+		}
+
+		// Read the whole manifest first, so that a bad line stops the batch before any sample runs //
+		SharedCaches caches = new SharedCaches();
+		ArrayList<Copynumber.BatchSample> samples = new ArrayList<Copynumber.BatchSample>();
+		HashMap<String, Integer> outputLines = new HashMap<String, Integer>();
+
+		try
+		{
+			BufferedReader manifest = new BufferedReader(new FileReader(args[1]));
+			String line;
+			int lineNumber = 0;
+
+			while((line = manifest.readLine()) != null)
+			{
+				lineNumber++;
+				if(line.trim().length() == 0 || line.startsWith("#"))
+					continue;
+
+				String[] columns = line.split("\t");
+				String input = columns[0].trim();
+				String outputName = (columns.length > 1) ? columns[1].trim() : "";
+				String[] inputs = input.split(",");
+
+				if(input.length() == 0 || outputName.length() == 0 || inputs.length > 2)
+				{
+					System.err.println("ERROR: Manifest line " + lineNumber + " needs an input (mpileup, or normal,tumor pileups) and an output base name");
+					System.exit(1);
+				}
+
+				if(outputLines.containsKey(outputName))
+				{
+					System.err.println("ERROR: Manifest lines " + outputLines.get(outputName) + " and " + lineNumber + " both write " + outputName);
+					System.exit(1);
+				}
+				outputLines.put(outputName, lineNumber);
+
+				// Arguments as the copynumber command would get them, with the sample's options last so they win //
+				ArrayList<String> sampleArgs = new ArrayList<String>();
+				sampleArgs.add("copynumber");
+				for(int i = 0; i < inputs.length; i++)
+					sampleArgs.add(inputs[i].trim());
+				sampleArgs.add(outputName);
+				sampleArgs.addAll(batchOptions);
+				for(int col = 2; col < columns.length; col++)
+				{
+					String[] options = columns[col].trim().split("\\s+");
+					for(int i = 0; i < options.length; i++)
+					{
+						if(options[i].length() > 0)
+							sampleArgs.add(options[i]);
+					}
+				}
+
+				samples.add(new Copynumber.BatchSample(lineNumber, input, outputName, sampleArgs.toArray(new String[sampleArgs.size()]), caches));
+			}
+
+			manifest.close();
+		}
+		catch(IOException e)
+		{
+			System.err.println("ERROR: Unable to read manifest " + args[1] + ": " + e.getLocalizedMessage());
+			System.exit(10);
+		}
+
+		// Run the samples on the pool, printing each one's messages as it finishes //
+		long startTime = System.nanoTime();
+		int threads = Math.min(sampleThreads, Math.max(samples.size(), 1));
+		ExecutorService pool = Executors.newFixedThreadPool(threads, daemonThreadFactory("copynumber-batch"));
+		ExecutorCompletionService<Copynumber.BatchSample> completed = new ExecutorCompletionService<Copynumber.BatchSample>(pool);
+		for(Copynumber.BatchSample sample : samples)
+			completed.submit(sample);
+
+		int failed = 0;
+		long sampleMillis = 0;
+
+		try
+		{
+			for(int done = 1; done <= samples.size(); done++)
+			{
+				Copynumber.BatchSample sample = completed.take().get();
+				System.err.println("Sample " + sample.outputName + " (manifest line " + sample.number + "):");
+				sample.messages.writeTo(System.err);
+				System.err.println("Sample " + sample.outputName + " " + ((sample.exitStatus == 0) ? "finished" : "FAILED with status " + sample.exitStatus) + " in " + sample.millis + " ms, " + done + " of " + samples.size() + " done");
+				if(sample.exitStatus != 0)
+					failed++;
+				sampleMillis += sample.millis;
+			}
+		}
+		catch(Exception e)
+		{
+			System.err.println("ERROR: Batch interrupted: " + e.getLocalizedMessage());
+			System.exit(11);
+		}
+		pool.shutdown();
+
+		// Per-sample summary, in manifest order //
+		String summaryFile = params.get("summary-file");
+		int exitStatus = 0;
+
+		try
+		{
+			PrintStream summary = (summaryFile != null) ? new PrintStream(new BufferedOutputStream(new FileOutputStream(summaryFile))) : System.out;
+			summary.println("output\tinput\texit_status\tmilliseconds\tshared_positions\tcompared_positions\traw_segments\tgood_segments");
+			for(Copynumber.BatchSample sample : samples)
+			{
+				Copynumber result = sample.result;
+				summary.print(sample.outputName + "\t" + sample.input + "\t" + sample.exitStatus + "\t" + sample.millis);
+				if(result != null)
+					summary.println("\t" + result.getSharedPositions() + "\t" + result.getComparedPositions() + "\t" + result.getRawSegments() + "\t" + result.getGoodSegments());
+				else
+					summary.println("\t0\t0\t0\t0");
+				if(exitStatus == 0)
+					exitStatus = sample.exitStatus;
+			}
+			summary.flush();
+			if(summary.checkError())
+				throw new IOException("write failed");
+			if(summaryFile != null)
+				summary.close();
+		}
+		catch(IOException e)
+		{
+			System.err.println("ERROR: Failed to write " + ((summaryFile != null) ? summaryFile : "summary") + ": " + e.getLocalizedMessage());
+			System.exit(11);
+		}
+
+		System.err.println(samples.size() + " samples, " + failed + " failed, in " + (System.nanoTime() - startTime) / 1000000 + " ms on " + threads + " threads (" + sampleMillis + " ms of sample time)");
+		for(CriticalDepthCache criticalDepths : caches.getCaches())
+		{
+			System.err.println("Change-point caches shared for p-value " + criticalDepths.getThreshold() + ":");
+			Copynumber.printCacheStats(criticalDepths.getPValueCache(), criticalDepths, System.err);
+		}
+
+		// A failed sample fails the batch, with the status of the first in the manifest //
+		if(exitStatus != 0)
+			System.exit(exitStatus);
+	}
+
+
+	/**
+	 * Runs copynumber jobs sent to a local TCP port until a client asks the server to shut down
+	 *
+	 * @param	args	Command-line arguments
+	 */
+	public static void serve(String[] args, HashMap<String, String> params)
+	{
+		String usage = "USAGE: java -jar VarScan.jar serve OPTIONS\n" +
+				"\tListens on 127.0.0.1 for copynumber jobs and runs them on a pool of workers, which keep the p-value\n" +
+				"\tcaches warm between jobs. Each request is a line of arguments separated by tabs, or by spaces if the\n" +
+				"\tline has no tabs. Paths are relative to the working directory of the server.\n" +
+				"\tThe server writes a random access token to the token file, readable only by the user running it, and\n" +
+				"\trefuses connections whose first line is not that token. Anyone who can read the token file can run\n" +
+				"\tjobs that read and write files as that user, or shut the server down.\n" +
+				"\t\tcopynumber [input(s)] [output] OPTIONS - Run a job as the copynumber command would; answers with\n" +
+				"\t\t\tthe job's messages, then DONE, job number, exit status, ms queued and ms running\n" +
+				"\t\tstatus - Answers with the queue depth, job counts and latencies, cache statistics and recent jobs,\n" +
+				"\t\t\tthen DONE\n" +
+				"\t\tshutdown - Stop taking jobs, and exit when the jobs already taken are done\n" +
+				"\nOPTIONS:\n" +
+				"\t--port - Local TCP port to listen on, 0 for any free port [0]\n" +
+				"\t--token-file - File to write the access token to, replaced at each start [varscan-serve.token]\n" +
+				"\t--workers - Jobs to run at once [number of CPUs]\n";
+
+		if(params.containsKey("help") || params.containsKey("h"))
+		{
+			System.err.println(usage);
+			return;
+		}
+
+		int port = 0;
+		int workers = Runtime.getRuntime().availableProcessors();
+		String tokenFile = "varscan-serve.token";
+
+		try
+		{
+			if(params.containsKey("port"))
+				port = Integer.parseInt(params.get("port"));
+
+			if(params.containsKey("workers"))
+				workers = Math.max(Integer.parseInt(params.get("workers")), 1);
+
+			if(params.containsKey("token-file"))
+				tokenFile = params.get("token-file");
+		}
+		catch(Exception e)
+		{
+			System.err.println("Input Parameter Threw Exception: " + e.getLocalizedMessage());
+			System.exit(1);
+		}
+
+		String token = null;
+		try
+		{
+			token = Copynumber.Server.writeToken(new File(tokenFile));
+		}
+		catch(IOException e)
+		{
+			System.err.println("ERROR: Unable to write the access token to " + tokenFile + ": " + e.getLocalizedMessage());
+			System.exit(10);
+		}
+
+		Copynumber.Server server = null;
+		try
+		{
+			server = new Copynumber.Server(port, workers, token);
+		}
+		catch(IOException e)
+		{
+			System.err.println("ERROR: Unable to listen on port " + port + ": " + e.getLocalizedMessage());
+			new File(tokenFile).delete();
+			System.exit(10);
+		}
+
+		System.err.println("Listening for copynumber jobs on 127.0.0.1:" + server.getPort() + " with " + server.getWorkers() + " workers; access token in " + tokenFile);
+
+		try
+		{
+			server.run();
+		}
+		catch(IOException e)
+		{
+			System.err.println("ERROR: Server stopped: " + e.getLocalizedMessage());
+			new File(tokenFile).delete();
+			System.exit(11);
+		}
+		new File(tokenFile).delete();
+
+		System.err.println(server.getCompleted() + " jobs served, " + server.getFailed() + " failed");
+	}
+
 
 	/**
-	 * Runs the main execution logic
-	 * @param args		Command-line arguments
+	 * Writes a sidecar byte-offset index for a sorted pileup or mpileup file
+	 *
+	 * @param	args	Command-line arguments
 	 */
-	public static void main(String[] args) {
+	public static void index(String[] args, HashMap<String, String> params)
+	{
+		String usage = "USAGE: java -jar VarScan.jar index [pileup or mpileup file] OPTIONS\n" +
+				"\tWrites [file]" + PileupIndex.EXTENSION + ", mapping each chromosome and every K positions to a byte\n" +
+				"\toffset (or BGZF virtual offset) for seeking\n" +
+				"\nOPTIONS:\n" +
+				"\t--index-interval - Positions between index entries within a chromosome (K) [" + PileupIndex.DEFAULT_INTERVAL + "]\n" +
+				"\t--decompress-threads - Threads for decompressing BGZF input [number of CPUs]\n";
+
+		if(args.length < 2 || args[1].startsWith("-") || params.containsKey("help") || params.containsKey("h"))
+		{
+			System.err.println(usage);
+			return;
+		}
 
-		String usage = "VarScan v2.4.4\n\n***NON-COMMERCIAL VERSION***\n\nUSAGE: java -jar VarScan.jar [COMMAND] [OPTIONS] \n\n";
-		usage = usage + "COMMANDS:\n" +
-				"\tcopynumber\t\t\tDetermine relative tumor copy number from tumor-normal pileups\n" +
-				"\n";
+		int interval = PileupIndex.DEFAULT_INTERVAL;
+		int threads = Runtime.getRuntime().availableProcessors();
 
-		if(args.length > 0)
+		try
 		{
-			HashMap<String, String> params = getParams(args);
-
-			if(args[0].equals("copynumber"))
-			{
-				copynumber(args, params);
-			}
+			if(params.containsKey("index-interval"))
+				interval = Integer.parseInt(params.get("index-interval"));
 
-			else
-			{
-				System.err.println("Command not recognized\n" + usage);
-			}
+			if(params.containsKey("decompress-threads"))
+				threads = Integer.parseInt(params.get("decompress-threads"));
 		}
-		else
+		catch(Exception e)
 		{
-			System.err.println(usage);
+			System.err.println("Input Parameter Threw Exception: " + e.getLocalizedMessage());
+			System.exit(1);
 		}
 
+		try
+		{
+			PileupIndex index = PileupIndex.build(args[1], Math.max(interval, 1), threads);
+			index.write(args[1] + PileupIndex.EXTENSION);
+			System.err.println(index.runChromosomes().length + " chromosome runs, " + index.getEntries() + " index entries written to " + args[1] + PileupIndex.EXTENSION);
+		}
+		catch(IOException e)
+		{
+			System.err.println("ERROR: Unable to index " + args[1] + ": " + e.getLocalizedMessage());
+			System.exit(10);
+		}
 	}
 
 
 	/**
-	 * Calls SNPs from a pileup file
-	 *
-	 * @param	args			Command-line arguments and parameters
-	 * @param	callType		"SNP", "INDEL", or "CNS"
-	 */
-
-
-	/**
-	 * Calls SNPs from an mpileup file
+	 * Prints the rows of a tabix-indexed BGZF table, such as copynumber output, that overlap regions
 	 *
-	 * @param	args			Command-line arguments and parameters
-	 * @param	callType		"SNP", "INDEL", or "CNS"
+	 * @param	args	Command-line arguments
 	 */
+	public static void query(String[] args, HashMap<String, String> params)
+	{
+		String usage = "USAGE: java -jar VarScan.jar query [file.gz] [regions] OPTIONS\n" +
+				"\tPrints the rows of a BGZF file indexed as [file.gz]" + TabixIndex.EXTENSION + ", such as copynumber --output-bgzf\n" +
+				"\toutput, that overlap the regions, given as chrom, chrom:start or chrom:start-end\n" +
+				"\nOPTIONS:\n" +
+				"\t--regions-file - Also query the regions of this file, as tab-delimited chrom, start, stop\n" +
+				"\t--print-header - If set to 1, print the header lines of the file first [0]\n";
+
+		if(args.length < 2 || args[1].startsWith("-") || params.containsKey("help") || params.containsKey("h"))
+		{
+			System.err.println(usage);
+			return;
+		}
 
+		String fileName = args[1];
+		RegionSet regions = new RegionSet();
+		boolean printHeader = false;
 
-	/**
-	 * Obtains read counts for a list of variants
-	 *
-	 * @param	args	Command-line arguments
-	 */
+		try
+		{
+			// Regions come before the options //
+			for(int i = 2; i < args.length && !args[i].startsWith("-"); i++)
+				regions.add(args[i]);
 
+			if(params.containsKey("regions-file"))
+				regions.addFile(params.get("regions-file"));
 
+			if(params.containsKey("print-header"))
+				printHeader = Integer.parseInt(params.get("print-header")) == 1;
+		}
+		catch(Exception e)
+		{
+			System.err.println("Input Parameter Threw Exception: " + e.getLocalizedMessage());
+			System.exit(1);
+		}
 
-	/**
-	 * Calls somatic/germline/LOH variants from normal and tumor pileup files
-	 *
-	 * @param	args	Command-line arguments
-	 */
+		if(regions.getCount() == 0 && !printHeader)
+		{
+			System.err.println(usage);
+			return;
+		}
 
+		try
+		{
+			long startTime = System.nanoTime();
+			TabixIndex index = TabixIndex.load(fileName + TabixIndex.EXTENSION);
+			BufferedOutputStream out = new BufferedOutputStream(System.out, 1 << 16);
+			TabTokenizer columns = new TabTokenizer();
+			int[] interval = new int[2];
+			long rows = 0;
+
+			if(printHeader)
+			{
+				ByteLineReader in = ByteLineReader.open(fileName, BgzfInputStream.MAX_BLOCK_SIZE, 1);
+				try
+				{
+					while(in.next() && index.isHeader(in.buffer(), in.lineStart(), in.lineEnd(), in.getLines()))
+					{
+						out.write(in.buffer(), in.lineStart(), in.lineEnd() - in.lineStart());
+						out.write('\n');
+					}
+				}
+				finally
+				{
+					in.close();
+				}
+			}
 
-	/**
-	 * Calls SNPs in a father-mother-child trio from an mpileup file
-	 *
-	 * @param	args			Command-line arguments and parameters
-	 * @param	callType		"SNP", "INDEL", or "CNS"
-	 */
+			for(String chrom : regions.getChromosomes())
+			{
+				int[] starts = regions.getStarts(chrom);
+				int[] ends = regions.getEnds(chrom);
+				for(int i = 0; i < starts.length; i++)
+				{
+					// Regions are 1-based and inclusive; the index is 0-based and half-open //
+					int beg = starts[i] - 1;
+					int end = ends[i];
+					long offset = index.seekOffset(chrom, beg, end);
+					if(offset < 0)
+						continue;
+
+					// Rows are sorted by start, so stop at the first past the region or off the chromosome //
+					ByteLineReader in = ByteLineReader.openAt(fileName, BgzfInputStream.MAX_BLOCK_SIZE, 1, offset, true);
+					try
+					{
+						while(in.next())
+						{
+							if(!index.parseLine(columns, in.buffer(), in.lineStart(), in.lineEnd(), interval))
+								continue;
+							if(!columns.fieldEquals(index.sequenceColumn(), chrom) || interval[0] >= end)
+								break;
+							if(interval[1] > beg)
+							{
+								out.write(in.buffer(), in.lineStart(), in.lineEnd() - in.lineStart());
+								out.write('\n');
+								rows++;
+							}
+						}
+					}
+					finally
+					{
+						in.close();
+					}
+				}
+			}
 
+			out.flush();
+			System.err.println(rows + " rows overlapping " + regions.getCount() + " regions in " + (System.nanoTime() - startTime) / 1000000 + " ms");
+		}
+		catch(IOException e)
+		{
+			System.err.println("ERROR: Unable to query " + fileName + ": " + e.getLocalizedMessage());
+			System.exit(10);
+		}
+	}
 
 
 	/**
-	 * Determines tumor copy number from normal and tumor pileup files
+	 * Converts a binary copynumber segment table back to the text .copynumber table
 	 *
 	 * @param	args	Command-line arguments
 	 */
-	public static void copynumber(String[] args, HashMap<String, String> params)
+	public static void view(String[] args, HashMap<String, String> params)
 	{
-		if(params.containsKey("mpileup"))
+		String usage = "USAGE: java -jar VarScan.jar view [copynumber.bin] OPTIONS\n" +
+				"\tPrints a segment table written by copynumber --output-binary as the text .copynumber table\n" +
+				"\nOPTIONS:\n" +
+				"\t--output-file - Write the table to this file instead of standard output\n";
+
+		if(args.length < 2 || args[1].startsWith("-") || params.containsKey("help") || params.containsKey("h"))
 		{
-			 Copynumber myCopynumber = new Copynumber(args, true);
+			System.err.println(usage);
+			return;
 		}
-		else
+
+		try
 		{
-			 Copynumber myCopynumber = new Copynumber(args);
-		}
+			SegmentTable table = SegmentTable.open(args[1]);
+			OutputStream stream = params.containsKey("output-file") ? new FileOutputStream(params.get("output-file")) : System.out;
+			Copynumber.SegmentWriter out = new Copynumber.SegmentWriter(stream, Copynumber.SegmentWriter.DEFAULT_BUFFER_SIZE);
+			out.println(Copynumber.SegmentWriter.HEADER);
+
+			String[] chroms = table.getChromosomes();
+			for(int row = 0; row < table.getRows(); row++)
+			{
+				out.writeRow(chroms[table.getChromId(row)], table.getStart(row), table.getStop(row), table.getPositions(row),
+						table.getNormalDepth(row), table.getTumorDepth(row), table.getLog2Ratio(row), table.getGCContent(row));
+			}
 
+			out.close();
+			if(out.checkError())
+			{
+				System.err.println("ERROR: Failed to write the table of " + args[1]);
+				System.exit(11);
+			}
+		}
+		catch(IOException e)
+		{
+			System.err.println("ERROR: Unable to read " + args[1] + ": " + e.getLocalizedMessage());
+			System.exit(10);
+		}
 	}
 
 
@@ -1825,6 +8079,69 @@ public class VarScan {
 	}
 
 
+	/**
+	 * Creates daemon threads for worker pools, so that a pool never keeps the JVM alive
+	 *
+	 * @param	name	Name prefix for the threads
+	 * @return			Thread factory for Executors
+	 */
+	static ThreadFactory daemonThreadFactory(final String name)
+	{
+		return new ThreadFactory() {
+			private int count = 0;
+
+			public synchronized Thread newThread(Runnable r) {
+				Thread thread = new Thread(r, name + "-" + (++count));
+				thread.setDaemon(true);
+				return thread;
+			}
+		};
+	}
+
+	/**
+	 * Gets the name of the input file given on the command line, as getByteInfile would read it
+	 *
+	 * @param	args	Command-line arguments
+	 * @return			The file name, or null if input comes from STDIN
+	 */
+	static String getInfileName(String[] args)
+	{
+		if(args.length > 1 && !args[1].startsWith("-") && new File(args[1]).exists())
+			return args[1];
+
+		return null;
+	}
+
+	/**
+	 * Gets the infile from command line or input buffer as a byte-oriented line reader.
+	 * Unlike getInfile this does not wait for piped input; see ByteLineReader.awaitInput.
+	 *
+	 * @param	args		Command-line arguments
+	 * @param	bufferSize	Size in bytes of the read buffer
+	 * @param	threads		Threads for decompressing a BGZF input file
+	 * @param	log			Stream for the message naming the input
+	 * @return				Line reader for the input file or STDIN
+	 */
+	static ByteLineReader getByteInfile(String[] args, int bufferSize, int threads, PrintStream log) throws IOException
+	{
+		// Check for file on command line //
+
+		if(args.length > 1 && !args[1].startsWith("-") && new File(args[1]).exists())
+		{
+			// Parse the infile //
+			log.println("Reading input from " + args[1]);
+			return ByteLineReader.open(args[1], bufferSize, threads);
+		}
+
+		// If no file from command line was parsed, try for piped input //
+
+		// Callers wait for piped input with ByteLineReader.awaitInput() rather than polling //
+
+		log.println("Reading input from STDIN");
+		return new ByteLineReader(System.in, bufferSize);
+	}
+
+
 	/**
 	 * Counts the depth of read bases meeting a minimum quality
 	 *
@@ -1859,6 +8176,58 @@ public class VarScan {
 	}
 
 
+	/**
+	 * Counts the depth of read bases meeting a minimum quality directly in a byte buffer
+	 *
+	 * @param	buffer		Bytes holding Phred+33 base qualities
+	 * @param	start		Offset of the first quality byte
+	 * @param	end			Offset just past the last quality byte
+	 * @param	minAvgQual	Integer of minimum required base quality to count a base.
+	 * @return	qualityDepth	Number of bases at or above the minimum quality
+	 */
+	static int qualityDepth(byte[] buffer, int start, int end, int minAvgQual)
+	{
+		// (quality - minByte) >>> 31 is 1 for a base below the minimum, so the count needs no branches //
+		int minByte = minAvgQual + 33;
+		int below0 = 0, below1 = 0, below2 = 0, below3 = 0;
+		int j = start;
+
+		// Four independent counters let the loop pipeline (and the JIT vectorize it) //
+		for(; j + 4 <= end; j += 4)
+		{
+			below0 += ((buffer[j] & 0xFF) - minByte) >>> 31;
+			below1 += ((buffer[j + 1] & 0xFF) - minByte) >>> 31;
+			below2 += ((buffer[j + 2] & 0xFF) - minByte) >>> 31;
+			below3 += ((buffer[j + 3] & 0xFF) - minByte) >>> 31;
+		}
+
+		for(; j < end; j++)
+		{
+			below0 += ((buffer[j] & 0xFF) - minByte) >>> 31;
+		}
+
+		return((end - start) - (below0 + below1 + below2 + below3));
+	}
+
+
+	/**
+	 * Counts the depth of normal and tumor read bases meeting a minimum quality from one buffer
+	 *
+	 * @param	buffer			Bytes holding both samples' Phred+33 base qualities, e.g. an mpileup line
+	 * @param	normalStart		Offset of the first normal quality byte
+	 * @param	normalEnd		Offset just past the last normal quality byte
+	 * @param	tumorStart		Offset of the first tumor quality byte
+	 * @param	tumorEnd		Offset just past the last tumor quality byte
+	 * @param	minAvgQual		Integer of minimum required base quality to count a base.
+	 * @param	depths			Receives the normal depth in [0] and the tumor depth in [1]
+	 */
+	static void qualityDepths(byte[] buffer, int normalStart, int normalEnd, int tumorStart, int tumorEnd, int minAvgQual, int[] depths)
+	{
+		depths[0] = qualityDepth(buffer, normalStart, normalEnd, minAvgQual);
+		depths[1] = qualityDepth(buffer, tumorStart, tumorEnd, minAvgQual);
+	}
+
+
 	/**
 	 * Calculates significance of read counts between two samples
 	 *
@@ -1884,45 +8253,175 @@ public class VarScan {
 		if(obsReads2 < 0)
 			obsReads2 = 0;
 
-		// Set up fisher's exact test //
+		// Calculate a p-value with the shared Fisher's exact test; its log-factorial table grows on demand //
 
-		FishersExact fisher = new FishersExact(expReads1 + expReads2 + obsReads1 + obsReads2 + 100);
+		pValue = sharedFisher.getRightTailedP(expReads1, expReads2, obsReads1, obsReads2);
 
-		// Calculate a p-value //
+		if(Double.isNaN(pValue))
+			System.err.println("Warning: unable to calculate p-value failure: " + expReads1 + "," + expReads2 + "," + obsReads1 + "," + obsReads2);
 
-		pValue = fisher.getRightTailedP(expReads1, expReads2, obsReads1, obsReads2);
-		int fisher_max = 1000;
-		int num_tries = 0;
+		// If p-value is 1, do left-sided test //
 
-		while(Double.isNaN(pValue) && num_tries < 10)
+		if(pValue >= 0.999)
 		{
-			fisher = new FishersExact(expReads1 + expReads2 + obsReads1 + obsReads2 + fisher_max);
-			//pValue = fisher.getTwoTailedP(expReads1, expReads2, obsReads1, obsReads2);
-			pValue = fisher.getRightTailedP(expReads1, expReads2, obsReads1, obsReads2);
-			fisher_max = fisher_max + 1000;
-			num_tries++;
+			pValue = sharedFisher.getLeftTailedP(expReads1, expReads2, obsReads1, obsReads2);
 		}
 
-		if(num_tries >= 10)
-			System.err.println("Warning: unable to calculate p-value failure: " + expReads1 + "," + expReads2 + "," + obsReads1 + "," + obsReads2);
+		return(pValue);
+	}
+
+
+
+	/**
+	 * Calculates significance of read counts only as precisely as needed to compare it with a threshold
+	 *
+	 * @param	expReads1	Reads supporting allele 1 (expected)
+	 * @param	expReads2	Reads supporting allele 2 (expected)
+	 * @param	obsReads1	Reads supporting allele 1 (observed)
+	 * @param	obsReads2	Reads supporting allele 2 (observed)
+	 * @param	threshold	P-value threshold the result will be compared against
+	 * @return	p-value 	P-value from getSignificance if it is below threshold (or NaN), otherwise a lower bound >= threshold
+	 */
+	public static double getSignificance(int expReads1, int expReads2, int obsReads1, int obsReads2, double threshold)
+	{
+		// Early termination relies on the left-sided switch at 0.999 lying above the threshold //
+		if(!(threshold > 0 && threshold < 0.999))
+			return(getSignificance(expReads1, expReads2, obsReads1, obsReads2));
+
+		if(expReads1 < 0)
+			expReads1 = 0;
+
+		if(expReads2 < 0)
+			expReads2 = 0;
+
+		if(obsReads1 < 0)
+			obsReads1 = 0;
+
+		if(obsReads2 < 0)
+			obsReads2 = 0;
+
+		// If the right tail is below threshold, it is the p-value getSignificance would return //
+
+		double rightP = sharedFisher.getRightTailedP(expReads1, expReads2, obsReads1, obsReads2, threshold);
+
+		if(Double.isNaN(rightP))
+			return(getSignificance(expReads1, expReads2, obsReads1, obsReads2));
+
+		if(rightP < threshold)
+			return(rightP);
+
+		// Both tails share the observed table, so rightP = 1 + observedP - leftP. A left tail above //
+		// 0.001 + observedP therefore proves the right tail is below 0.999 and is the p-value returned //
+
+		double observedP = sharedFisher.getP(expReads1, expReads2, obsReads1, obsReads2);
+		double rightTailCertain = 0.001 + observedP + 1e-9;
+		double leftP = sharedFisher.getLeftTailedP(expReads1, expReads2, obsReads1, obsReads2, Math.min(threshold, rightTailCertain));
+
+		if(leftP >= threshold)
+			return(Math.min(rightP, leftP));
+
+		if(leftP >= rightTailCertain)
+			return(rightP);
+
+		// Otherwise the left tail is small, so take the exact path //
+
+		return(getSignificance(expReads1, expReads2, obsReads1, obsReads2));
+	}
+
+
+
+	/**
+	 * Approximates significance of read counts between two samples for large read counts. Tables with a
+	 * thin row or column, and tables whose approximate right tail lies near the switch to the left tail,
+	 * get the exact p-value of getSignificance instead.
+	 *
+	 * @param	expReads1	Reads supporting allele 1 (expected)
+	 * @param	expReads2	Reads supporting allele 2 (expected)
+	 * @param	obsReads1	Reads supporting allele 1 (observed)
+	 * @param	obsReads2	Reads supporting allele 2 (observed)
+	 * @return	p-value 	Normal approximation to the p-value from getSignificance
+	 */
+	public static double getApproximateSignificance(int expReads1, int expReads2, int obsReads1, int obsReads2)
+	{
+		if(expReads1 < 0)
+			expReads1 = 0;
+
+		if(expReads2 < 0)
+			expReads2 = 0;
+
+		if(obsReads1 < 0)
+			obsReads1 = 0;
+
+		if(obsReads2 < 0)
+			obsReads2 = 0;
+
+		// A large total is not enough: a deep normal beside a thin tumor leaves small cells //
+
+		if(!FishersExact.isNormalApproximable(expReads1, expReads2, obsReads1, obsReads2))
+			return(getSignificance(expReads1, expReads2, obsReads1, obsReads2));
+
+		double pValue = sharedFisher.getNormalRightTailedP(expReads1, expReads2, obsReads1, obsReads2);
+
+		// Near 0.999 the approximate right tail cannot tell which tail to report, so use the exact rule //
+
+		if(pValue >= 0.99 && pValue < 0.9999)
+			return(getSignificance(expReads1, expReads2, obsReads1, obsReads2));
 
 		// If p-value is 1, do left-sided test //
 
 		if(pValue >= 0.999)
-		{
-			pValue = fisher.getLeftTailedP(expReads1, expReads2, obsReads1, obsReads2);
+			pValue = sharedFisher.getNormalLeftTailedP(expReads1, expReads2, obsReads1, obsReads2);
 
-			while(Double.isNaN(pValue))
-			{
-				fisher = new FishersExact(expReads1 + expReads2 + obsReads1 + obsReads2 + fisher_max);
-				//pValue = fisher.getTwoTailedP(expReads1, expReads2, obsReads1, obsReads2);
-				pValue = fisher.getLeftTailedP(expReads1, expReads2, obsReads1, obsReads2);
-				fisher_max = fisher_max + 1000;
-			}
-		}
+		// Degenerate margins have no normal approximation //
+
+		if(Double.isNaN(pValue))
+			pValue = getSignificance(expReads1, expReads2, obsReads1, obsReads2);
 
 		return(pValue);
 	}
 
 
+
+	/**
+	 * Calculates significance of read counts between two samples for a batch of tables
+	 *
+	 * @param	expReads1	Reads supporting allele 1 (expected) for each table
+	 * @param	expReads2	Reads supporting allele 2 (expected) for each table
+	 * @param	obsReads1	Reads supporting allele 1 (observed) for each table
+	 * @param	obsReads2	Reads supporting allele 2 (observed) for each table
+	 * @param	pValues 	Receives the p-value from getSignificance for each table
+	 * @throws	IllegalArgumentException if the five arrays are not all the same length
+	 */
+	public static void getSignificance(int[] expReads1, int[] expReads2, int[] obsReads1, int[] obsReads2, double[] pValues)
+	{
+		int count = pValues.length;
+		if(expReads1.length != count || expReads2.length != count || obsReads1.length != count || obsReads2.length != count)
+			throw new IllegalArgumentException("Fisher batch arrays differ in length");
+
+		int[] a = new int[count];
+		int[] b = new int[count];
+		int[] c = new int[count];
+		int[] d = new int[count];
+
+		for(int i = 0; i < count; i++)
+		{
+			a[i] = Math.max(0, expReads1[i]);
+			b[i] = Math.max(0, expReads2[i]);
+			c[i] = Math.max(0, obsReads1[i]);
+			d[i] = Math.max(0, obsReads2[i]);
+		}
+
+		sharedFisher.getRightTailedP(a, b, c, d, pValues);
+
+		// If p-value is 1, do left-sided test //
+
+		for(int i = 0; i < count; i++)
+		{
+			if(pValues[i] >= 0.999)
+				pValues[i] = sharedFisher.getLeftTailedP(a[i], b[i], c[i], d[i]);
+			else if(Double.isNaN(pValues[i]))
+				System.err.println("Warning: unable to calculate p-value failure: " + a[i] + "," + b[i] + "," + c[i] + "," + d[i]);
+		}
+	}
+
 }